@@ -0,0 +1,776 @@
+#!/usr/bin/env python3
+"""
+VaultSafe 同步服务器压测脚本
+在进程内通过 ASGI 传输直接调用应用：
+  - latency:     大文件上传期间小请求的延迟
+  - compression: 压缩与不压缩路径的传输字节数和每请求 CPU 时间
+  - payload:     不同负载大小（1 KB ~ 50 MB）的 GET/POST 吞吐量与延迟
+  - status:      不同配置数量（10 ~ 100k）下 /status 的延迟，以及分页和 NDJSON 导出的延迟
+  - mixed:       多个配置上的并发读写混合负载
+  - codec:       典型与大负载下上传、批量下载和 /status 的每请求 CPU 时间（对比 JSON 编解码层）
+  - scaling:     启动真实服务器进程，对比不同工作进程数（VAULTSAFE_WORKERS）下 mixed 负载的吞吐量
+  - replication: 启动主服务器和副本进程，测量副本追平耗时和写入传播到副本的延迟
+  - all:         依次运行 payload / status / mixed
+
+结果以 JSON 输出（--output 可写入文件），随机数据由 --seed 固定，便于在不同提交之间对比。
+
+依赖: pip install httpx
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Optional
+
+import httpx
+
+import sync_server
+
+
+# 默认参数
+SMALL_CONFIG = "bench-small"    # 小请求使用的配置
+LARGE_PAYLOAD_MB = 8            # 大上传的负载大小
+LARGE_UPLOADERS = 4             # 并发大上传的客户端数量
+SMALL_CLIENTS = 16              # 并发小请求的客户端数量
+DURATION = 5.0                  # 压测时长（秒）
+COMPRESSION_SIZES_KB = [64, 1024, 8192]  # 压缩对比使用的负载大小
+COMPRESSION_ROUNDS = 5          # 每种组合重复次数
+PAYLOAD_SIZES_KB = [1, 64, 1024, 10240, 51200]  # payload 场景的负载大小
+PAYLOAD_BYTES_PER_SIZE = 256 * 1024 * 1024      # 每种负载大小累计传输的字节数上限（决定重复次数）
+STATUS_CONFIG_COUNTS = [10, 1000, 10000, 100000]  # status 场景的配置数量
+STATUS_ROUNDS = 20              # 每种配置数量请求 /status 的次数
+STATUS_PAGE_LIMIT = 100         # status 场景分页请求的每页数量
+MIXED_CONFIGS = 200             # mixed 场景的配置数量
+MIXED_CLIENTS = 32              # mixed 场景的并发客户端数量
+MIXED_WRITE_RATIO = 0.2         # mixed 场景中写请求的比例
+MIXED_PAYLOAD_KB = 16           # mixed 场景的负载大小
+CODEC_PAYLOADS_KB = {"typical": 16, "large": 4096}  # codec 场景的负载大小
+CODEC_BYTES_PER_ITEM = 64 * 1024 * 1024        # codec 场景每项测量累计上传的字节数上限（决定重复次数）
+CODEC_STATUS_CONFIGS = 1000     # codec 场景 /status 使用的配置数量
+SCALING_WORKERS = [1, 2, 4]     # scaling 场景依次测试的工作进程数
+SCALING_PORT = 5099             # scaling 场景服务器监听的端口
+REPLICATION_WRITES = 200        # replication 场景测量复制延迟的写入次数
+SEED = 20240101                 # 随机数据种子
+
+rng = random.Random(SEED)
+
+
+def make_backup(size: int) -> str:
+    """构造指定大小的备份 JSON 字符串（密文为随机数据的 base64，接近真实备份）"""
+    ciphertext = base64.b64encode(rng.randbytes(size * 3 // 4)).decode("ascii")
+    return json.dumps({
+        "version": "1.0",
+        "format": "vaultsafe-encrypted",
+        "encrypted": True,
+        "data": {
+            "nonce": "bench-device",
+            "iv": "bench-iv",
+            "ciphertext": ciphertext
+        },
+        "checksum": "0" * 64,
+        "exportedAt": "2024-01-01T00:00:00.000Z"
+    })
+
+
+def make_upload(device_id: str, size: int) -> dict:
+    """构造上传请求体"""
+    return {
+        "device_id": device_id,
+        "timestamp": int(time.time()),
+        "encrypted_data": make_backup(size),
+        "version": "1.0"
+    }
+
+
+def percentile(samples: list, p: float) -> float:
+    """计算百分位数（最近秩法）"""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    k = max(0, min(len(ordered) - 1, int(round(p / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[k]
+
+
+def summarize(samples: list, elapsed: float = 0.0) -> dict:
+    """汇总延迟样本（毫秒）；给出总耗时时同时计算吞吐量"""
+    result = {
+        "count": len(samples),
+        "p50_ms": round(percentile(samples, 50) * 1000, 2),
+        "p95_ms": round(percentile(samples, 95) * 1000, 2),
+        "p99_ms": round(percentile(samples, 99) * 1000, 2),
+        "max_ms": round(max(samples) * 1000, 2) if samples else 0.0,
+    }
+    if elapsed:
+        result["throughput_rps"] = round(len(samples) / elapsed, 2)
+    return result
+
+
+async def large_uploader(client: httpx.AsyncClient, index: int, body: bytes, deadline: float, latencies: list):
+    """持续上传大负载直到截止时间"""
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        response = await client.post(
+            f"/sync/bench-large-{index}",
+            content=body,
+            headers={"Content-Type": "application/json"}
+        )
+        latencies.append(time.perf_counter() - start)
+        response.raise_for_status()
+
+
+async def small_reader(client: httpx.AsyncClient, deadline: float, latencies: list):
+    """持续发送小 GET 请求直到截止时间"""
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        response = await client.get(f"/sync/{SMALL_CONFIG}")
+        latencies.append(time.perf_counter() - start)
+        response.raise_for_status()
+
+
+async def bench_small_gets_under_large_posts(
+    large_mb: int = LARGE_PAYLOAD_MB,
+    uploaders: int = LARGE_UPLOADERS,
+    readers: int = SMALL_CLIENTS,
+    duration: float = DURATION
+) -> dict:
+    """大上传进行中时，测量并发小 GET 的延迟分布"""
+    transport = httpx.ASGITransport(app=sync_server.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        small = await client.post(f"/sync/{SMALL_CONFIG}", json=make_upload("bench-small", 512))
+        small.raise_for_status()
+
+        # 只在基线阶段测量纯小请求延迟
+        idle_latencies: list = []
+        idle_deadline = time.perf_counter() + min(duration, 1.0)
+        await asyncio.gather(*(small_reader(client, idle_deadline, idle_latencies) for _ in range(readers)))
+
+        large_body = json.dumps(make_upload("bench-large", large_mb * 1024 * 1024)).encode("utf-8")
+        get_latencies: list = []
+        post_latencies: list = []
+        deadline = time.perf_counter() + duration
+        await asyncio.gather(
+            *(large_uploader(client, i, large_body, deadline, post_latencies) for i in range(uploaders)),
+            *(small_reader(client, deadline, get_latencies) for _ in range(readers))
+        )
+
+    return {
+        "large_payload_mb": large_mb,
+        "uploaders": uploaders,
+        "readers": readers,
+        "idle_get": summarize(idle_latencies),
+        "get_under_load": summarize(get_latencies),
+        "large_post": summarize(post_latencies),
+    }
+
+
+async def bench_compression(
+    sizes_kb: list = COMPRESSION_SIZES_KB,
+    rounds: int = COMPRESSION_ROUNDS
+) -> list:
+    """对比 identity / gzip / zstd 路径的传输字节数和每请求 CPU 时间
+
+    CPU 时间为进程内 process_time 差值，包含 ASGI 客户端自身的开销，
+    因此只用于不同编码之间的相对比较。
+    """
+    results = []
+    backend = sync_server.data_store.backend
+    transport = httpx.ASGITransport(app=sync_server.app)
+
+    for encoding in sync_server.supported_encodings():
+        # 每种编码使用对应落盘压缩方式的存储，identity 即当前不压缩路径
+        previous_store = sync_server.data_store
+        with tempfile.TemporaryDirectory(prefix="vaultsafe-bench-") as data_dir:
+            sync_server.data_store = sync_server.create_data_store(backend, data_dir, compression=encoding)
+            async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+                for size_kb in sizes_kb:
+                    raw_body = json.dumps(make_upload("bench-compress", size_kb * 1024)).encode("utf-8")
+                    upload_body = sync_server.compress_content(raw_body, encoding)
+                    upload_headers = {"Content-Type": "application/json"}
+                    download_headers = {"Accept-Encoding": encoding}
+                    if encoding != "identity":
+                        upload_headers["Content-Encoding"] = encoding
+
+                    upload_cpu = 0.0
+                    download_cpu = 0.0
+                    download_bytes = 0
+                    for _ in range(rounds):
+                        start = time.process_time()
+                        response = await client.post("/sync/bench-compress", content=upload_body, headers=upload_headers)
+                        upload_cpu += time.process_time() - start
+                        response.raise_for_status()
+
+                        start = time.process_time()
+                        response = await client.get("/sync/bench-compress", headers=download_headers)
+                        download_cpu += time.process_time() - start
+                        response.raise_for_status()
+                        download_bytes = response.num_bytes_downloaded
+
+                    results.append({
+                        "encoding": encoding,
+                        "payload_kb": size_kb,
+                        "upload_bytes": len(upload_body),
+                        "download_bytes": download_bytes,
+                        "stored_bytes": sync_server.data_store.get_metadata("bench-compress")["stored_size"],
+                        "upload_cpu_ms": round(upload_cpu / rounds * 1000, 3),
+                        "download_cpu_ms": round(download_cpu / rounds * 1000, 3),
+                    })
+            sync_server.data_store.close()
+        sync_server.data_store = previous_store
+
+    return results
+
+
+async def bench_payload_sizes(sizes_kb: list = PAYLOAD_SIZES_KB) -> list:
+    """不同负载大小下 POST / GET /sync 的延迟与吞吐量（单客户端顺序请求）"""
+    results = []
+    transport = httpx.ASGITransport(app=sync_server.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        for size_kb in sizes_kb:
+            rounds = max(3, min(50, PAYLOAD_BYTES_PER_SIZE // (size_kb * 1024)))
+            config = f"bench-payload-{size_kb}"
+            body = json.dumps(make_upload("bench-payload", size_kb * 1024)).encode("utf-8")
+
+            post_latencies = []
+            start = time.perf_counter()
+            for _ in range(rounds):
+                begin = time.perf_counter()
+                response = await client.post(f"/sync/{config}", content=body, headers={"Content-Type": "application/json"})
+                post_latencies.append(time.perf_counter() - begin)
+                response.raise_for_status()
+            post_elapsed = time.perf_counter() - start
+
+            get_latencies = []
+            start = time.perf_counter()
+            for _ in range(rounds):
+                begin = time.perf_counter()
+                response = await client.get(f"/sync/{config}")
+                get_latencies.append(time.perf_counter() - begin)
+                response.raise_for_status()
+            get_elapsed = time.perf_counter() - start
+
+            results.append({
+                "payload_kb": size_kb,
+                "rounds": rounds,
+                "post": summarize(post_latencies, post_elapsed),
+                "get": summarize(get_latencies, get_elapsed),
+                "post_mb_per_s": round(len(body) * rounds / post_elapsed / 1024 / 1024, 2),
+                "get_mb_per_s": round(len(body) * rounds / get_elapsed / 1024 / 1024, 2),
+            })
+            await client.post(f"/clear/{config}")
+
+    return results
+
+
+def populate_configs(count: int, start: int = 0) -> None:
+    """直接通过数据存储批量写入配置（绕过 HTTP，只用于准备 /status 场景的数据）"""
+    store = sync_server.data_store
+    backup = make_backup(512)
+
+    def save(index):
+        store.save_data(
+            f"bench-status-{index:06d}",
+            {"device_info": {"bench-device": {}}, "encrypted_data": backup},
+            "bench-device"
+        )
+
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        list(pool.map(save, range(start, count)))
+
+
+async def bench_status(config_counts: list = STATUS_CONFIG_COUNTS, rounds: int = STATUS_ROUNDS) -> list:
+    """不同配置数量下 GET /status 的延迟和响应大小（配置数量递增，逐步补齐）"""
+    results = []
+    populated = 0
+    transport = httpx.ASGITransport(app=sync_server.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        for count in sorted(config_counts):
+            populate_start = time.perf_counter()
+            await asyncio.get_running_loop().run_in_executor(None, populate_configs, count, populated)
+            populate_seconds = time.perf_counter() - populate_start
+            populated = count
+
+            latencies = []
+            response_bytes = 0
+            start = time.perf_counter()
+            for _ in range(rounds):
+                begin = time.perf_counter()
+                response = await client.get("/status")
+                latencies.append(time.perf_counter() - begin)
+                response.raise_for_status()
+                response_bytes = response.num_bytes_downloaded
+            elapsed = time.perf_counter() - start
+
+            # 翻到中间的一页：键集分页的延迟应与配置总数无关
+            middle = await client.get("/status", params={"limit": count // 2 or 1})
+            middle.raise_for_status()
+            cursor = middle.json()["next_cursor"]
+            page_latencies = []
+            page_start = time.perf_counter()
+            for _ in range(rounds):
+                begin = time.perf_counter()
+                params = {"limit": STATUS_PAGE_LIMIT}
+                if cursor:
+                    params["cursor"] = cursor
+                response = await client.get("/status", params=params)
+                page_latencies.append(time.perf_counter() - begin)
+                response.raise_for_status()
+            page_elapsed = time.perf_counter() - page_start
+
+            # NDJSON 导出的完整耗时（ASGITransport 会缓冲整个响应，测不出首字节时间）
+            begin = time.perf_counter()
+            response = await client.get("/status", params={"format": "ndjson"})
+            export_seconds = time.perf_counter() - begin
+            response.raise_for_status()
+
+            results.append({
+                "configs": count,
+                "populate_seconds": round(populate_seconds, 2),
+                "response_bytes": response_bytes,
+                "status": summarize(latencies, elapsed),
+                "page": summarize(page_latencies, page_elapsed),
+                "ndjson": {
+                    "lines": response.text.count("\n"),
+                    "total_ms": round(export_seconds * 1000, 2),
+                },
+            })
+
+    return results
+
+
+async def mixed_client(
+    client: httpx.AsyncClient,
+    index: int,
+    bodies: list,
+    configs: int,
+    write_ratio: float,
+    deadline: float,
+    reads: list,
+    writes: list,
+    errors: list
+):
+    """在随机配置上按比例混合读写，直到截止时间"""
+    client_rng = random.Random(SEED + index)
+    while time.perf_counter() < deadline:
+        config = f"bench-mixed-{client_rng.randrange(configs)}"
+        begin = time.perf_counter()
+        if client_rng.random() < write_ratio:
+            response = await client.post(
+                f"/sync/{config}",
+                content=client_rng.choice(bodies),
+                headers={"Content-Type": "application/json"}
+            )
+            writes.append(time.perf_counter() - begin)
+        else:
+            response = await client.get(f"/sync/{config}")
+            reads.append(time.perf_counter() - begin)
+        if response.status_code != 200:
+            errors.append(response.status_code)
+
+
+async def bench_mixed(
+    configs: int = MIXED_CONFIGS,
+    clients: int = MIXED_CLIENTS,
+    write_ratio: float = MIXED_WRITE_RATIO,
+    payload_kb: int = MIXED_PAYLOAD_KB,
+    duration: float = DURATION
+) -> dict:
+    """多个配置上的并发读写混合负载"""
+    transport = httpx.ASGITransport(app=sync_server.app)
+    bodies = [
+        json.dumps(make_upload(f"bench-mixed-device-{i}", payload_kb * 1024)).encode("utf-8")
+        for i in range(8)
+    ]
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        # 预先写入所有配置，保证读请求都能命中
+        for i in range(configs):
+            response = await client.post(f"/sync/bench-mixed-{i}", content=bodies[i % len(bodies)], headers={"Content-Type": "application/json"})
+            response.raise_for_status()
+
+        reads: list = []
+        writes: list = []
+        errors: list = []
+        start = time.perf_counter()
+        deadline = start + duration
+        await asyncio.gather(*(
+            mixed_client(client, i, bodies, configs, write_ratio, deadline, reads, writes, errors)
+            for i in range(clients)
+        ))
+        elapsed = time.perf_counter() - start
+
+    return {
+        "configs": configs,
+        "clients": clients,
+        "write_ratio": write_ratio,
+        "payload_kb": payload_kb,
+        "duration_s": round(elapsed, 2),
+        "throughput_rps": round((len(reads) + len(writes)) / elapsed, 2),
+        "read": summarize(reads, elapsed),
+        "write": summarize(writes, elapsed),
+        "errors": len(errors),
+    }
+
+
+async def measure_cpu(request, rounds: int) -> float:
+    """重复发起请求，返回每请求的平均 CPU 时间（毫秒）"""
+    total = 0.0
+    for _ in range(rounds):
+        start = time.process_time()
+        response = await request()
+        total += time.process_time() - start
+        response.raise_for_status()
+    return round(total / rounds * 1000, 3)
+
+
+async def bench_codec(payloads_kb: dict = CODEC_PAYLOADS_KB, status_configs: int = CODEC_STATUS_CONFIGS) -> dict:
+    """JSON 编解码路径的每请求 CPU 时间：上传、批量下载（备份内嵌在 JSON 中）和 /status
+
+    与 compression 场景相同，CPU 时间包含 ASGI 客户端自身的开销，只用于对比不同提交或
+    是否安装 orjson 的结果。
+    """
+    results = {"json_codec": getattr(sync_server, "JSON_CODEC", "json"), "payloads": []}
+    transport = httpx.ASGITransport(app=sync_server.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        for label, size_kb in payloads_kb.items():
+            config = f"bench-codec-{label}"
+            body = json.dumps(make_upload("bench-codec", size_kb * 1024)).encode("utf-8")
+            rounds = max(5, min(200, CODEC_BYTES_PER_ITEM // len(body)))
+            headers = {"Content-Type": "application/json"}
+            batch = json.dumps({"configs": [{"name": config}]}).encode("utf-8")
+
+            upload_ms = await measure_cpu(lambda: client.post(f"/sync/{config}", content=body, headers=headers), rounds)
+            batch_ms = await measure_cpu(lambda: client.post("/sync/batch", content=batch, headers=headers), rounds)
+            results["payloads"].append({
+                "payload": label,
+                "payload_kb": size_kb,
+                "rounds": rounds,
+                "upload_cpu_ms": upload_ms,
+                "batch_download_cpu_ms": batch_ms,
+            })
+            await client.post(f"/clear/{config}")
+
+        await asyncio.get_running_loop().run_in_executor(None, populate_configs, status_configs)
+        results["status"] = {
+            "configs": status_configs,
+            "page_cpu_ms": await measure_cpu(lambda: client.get("/status", params={"limit": STATUS_PAGE_LIMIT}), STATUS_ROUNDS),
+            "full_cpu_ms": await measure_cpu(lambda: client.get("/status"), STATUS_ROUNDS),
+            "ndjson_cpu_ms": await measure_cpu(lambda: client.get("/status", params={"format": "ndjson"}), STATUS_ROUNDS),
+        }
+
+    return results
+
+
+def start_server(
+    workers: int,
+    data_dir: str,
+    backend: str,
+    port: int = SCALING_PORT,
+    extra_env: Optional[dict] = None
+) -> subprocess.Popen:
+    """以指定工作进程数启动真实的服务器进程，等待健康检查通过"""
+    env = dict(
+        os.environ,
+        VAULTSAFE_WORKERS=str(workers),
+        VAULTSAFE_PORT=str(port),
+        VAULTSAFE_DATA_DIR=data_dir,
+        VAULTSAFE_STORAGE_BACKEND=backend,
+        VAULTSAFE_LOG_LEVEL="WARNING",
+        **(extra_env or {}),
+    )
+    server = subprocess.Popen(
+        [sys.executable, os.path.abspath(sync_server.__file__)],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL
+    )
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/health", timeout=1).raise_for_status()
+            # 等所有工作进程都启动完成
+            time.sleep(1)
+            return server
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    server.kill()
+    raise RuntimeError(f"Server with {workers} workers did not start")
+
+
+async def scaling_load(base_url: str, index: int, clients: int, configs: int, duration: float) -> dict:
+    """一个压测进程：clients 个并发客户端对真实服务器执行 mixed 负载"""
+    bodies = [
+        json.dumps(make_upload(f"bench-scaling-device-{i}", MIXED_PAYLOAD_KB * 1024)).encode("utf-8")
+        for i in range(8)
+    ]
+    limits = httpx.Limits(max_connections=clients, max_keepalive_connections=clients)
+    async with httpx.AsyncClient(base_url=base_url, timeout=None, limits=limits) as client:
+        reads: list = []
+        writes: list = []
+        errors: list = []
+        deadline = time.perf_counter() + duration
+        await asyncio.gather(*(
+            mixed_client(client, index * clients + i, bodies, configs, MIXED_WRITE_RATIO, deadline, reads, writes, errors)
+            for i in range(clients)
+        ))
+    return {"reads": reads, "writes": writes, "errors": len(errors)}
+
+
+def scaling_load_process(args: tuple) -> dict:
+    """压测子进程入口"""
+    return asyncio.run(scaling_load(*args))
+
+
+def bench_scaling(
+    worker_counts: list = SCALING_WORKERS,
+    load_processes: int = 0,
+    clients: int = MIXED_CLIENTS,
+    duration: float = DURATION,
+    backend: str = sync_server.STORAGE_BACKEND,
+    configs: int = MIXED_CONFIGS
+) -> list:
+    """依次以不同工作进程数启动服务器，用多个压测进程施加相同的 mixed 负载，对比吞吐量
+
+    压测客户端本身也消耗 CPU，分散到 load_processes 个进程中，避免客户端先成为瓶颈。
+    """
+    load_processes = load_processes or os.cpu_count() or 1
+    per_process = max(1, clients // load_processes)
+    base_url = f"http://127.0.0.1:{SCALING_PORT}"
+    body = json.dumps(make_upload("bench-scaling-device", MIXED_PAYLOAD_KB * 1024)).encode("utf-8")
+
+    results = []
+    for workers in worker_counts:
+        with tempfile.TemporaryDirectory(prefix="vaultsafe-scaling-") as data_dir:
+            server = start_server(workers, data_dir, backend)
+            try:
+                # 预先写入所有配置，保证读请求都能命中
+                with httpx.Client(base_url=base_url, timeout=None) as client:
+                    for i in range(configs):
+                        client.post(
+                            f"/sync/bench-mixed-{i}", content=body, headers={"Content-Type": "application/json"}
+                        ).raise_for_status()
+
+                start = time.perf_counter()
+                with ProcessPoolExecutor(load_processes) as pool:
+                    loads = list(pool.map(
+                        scaling_load_process,
+                        [(base_url, i, per_process, configs, duration) for i in range(load_processes)]
+                    ))
+                elapsed = time.perf_counter() - start
+            finally:
+                server.terminate()
+                server.wait(30)
+
+        reads = [sample for load in loads for sample in load["reads"]]
+        writes = [sample for load in loads for sample in load["writes"]]
+        results.append({
+            "workers": workers,
+            "load_processes": load_processes,
+            "clients": per_process * load_processes,
+            "duration_s": round(elapsed, 2),
+            "throughput_rps": round((len(reads) + len(writes)) / elapsed, 2),
+            "read": summarize(reads, elapsed),
+            "write": summarize(writes, elapsed),
+            "errors": sum(load["errors"] for load in loads),
+        })
+
+    baseline = results[0]["throughput_rps"] if results else 0
+    for result in results:
+        result["speedup"] = round(result["throughput_rps"] / baseline, 2) if baseline else None
+    return results
+
+
+def wait_replicated(client: httpx.Client, since: int, feed: Optional[str], config: str, version: int) -> tuple:
+    """长轮询副本自己的变更流，直到 config 的 version 已应用，返回新的 (since, feed)"""
+    while True:
+        params = {"since": since, "wait": 10}
+        if feed:
+            params["feed"] = feed
+        response = client.get("/replication/changes", params=params)
+        response.raise_for_status()
+        page = response.json()
+        since, feed = page["next"], page["feed"]
+        if any(
+            change["config"] == config and change["version"] >= version
+            for change in page["changes"] if change["op"] == "put"
+        ):
+            return since, feed
+
+
+def bench_replication(
+    configs: int = MIXED_CONFIGS,
+    writes: int = REPLICATION_WRITES,
+    backend: str = sync_server.STORAGE_BACKEND
+) -> dict:
+    """启动主服务器和一个副本进程，测量副本追平已有配置的耗时，以及单次写入传播到副本的延迟
+
+    追平耗时从启动副本进程开始计时（包含进程启动）；传播延迟从向主服务器上传开始，
+    到副本的变更流出现该版本为止。
+    """
+    primary_url = f"http://127.0.0.1:{SCALING_PORT}"
+    replica_url = f"http://127.0.0.1:{SCALING_PORT + 1}"
+    body = json.dumps(make_upload("bench-replication-device", MIXED_PAYLOAD_KB * 1024)).encode("utf-8")
+    headers = {"Content-Type": "application/json"}
+
+    with tempfile.TemporaryDirectory(prefix="vaultsafe-primary-") as primary_dir, \
+            tempfile.TemporaryDirectory(prefix="vaultsafe-replica-") as replica_dir:
+        primary = start_server(1, primary_dir, backend)
+        replica = None
+        try:
+            with httpx.Client(base_url=primary_url, timeout=None) as client:
+                for i in range(configs):
+                    client.post(f"/sync/bench-mixed-{i}", content=body, headers=headers).raise_for_status()
+
+            start = time.perf_counter()
+            replica = start_server(1, replica_dir, backend, SCALING_PORT + 1, {"VAULTSAFE_REPLICA_OF": primary_url})
+            with httpx.Client(base_url=primary_url, timeout=None) as client, \
+                    httpx.Client(base_url=replica_url, timeout=None) as replica_client:
+                while replica_client.get("/status", params={"limit": 1}).json()["total_configs"] < configs:
+                    time.sleep(0.05)
+                catch_up = time.perf_counter() - start
+
+                page = replica_client.get("/replication/changes", params={"limit": 1}).json()
+                since, feed = page["last_seq"], page["feed"]
+                lags = []
+                lag_start = time.perf_counter()
+                for i in range(writes):
+                    config = f"bench-mixed-{i % configs}"
+                    begin = time.perf_counter()
+                    response = client.post(f"/sync/{config}", content=body, headers=headers)
+                    response.raise_for_status()
+                    since, feed = wait_replicated(replica_client, since, feed, config, response.json()["version"])
+                    lags.append(time.perf_counter() - begin)
+                elapsed = time.perf_counter() - lag_start
+        finally:
+            for server in (replica, primary):
+                if server is not None:
+                    server.terminate()
+                    server.wait(30)
+
+    return {
+        "configs": configs,
+        "payload_kb": MIXED_PAYLOAD_KB,
+        "catch_up_s": round(catch_up, 2),
+        "catch_up_configs_per_s": round(configs / catch_up, 2),
+        "writes": writes,
+        "lag": summarize(lags, elapsed),
+    }
+
+
+def run_metadata(backend: str, workers: int) -> dict:
+    """记录运行环境，便于对比不同提交的结果"""
+    try:
+        commit = subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "storage_backend": backend,
+        "storage_workers": workers,
+        "storage_compression": sync_server.data_store.compression,
+        "seed": SEED,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="VaultSafe 同步服务器压测")
+    parser.add_argument(
+        "scenario", nargs="?", default="latency",
+        choices=["latency", "compression", "payload", "status", "mixed", "codec", "scaling", "replication", "all"]
+    )
+    parser.add_argument("--sizes-kb", type=int, nargs="+", default=PAYLOAD_SIZES_KB, help="payload 场景的负载大小（KB）")
+    parser.add_argument("--status-configs", type=int, nargs="+", default=STATUS_CONFIG_COUNTS, help="status 场景的配置数量")
+    parser.add_argument("--duration", type=float, default=DURATION, help="latency / mixed 场景的持续时间（秒）")
+    parser.add_argument("--clients", type=int, default=MIXED_CLIENTS, help="mixed / scaling 场景的并发客户端数量")
+    parser.add_argument("--write-ratio", type=float, default=MIXED_WRITE_RATIO, help="mixed 场景中写请求的比例（1 为只写）")
+    parser.add_argument("--workers", type=int, nargs="+", default=SCALING_WORKERS, help="scaling 场景依次测试的工作进程数")
+    parser.add_argument("--load-processes", type=int, default=0, help="scaling 场景的压测进程数（默认等于 CPU 核数）")
+    parser.add_argument("--seed", type=int, default=SEED, help="随机数据种子")
+    parser.add_argument("--output", help="把 JSON 结果写入指定文件")
+    args = parser.parse_args()
+    rng.seed(args.seed)
+
+    print("=" * 50)
+    print("  VaultSafe 同步服务器压测")
+    print("=" * 50)
+
+    # 压测时不输出每个请求的日志
+    sync_server.logger.setLevel("WARNING")
+
+    with tempfile.TemporaryDirectory(prefix="vaultsafe-bench-") as data_dir:
+        workers = int(os.getenv("VAULTSAFE_STORAGE_WORKERS", sync_server.STORAGE_WORKERS))
+        backend = os.getenv("VAULTSAFE_STORAGE_BACKEND", sync_server.STORAGE_BACKEND)
+        sync_server.DATA_DIR = data_dir
+        sync_server.open_data_store(backend, data_dir, workers)
+
+        print(f"\n📁 临时数据目录: {data_dir}")
+        print(f"🗄️  存储后端: {backend}")
+        print(f"🧵 存储线程池: {workers}")
+        meta = run_metadata(backend, workers)
+        meta["seed"] = args.seed
+
+        if args.scenario == "latency":
+            print(f"⬆️  大上传: {LARGE_UPLOADERS} 个客户端 × {LARGE_PAYLOAD_MB} MB")
+            print(f"⬇️  小请求: {SMALL_CLIENTS} 个客户端，持续 {args.duration} 秒\n")
+
+            result = asyncio.run(bench_small_gets_under_large_posts(duration=args.duration))
+            result["storage_workers"] = workers
+            result["storage_backend"] = backend
+        elif args.scenario == "compression":
+            print(f"📦 编码: {', '.join(sync_server.supported_encodings())}\n")
+            result = asyncio.run(bench_compression())
+        elif args.scenario == "codec":
+            print(f"🧮 负载大小: {', '.join(f'{name} {kb} KB' for name, kb in CODEC_PAYLOADS_KB.items())}\n")
+            result = {"meta": meta, "codec": asyncio.run(bench_codec())}
+        elif args.scenario == "scaling":
+            print(f"👷 工作进程数: {', '.join(str(n) for n in args.workers)}")
+            print(f"🔀 混合读写: {args.clients} 个客户端 × {MIXED_CONFIGS} 个配置，持续 {args.duration} 秒\n")
+            result = {
+                "meta": meta,
+                "scaling": bench_scaling(args.workers, args.load_processes, args.clients, args.duration, backend),
+            }
+        elif args.scenario == "replication":
+            print(f"🔁 主服务器 → 副本: {MIXED_CONFIGS} 个配置，{REPLICATION_WRITES} 次写入\n")
+            result = {"meta": meta, "replication": bench_replication(backend=backend)}
+        else:
+            result = {"meta": meta}
+            if args.scenario in ("payload", "all"):
+                print(f"📦 负载大小: {', '.join(f'{kb} KB' for kb in args.sizes_kb)}")
+                result["payload"] = asyncio.run(bench_payload_sizes(args.sizes_kb))
+            if args.scenario in ("status", "all"):
+                print(f"📊 配置数量: {', '.join(str(n) for n in args.status_configs)}")
+                result["status"] = asyncio.run(bench_status(args.status_configs))
+            if args.scenario in ("mixed", "all"):
+                print(f"🔀 混合读写: {args.clients} 个客户端 × {MIXED_CONFIGS} 个配置，写比例 {args.write_ratio}，持续 {args.duration} 秒")
+                result["mixed"] = asyncio.run(bench_mixed(
+                    clients=args.clients, write_ratio=args.write_ratio, duration=args.duration
+                ))
+            print()
+        sync_server.close_data_store()
+
+    output = json.dumps(result, indent=2, ensure_ascii=False)
+    print(output)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+        print(f"\n💾 结果已写入: {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
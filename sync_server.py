@@ -5,21 +5,63 @@ VaultSafe 同步服务器 - FastAPI 版本
 支持多配置文件，通过 URL 参数指定配置名称
 """
 
+import asyncio
+import base64
+import bisect
+import gzip
+import hashlib
+import hmac
+import http.client
+import io
 import json
+import logging
 import os
+import queue
+import random
 import re
-import shutil
+import socket
+import sqlite3
+import struct
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import weakref
+import zlib
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import Optional, Dict, Any, List
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional, Dict, Any, List, Tuple, BinaryIO, Callable, Union
 from contextlib import asynccontextmanager
 
-from fastapi import FastAPI, HTTPException, Request, Depends, status
+from fastapi import FastAPI, HTTPException, Request, Response, Depends, Query, status
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import HTTPBasic, HTTPBearer, HTTPAuthorizationCredentials
-from fastapi.responses import ORJSONResponse
-from pydantic import BaseModel
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.routing import APIRoute
+from pydantic import BaseModel, ValidationError
+from starlette.concurrency import run_in_threadpool
 import uvicorn
 
+try:
+    import zstandard  # 可选依赖：pip install zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import orjson  # 可选依赖：pip install orjson，加快 JSON 编解码
+except ImportError:
+    orjson = None
+
+try:
+    import fcntl  # 多进程模式的跨进程文件锁（仅 Unix）
+except ImportError:
+    fcntl = None
+
 
 # 配置模型
 class SyncUploadData(BaseModel):
@@ -30,6 +72,33 @@ class SyncUploadData(BaseModel):
     version: str = "1.0"
 
 
+class BatchUploadData(SyncUploadData):
+    """批量上传中的单个配置"""
+    config_name: str
+    if_match: Optional[str] = None
+
+
+class ManifestUploadData(BaseModel):
+    """分块上传的清单：按顺序列出组成完整备份的数据块哈希"""
+    device_id: str
+    timestamp: int
+    chunks: List[str]
+    version: str = "1.0"
+
+
+class BatchFetchItem(BaseModel):
+    """批量下载中的单个配置及客户端已知的版本"""
+    name: str
+    etag: Optional[str] = None
+    last_updated: Optional[str] = None
+
+
+class BatchSyncRequest(BaseModel):
+    """批量同步请求"""
+    uploads: List[BatchUploadData] = []
+    configs: List[BatchFetchItem] = []
+
+
 class ConfigResponse(BaseModel):
     """配置响应模型"""
     name: str
@@ -37,7 +106,12 @@ class ConfigResponse(BaseModel):
     has_data: bool = False
     devices: List[str] = []
     backup: Dict[str, Any] = {}
+    size: int = 0
+    etag: Optional[str] = None
+    version: Optional[int] = None
+    version_count: int = 0
     error: Optional[str] = None
+    integrity: Optional[Dict[str, Any]] = None
 
 
 class StatusResponse(BaseModel):
@@ -46,6 +120,7 @@ class StatusResponse(BaseModel):
     data_dir: str
     total_configs: int
     configs: List[ConfigResponse]
+    next_cursor: Optional[str] = None
 
 
 # 配置
@@ -55,344 +130,5894 @@ API_TOKEN: Optional[str] = None  # 设置为 None 则不需要认证
 BASIC_AUTH_USERNAME: Optional[str] = None
 BASIC_AUTH_PASSWORD: Optional[str] = None
 DATA_DIR = 'sync_data'  # 数据目录
+STORAGE_BACKEND = 'file'  # 存储后端：file / sqlite / journal
+STORAGE_WORKERS = 4  # 存储 I/O 线程池大小
+STORAGE_COMPRESSION = 'gzip'  # 备份落盘压缩方式：gzip / zstd / identity
+MAX_DECOMPRESSED_SIZE = 256 * 1024 * 1024  # 解压后请求体的最大字节数
+MAX_VERSIONS = 10  # 每个配置保留的历史版本数
+GC_INTERVAL = 10.0  # 后台垃圾回收间隔（秒）
+GC_GRACE_SECONDS = 3600.0  # 未被引用的备份至少保留多久才会被回收（秒）
+GC_BATCH_SIZE = 100  # 每步垃圾回收最多删除的备份数量
+PURGE_RATE_MB = 32.0  # 后台物理删除已清除数据的速率上限（MB/秒）
+SCRUB_RATE_MB = 4.0  # 后台完整性校验读取备份的速率上限（MB/秒），0 表示不校验
+SCRUB_INTERVAL = 3600.0  # 完整性校验每轮检查完所有配置后，间隔多久开始下一轮（秒）
+SCRUB_BATCH_SIZE = 100  # 完整性校验每步最多列出的配置数量
+JOURNAL_SEGMENT_SIZE = 64 * 1024 * 1024  # journal 后端的日志段写满该大小后切换到新段
+JOURNAL_COMPACT_RATIO = 0.5  # 已封存日志段中有效数据低于该比例时在垃圾回收中压缩
+MAX_WAIT_SECONDS = 300.0  # 长轮询 ?wait= 的最大等待时间（秒）
+SSE_KEEPALIVE_SECONDS = 15.0  # SSE 空闲时发送心跳注释的间隔（秒）
+MAX_BATCH_SIZE = 100  # 一次批量同步最多包含的配置数量
+STATUS_PAGE_SIZE = 1000  # /status 分页每页最多返回的配置数量，也是 NDJSON 导出每次从存储读取的数量
+CHUNK_MIN_SIZE = 64 * 1024  # 内容分块的最小大小
+CHUNK_MAX_SIZE = 1024 * 1024  # 内容分块的最大大小
+CHUNK_BOUNDARY = b'Zz'  # 内容分块的切分标记
+CHUNK_UPLOAD_MAX_SIZE = 8 * 1024 * 1024  # 客户端上传单个数据块的最大字节数
+CHUNKED_ENCODING = 'chunked'  # 分块存储的版本记录中的 encoding 标记
+CHUNK_CACHE_SIZE = 64  # 缓存最近切分过的整体备份的数据块列表个数
+LOG_LEVEL = 'INFO'  # 日志级别：DEBUG / INFO / WARNING / ERROR
+LOG_SAMPLE_RATE = 1.0  # 上传/下载请求日志的采样比例（0~1）
+WORKERS = 1  # uvicorn 工作进程数，大于 1 时启用跨进程协调（仅 Unix）
+CHANGE_POLL_INTERVAL = 0.05  # 多进程模式下检查其他工作进程变更的间隔（秒）
+CHANGELOG_MAX_SIZE = 4 * 1024 * 1024  # 共享变更日志超过该大小时清空重写
+CACHE_MAX_MB = 64  # 热点备份响应缓存的内存上限（MB），0 表示不缓存
+RATE_LIMIT = 0.0  # 每个凭据（未携带或未通过认证时每个 IP）每秒允许的请求数，0 表示不限制
+IP_RATE_LIMIT = 0.0  # 每个客户端 IP 每秒允许的请求数（不区分凭据），0 表示不限制
+CONFIG_WRITE_RATE_LIMIT = 0.0  # 每个配置每秒允许的上传次数，0 表示不限制
+RATE_LIMIT_BURST_SECONDS = 10.0  # 令牌桶容量：最多可以一次性用掉多少秒的额度
+CONFIG_QUOTA_MB = 0.0  # 单个配置备份（请求体）的大小上限（MB），0 表示不限制
+STORAGE_QUOTA_MB = 0.0  # 所有配置当前备份的总落盘大小上限（MB），0 表示不限制
+TOKEN_FILE: Optional[str] = None  # 多用户令牌文件（JSON），设置后按令牌限定可访问的配置
+TOKEN_RELOAD_INTERVAL = 1.0  # 检查令牌文件是否变化的最短间隔（秒）
+REPLICA_OF = ''  # 副本模式：主服务器地址（如 http://127.0.0.1:5000），为空时作为主服务器运行
+REPLICA_TOKEN = ''  # 副本访问主服务器的 Bearer 令牌，为空时使用 API_TOKEN；地址中带 user:password@ 时改用 Basic 认证
+REPLICATION_PAGE_SIZE = 500  # /replication/changes 每次最多返回的变更数量，也是副本每批应用的数量
+REPLICATION_LOG_MAX_SIZE = 4 * 1024 * 1024  # 复制变更流文件超过该大小且半数以上的行已失效时重写
+REPLICATION_SEQ_BLOCK = 1000  # 复制变更流每次持久化预留的序号数量
+REPLICA_CONCURRENCY = 4  # 副本同时从主服务器下载的备份数量
+REPLICA_POLL_WAIT = 20.0  # 副本长轮询变更流的等待时间（秒）
+REPLICA_RETRY_SECONDS = 5.0  # 副本同步失败后重试的间隔（秒）
+
+# 从环境变量读取配置（可选）
+# 在模块级读取：uvicorn 多进程模式下每个工作进程都会重新导入本模块，__main__ 中的赋值不会生效
+API_TOKEN = os.getenv('VAULTSAFE_API_TOKEN', API_TOKEN)
+BASIC_AUTH_USERNAME = os.getenv('VAULTSAFE_USERNAME', BASIC_AUTH_USERNAME)
+BASIC_AUTH_PASSWORD = os.getenv('VAULTSAFE_PASSWORD', BASIC_AUTH_PASSWORD)
+PORT = int(os.getenv('VAULTSAFE_PORT', PORT))
+DATA_DIR = os.getenv('VAULTSAFE_DATA_DIR', DATA_DIR)
+STORAGE_BACKEND = os.getenv('VAULTSAFE_STORAGE_BACKEND', STORAGE_BACKEND)
+STORAGE_WORKERS = int(os.getenv('VAULTSAFE_STORAGE_WORKERS', STORAGE_WORKERS))
+STORAGE_COMPRESSION = os.getenv('VAULTSAFE_STORAGE_COMPRESSION', STORAGE_COMPRESSION)
+MAX_VERSIONS = int(os.getenv('VAULTSAFE_MAX_VERSIONS', MAX_VERSIONS))
+GC_INTERVAL = float(os.getenv('VAULTSAFE_GC_INTERVAL', GC_INTERVAL))
+PURGE_RATE_MB = float(os.getenv('VAULTSAFE_PURGE_RATE_MB', PURGE_RATE_MB))
+SCRUB_RATE_MB = float(os.getenv('VAULTSAFE_SCRUB_RATE_MB', SCRUB_RATE_MB))
+SCRUB_INTERVAL = float(os.getenv('VAULTSAFE_SCRUB_INTERVAL', SCRUB_INTERVAL))
+LOG_LEVEL = os.getenv('VAULTSAFE_LOG_LEVEL', LOG_LEVEL)
+LOG_SAMPLE_RATE = float(os.getenv('VAULTSAFE_LOG_SAMPLE_RATE', LOG_SAMPLE_RATE))
+WORKERS = int(os.getenv('VAULTSAFE_WORKERS', WORKERS))
+CACHE_MAX_MB = float(os.getenv('VAULTSAFE_CACHE_MB', CACHE_MAX_MB))
+RATE_LIMIT = float(os.getenv('VAULTSAFE_RATE_LIMIT', RATE_LIMIT))
+IP_RATE_LIMIT = float(os.getenv('VAULTSAFE_IP_RATE_LIMIT', IP_RATE_LIMIT))
+CONFIG_WRITE_RATE_LIMIT = float(os.getenv('VAULTSAFE_CONFIG_WRITE_RATE_LIMIT', CONFIG_WRITE_RATE_LIMIT))
+RATE_LIMIT_BURST_SECONDS = float(os.getenv('VAULTSAFE_RATE_LIMIT_BURST_SECONDS', RATE_LIMIT_BURST_SECONDS))
+CONFIG_QUOTA_MB = float(os.getenv('VAULTSAFE_CONFIG_QUOTA_MB', CONFIG_QUOTA_MB))
+STORAGE_QUOTA_MB = float(os.getenv('VAULTSAFE_STORAGE_QUOTA_MB', STORAGE_QUOTA_MB))
+TOKEN_FILE = os.getenv('VAULTSAFE_TOKEN_FILE', TOKEN_FILE)
+TOKEN_RELOAD_INTERVAL = float(os.getenv('VAULTSAFE_TOKEN_RELOAD_INTERVAL', TOKEN_RELOAD_INTERVAL))
+REPLICA_OF = os.getenv('VAULTSAFE_REPLICA_OF', REPLICA_OF)
+REPLICA_TOKEN = os.getenv('VAULTSAFE_REPLICA_TOKEN', REPLICA_TOKEN) or API_TOKEN
 
 # 安全认证
 security_bearer = HTTPBearer(auto_error=False)
 security_basic = HTTPBasic(auto_error=False)
 
 
-# 数据存储类
-class DataStore:
-    """数据存储管理类"""
+# JSON 编解码：安装了 orjson 时使用 orjson，否则回退到标准库 json，两者的输出可以互相读取
+JSON_CODEC = 'orjson' if orjson is not None else 'json'
 
-    def __init__(self, data_dir: str):
-        self.data_dir = data_dir
-        os.makedirs(data_dir, exist_ok=True)
 
-    def get_config_file(self, config_name: str) -> str:
-        """获取配置文件路径"""
-        # 安全检查：只允许文件名（字母、数字、下划线、连字符）
-        if not re.match(r'^[a-zA-Z0-9_-]+$', config_name):
-            raise ValueError(f"Invalid config name: {config_name}")
+def json_encode(obj: Any, indent: bool = False, default: Optional[Callable[[Any], Any]] = None) -> bytes:
+    """编码为 UTF-8 JSON：默认紧凑格式，``indent`` 时缩进两个空格；非 ASCII 字符不转义"""
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if indent else 0)
+        return orjson.dumps(obj, default=default, option=option)
+    return json.dumps(
+        obj, ensure_ascii=False, default=default,
+        indent=2 if indent else None, separators=None if indent else (',', ':')
+    ).encode('utf-8')
 
-        return os.path.join(self.data_dir, f"{config_name}.json")
 
-    def load_data(self, config_name: str) -> Dict[str, Any]:
-        """加载存储的数据"""
-        data_file = self.get_config_file(config_name)
+def json_decode(data: Union[bytes, str]) -> Any:
+    """解析 JSON（bytes 无需先解码为 str），格式错误时抛出 json.JSONDecodeError（orjson 的异常是其子类）"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
 
-        if not os.path.exists(data_file):
-            return {
-                'config_name': config_name,
-                'encrypted_data': None,
-                'last_updated': None,
-                'device_info': {}
-            }
 
+def compute_etag(blob_hash: str) -> str:
+    """由备份内容的 SHA-256 生成强 ETag"""
+    return f'"{blob_hash}"'
+
+
+def backup_bytes(encrypted_data: Union[bytes, str]) -> bytes:
+    """上传的备份内容：已是 bytes 时直接使用，str 按 UTF-8 编码"""
+    if isinstance(encrypted_data, bytes):
+        return encrypted_data
+    return encrypted_data.encode('utf-8')
+
+
+def summarize_backup(blob: bytes) -> Dict[str, Any]:
+    """解析备份 JSON，提取版本、导出时间和校验和（仅在保存时执行一次）"""
+    try:
+        backup = json_decode(blob)
+        return {
+            'version': backup.get('version'),
+            'exportedAt': backup.get('exportedAt'),
+            'checksum': backup.get('checksum', '')
+        }
+    except Exception:
+        return {}
+
+
+CHUNK_HASH_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+BACKUP_FIELD_PATTERN = re.compile(rb'"(version|exportedAt|checksum)"\s*:\s*"([^"\\]*)"')
+
+
+def summarize_backup_fragments(head: bytes, tail: bytes) -> Dict[str, Any]:
+    """从超大备份的开头和结尾片段提取摘要，不解析完整 JSON
+
+    客户端导出的备份中 ``version`` 位于密文之前，``checksum`` / ``exportedAt`` 位于密文之后。
+    """
+    fields: Dict[str, Any] = {}
+    for match in BACKUP_FIELD_PATTERN.finditer(head):
+        fields.setdefault(match.group(1).decode(), match.group(2).decode())
+    for match in BACKUP_FIELD_PATTERN.finditer(tail):
+        if match.group(1) != b'version':
+            fields[match.group(1).decode()] = match.group(2).decode()
+    return {
+        'version': fields.get('version'),
+        'exportedAt': fields.get('exportedAt'),
+        'checksum': fields.get('checksum', '')
+    }
+
+
+def supported_encodings() -> List[str]:
+    """当前环境可用的内容编码"""
+    encodings = ['identity', 'gzip']
+    if zstandard is not None:
+        encodings.append('zstd')
+    return encodings
+
+
+# 压缩内容损坏时解压器抛出的异常
+CORRUPT_CONTENT_ERRORS: Tuple[type, ...] = (zlib.error, EOFError)
+if zstandard is not None:
+    CORRUPT_CONTENT_ERRORS += (zstandard.ZstdError,)
+
+
+def compressor_for(encoding: str):
+    """创建增量压缩器（compress/flush 接口），identity 返回 None"""
+    if encoding == 'gzip':
+        # 备份主体是随机密文的 base64，几乎没有可复用的重复串，
+        # 只做 Huffman 编码的压缩率与默认策略相当，速度快数倍
+        return zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS, 9, zlib.Z_HUFFMAN_ONLY)
+    if encoding == 'zstd' and zstandard is not None:
+        return zstandard.ZstdCompressor(level=3).compressobj()
+    if encoding == 'identity':
+        return None
+    raise ValueError(f"Unsupported content encoding: {encoding}")
+
+
+def decompressor_for(encoding: str):
+    """创建增量解压器（decompress 接口），identity 返回 None"""
+    if encoding in ('gzip', 'x-gzip'):
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if encoding == 'zstd' and zstandard is not None:
+        return zstandard.ZstdDecompressor().decompressobj()
+    if encoding == 'identity':
+        return None
+    raise ValueError(f"Unsupported content encoding: {encoding}")
+
+
+def compress_content(content: bytes, encoding: str) -> bytes:
+    """按指定内容编码压缩数据"""
+    compressor = compressor_for(encoding)
+    if compressor is None:
+        return content
+    return compressor.compress(content) + compressor.flush()
+
+
+def decompress_content(content: bytes, encoding: str, max_size: int = MAX_DECOMPRESSED_SIZE) -> bytes:
+    """按指定内容编码解压数据，超过 max_size 时抛出 OverflowError"""
+    if encoding in ('gzip', 'x-gzip'):
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        result = decompressor.decompress(content, max_size + 1)
+        if decompressor.unconsumed_tail:
+            raise OverflowError("Decompressed content is too large")
+    elif encoding == 'zstd' and zstandard is not None:
+        reader = zstandard.ZstdDecompressor().stream_reader(content)
+        result = reader.read(max_size + 1)
+    elif encoding == 'identity':
+        result = content
+    else:
+        raise ValueError(f"Unsupported content encoding: {encoding}")
+
+    if len(result) > max_size:
+        raise OverflowError("Decompressed content is too large")
+    return result
+
+
+def accepts_encoding(accept_encoding: Optional[str], encoding: str) -> bool:
+    """判断 Accept-Encoding 请求头是否接受指定编码（q=0 视为拒绝）"""
+    if encoding == 'identity':
+        return True
+    if not accept_encoding:
+        return False
+
+    for item in accept_encoding.split(','):
+        token, _, params = item.strip().partition(';')
+        if token.strip().lower() not in (encoding, '*'):
+            continue
+        params = params.strip().replace(' ', '')
+        if params.startswith('q='):
+            try:
+                return float(params[2:]) > 0
+            except ValueError:
+                return False
+        return True
+    return False
+
+
+def open_decoded(f: BinaryIO, encoding: str) -> BinaryIO:
+    """把落盘的（可能已压缩的）文件对象包装为按需解压的只读流，每次读取的内存有界"""
+    if encoding == 'gzip':
+        return gzip.GzipFile(fileobj=f, mode='rb')
+    if encoding == 'zstd' and zstandard is not None:
+        return zstandard.ZstdDecompressor().stream_reader(f, closefd=False)
+    if encoding == 'identity':
+        return f
+    raise ValueError(f"Unsupported content encoding: {encoding}")
+
+
+def parse_range(range_header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """解析单个 ``bytes`` 区间，返回闭区间 (起始, 结束)
+
+    没有 Range、格式不支持或请求多个区间时返回 None（按完整内容响应），
+    区间无法满足时抛出 ValueError（应返回 416）。
+    """
+    if not range_header:
+        return None
+    unit, _, spec = range_header.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in spec:
+        return None
+
+    start_text, sep, end_text = (part.strip() for part in spec.partition('-'))
+    if not sep or not (start_text or end_text):
+        return None
+    if (start_text and not start_text.isdigit()) or (end_text and not end_text.isdigit()):
+        return None
+
+    if start_text:
+        start = int(start_text)
+        end = int(end_text) if end_text else size - 1
+        if end_text and end < start:
+            return None
+    else:
+        # 后缀区间：最后 N 个字节
+        suffix = int(end_text)
+        if suffix == 0:
+            raise ValueError(f"Range not satisfiable: {range_header}")
+        start, end = max(0, size - suffix), size - 1
+
+    if start >= size:
+        raise ValueError(f"Range not satisfiable: {range_header}")
+    return start, min(end, size - 1)
+
+
+class BackupDigest:
+    """增量计算备份的 SHA-256、大小和摘要，内存占用与备份大小无关
+
+    只保留开头和结尾各一小段用于提取备份摘要（版本、导出时间、校验和）。
+    """
+
+    SUMMARY_WINDOW = 64 * 1024
+
+    def __init__(self, max_size: int = MAX_DECOMPRESSED_SIZE):
+        self.max_size = max_size
+        self.size = 0
+        self._hasher = hashlib.sha256()
+        self._head = bytearray()
+        self._tail = b''
+
+    def update(self, chunk: bytes) -> None:
+        self.size += len(chunk)
+        if self.size > self.max_size:
+            raise OverflowError("Backup is too large")
+
+        self._hasher.update(chunk)
+        if len(self._head) < self.SUMMARY_WINDOW:
+            self._head += chunk[:self.SUMMARY_WINDOW - len(self._head)]
+        self._tail = (self._tail + chunk[-self.SUMMARY_WINDOW:])[-self.SUMMARY_WINDOW:]
+
+    def hexdigest(self) -> str:
+        return self._hasher.hexdigest()
+
+    def summary(self) -> Dict[str, Any]:
+        if self.size <= self.SUMMARY_WINDOW:
+            return summarize_backup(bytes(self._head))
+        return summarize_backup_fragments(bytes(self._head), self._tail)
+
+
+class StagedBlob:
+    """流式写入的备份临时文件
+
+    写入时同步计算 SHA-256、按落盘编码增量压缩并统计大小，内存占用与备份大小无关。
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        encoding: str,
+        max_size: int = MAX_DECOMPRESSED_SIZE,
+        content_encoding: str = 'identity',
+        durable: bool = True
+    ):
+        self._decompressor = decompressor_for(content_encoding)
+        self._compressor = compressor_for(encoding)
+        fd, self.path = tempfile.mkstemp(dir=directory, prefix='.upload-', suffix='.tmp')
+        self._file = os.fdopen(fd, 'wb')
+        self.encoding = encoding
+        self.durable = durable
+        self._digest = BackupDigest(max_size)
+        self.stored_size = 0
+        self.hash: Optional[str] = None
+        self.backup: Dict[str, Any] = {}
+
+    @property
+    def size(self) -> int:
+        """已写入的未压缩字节数"""
+        return self._digest.size
+
+    def write(self, chunk: bytes) -> None:
+        """写入一块数据（请求带 Content-Encoding 时先解压）"""
+        if self._decompressor is not None:
+            chunk = self._decompressor.decompress(chunk)
+        if not chunk:
+            return
+
+        self._digest.update(chunk)
+        if self._compressor is not None:
+            chunk = self._compressor.compress(chunk)
+        self._file.write(chunk)
+        self.stored_size += len(chunk)
+
+    def finish(self) -> None:
+        """写完剩余的压缩数据并落盘，计算哈希和备份摘要"""
+        if self._compressor is not None:
+            rest = self._compressor.flush()
+            self._file.write(rest)
+            self.stored_size += len(rest)
+        self._file.flush()
+        if self.durable:
+            os.fsync(self._file.fileno())
+        self._file.close()
+
+        self.hash = self._digest.hexdigest()
+        self.backup = self._digest.summary()
+
+    def discard(self) -> None:
+        """删除临时文件（已被移入备份存储时无操作）"""
+        self._file.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def iter_content_chunks(
+    reader: BinaryIO,
+    min_size: int = CHUNK_MIN_SIZE,
+    max_size: int = CHUNK_MAX_SIZE,
+    boundary: bytes = CHUNK_BOUNDARY
+):
+    """按内容切分数据流
+
+    从距上一个切点 min_size 处开始查找 boundary，切在其后；max_size 内没有找到则强制切分。
+    切点只取决于附近的内容，插入或删除数据后之后的切点会重新对齐。
+    备份主体是随机密文的 base64，两个字符的 boundary 约每 4 KB 出现一次；
+    查找使用 bytes.find，不逐字节计算滚动哈希。
+    """
+    buffer = b''
+    eof = False
+    while buffer or not eof:
+        while not eof and len(buffer) < max_size:
+            data = reader.read(max_size)
+            if not data:
+                eof = True
+            buffer += data
+
+        if len(buffer) <= min_size:
+            if buffer:
+                yield buffer
+            return
+
+        index = buffer.find(boundary, min_size, max_size)
+        cut = index + len(boundary) if index >= 0 else min(max_size, len(buffer))
+        yield buffer[:cut]
+        buffer = buffer[cut:]
+
+
+class MissingChunksError(Exception):
+    """清单引用了服务器上不存在的数据块"""
+
+    def __init__(self, missing: List[str]):
+        super().__init__(f"{len(missing)} chunks are missing")
+        self.missing = missing
+
+
+class ChunkedReader(io.RawIOBase):
+    """把分块存储的版本按顺序拼接为未压缩的只读流，每次只打开一个数据块"""
+
+    def __init__(self, store: 'DataStore', chunks: List[List[Any]]):
+        super().__init__()
+        self.store = store
+        self.chunks = chunks
+        self._index = 0
+        self._position = 0
+        self._raw: Optional[BinaryIO] = None
+        self._reader: Optional[BinaryIO] = None
+
+    def readable(self) -> bool:
+        return True
+
+    def _close_current(self) -> None:
+        if self._reader is not None:
+            self._reader.close()
+            self._raw.close()
+            self._reader = self._raw = None
+
+    def _open_current(self) -> bool:
+        if self._index >= len(self.chunks):
+            return False
+        chunk_hash, _, encoding = self.chunks[self._index]
+        self._raw, _ = self.store.open_blob(chunk_hash, encoding)
+        self._reader = open_decoded(self._raw, encoding)
+        return True
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            return b''.join(iter(lambda: self.read(1024 * 1024), b''))
+        while True:
+            if self._reader is None and not self._open_current():
+                return b''
+            data = self._reader.read(size)
+            if data:
+                self._position += len(data)
+                return data
+            self._close_current()
+            self._index += 1
+
+    def readinto(self, buffer) -> int:
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        """只支持向前定位：整块跳过，不读取被跳过的数据块"""
+        if whence != io.SEEK_SET or offset < self._position:
+            raise io.UnsupportedOperation("ChunkedReader only seeks forward")
+        if offset == self._position:
+            return offset
+
+        # 从当前数据块的开头重新定位
+        self._close_current()
+        skip = offset - sum(chunk[1] for chunk in self.chunks[:self._index])
+        while self._index < len(self.chunks) and skip >= self.chunks[self._index][1]:
+            skip -= self.chunks[self._index][1]
+            self._index += 1
+        if skip and self._open_current():
+            self._reader.seek(skip)
+        self._position = offset
+        return offset
+
+    def tell(self) -> int:
+        return self._position
+
+    def close(self) -> None:
+        self._close_current()
+        super().close()
+
+
+def atomic_write(path: str, content: bytes) -> None:
+    """原子写入文件：先写同目录临时文件并 fsync，再用 os.replace 替换
+
+    读取方只会看到旧文件或完整的新文件，不会读到写了一半的内容。
+    """
+    directory, filename = os.path.split(path)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f'.{filename}.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def fsync_directory(directory: str) -> None:
+    """fsync 目录，使 rename 持久化（Windows 不支持，直接跳过）"""
+    if not hasattr(os, 'O_DIRECTORY'):
+        return
+    fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class InterProcessLock:
+    """线程锁 + 文件锁（flock）：同一进程内的线程之间、共享数据目录的工作进程之间都互斥
+
+    ``path`` 为 None（单进程模式）时只是普通的线程锁。只用于持有时间很短的临界区，
+    在线程池中阻塞等待；配置写锁可能持有较久，见 DataStore.locked。
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        if path and fcntl is None:
+            raise ValueError("Cross-process file locks require fcntl (Unix only)")
+        self._lock = threading.Lock()
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600) if path else None
+
+    def __enter__(self) -> 'InterProcessLock':
+        self._lock.acquire()
+        if self._fd is not None:
+            try:
+                fcntl.flock(self._fd, fcntl.LOCK_EX)
+            except BaseException:
+                self._lock.release()
+                raise
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._lock.release()
+
+    def close(self) -> None:
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+async def flock_async(fd: int, operation: int) -> None:
+    """以非阻塞方式重试获取文件锁，等待期间不占用线程：其他进程持锁时本进程的其他请求照常处理"""
+    delay = 0.001
+    while True:
+        try:
+            fcntl.flock(fd, operation | fcntl.LOCK_NB)
+            return
+        except BlockingIOError:
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.05)
+
+
+class StoreBarrier:
+    """整个存储的读写屏障：写入配置（以及后台回收、校验的每一步）以共享方式持有，清除全部数据以独占方式持有
+
+    独占请求等待期间，新的共享请求排在它之后，持续的上传不会让清除一直等下去。
+    ``path`` 不为 None（多进程模式）时同时持有该文件的共享 / 独占文件锁，在工作进程之间同样互斥。
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self._shared = 0
+        self._exclusive = False
+        self._waiting = 0
+        self._changed = asyncio.Condition()
+
+    @asynccontextmanager
+    async def _file_lock(self, exclusive: bool):
+        if self.path is None:
+            yield
+            return
+        # 每个持有者各用一个文件描述符，共享锁之间互不影响；关闭即释放
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            await flock_async(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            yield
+        finally:
+            os.close(fd)
+
+    @asynccontextmanager
+    async def shared(self):
+        async with self._changed:
+            await self._changed.wait_for(lambda: not self._exclusive and not self._waiting)
+            self._shared += 1
+        try:
+            async with self._file_lock(False):
+                yield
+        finally:
+            async with self._changed:
+                self._shared -= 1
+                self._changed.notify_all()
+
+    @asynccontextmanager
+    async def exclusive(self):
+        async with self._changed:
+            self._waiting += 1
+            try:
+                await self._changed.wait_for(lambda: not self._exclusive and not self._shared)
+            finally:
+                self._waiting -= 1
+                # 取消等待时放行排在后面的共享请求
+                self._changed.notify_all()
+            self._exclusive = True
+        try:
+            async with self._file_lock(True):
+                yield
+        finally:
+            async with self._changed:
+                self._exclusive = False
+                self._changed.notify_all()
+
+
+class ChangeLog:
+    """多进程模式下的共享变更日志（数据目录下的 ``.changelog``）
+
+    每次写入或清除后追加一行 JSON（写入进程的 PID + 配置名），各工作进程从自己的读取位置
+    增量读取其他进程追加的行，用来失效本地缓存和推送变更通知。检查是否有新变更只需一次 stat。
+
+    文件超过 max_size 时被替换为空文件；读取方发现 inode 变化后先读完旧文件的剩余部分再切换，
+    追加与替换在同一把文件锁内完成，不会丢失变更。
+    """
+
+    def __init__(self, path: str, max_size: int = CHANGELOG_MAX_SIZE):
+        self.path = path
+        self.max_size = max_size
+        self.pid = os.getpid()
+        self._write_lock = InterProcessLock(path + '.lock')
+        self._read_lock = threading.Lock()
+        self._buffer = b''
+        with self._write_lock:
+            with open(path, 'ab'):
+                pass
+        # 只关心启动之后的变更
+        self._open(at_end=True)
+
+    def _open(self, at_end: bool = False) -> None:
+        self._file = open(self.path, 'rb', buffering=0)
+        stat = os.fstat(self._file.fileno())
+        self._inode = stat.st_ino
+        self._offset = stat.st_size if at_end else 0
+        self._file.seek(self._offset)
+        self._buffer = b''
+
+    def append(self, entry: Dict[str, Any]) -> None:
+        """追加一条变更（单行 JSON，O_APPEND 写入）"""
+        line = json_encode({'pid': self.pid, **entry}) + b'\n'
+        with self._write_lock:
+            with open(self.path, 'ab') as f:
+                f.write(line)
+                size = f.tell()
+            if size > self.max_size:
+                fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(self.path), prefix='.changelog-', suffix='.tmp')
+                os.close(fd)
+                os.replace(temp_path, self.path)
+
+    def _read_rest(self) -> bytes:
+        data = self._file.read()
+        self._offset += len(data)
+        return data
+
+    def read(self) -> List[Dict[str, Any]]:
+        """读取其他进程新追加的变更，没有新变更时只做一次 stat"""
+        with self._read_lock:
+            try:
+                stat = os.stat(self.path)
+            except FileNotFoundError:
+                stat = None
+            if stat is not None and stat.st_ino == self._inode and stat.st_size == self._offset:
+                return []
+
+            data = self._buffer + self._read_rest()
+            if stat is not None and stat.st_ino != self._inode:
+                # 文件已被替换：旧文件剩余部分已读完，从头读取新文件
+                self._file.close()
+                self._open()
+                data += self._read_rest()
+
+            lines = data.split(b'\n')
+            self._buffer = lines.pop()
+            entries = []
+            for line in lines:
+                try:
+                    entry = json_decode(line)
+                except ValueError:
+                    continue
+                if entry.get('pid') != self.pid:
+                    entries.append(entry)
+            return entries
+
+    def close(self) -> None:
+        self._file.close()
+        self._write_lock.close()
+
+
+class ReplicationFeed:
+    """复制变更流（数据目录下的 ``.replication/``）：每次写入或清除后追加一条带递增序号的变更，
+    副本通过 /replication/changes?since= 增量拉取
+
+    - ``feed.log``：每行一条 JSON 变更 ``{"seq", "op": "put" / "delete" / "reset", "config", ...}``，
+      同一配置只有最新一条有效，``reset``（清除全部）之前的变更全部失效；
+      文件超过 max_size 且半数以上的行已失效时只保留有效变更重写
+    - ``state.json``：变更流 ID 和已预留的序号上限。序号按 REPLICATION_SEQ_BLOCK 成批预留并落盘，
+      变更行本身不 fsync：崩溃时丢失的行的序号不会再被分配（重启后从预留上限之后继续编号），
+      副本见过的序号不会指向另一个变更；丢失的变更由启动时的 DataStore.reconcile_feed 补发
+    - 内存中保存每个配置的最新变更和按序号排列的列表，按 since 二分查找；
+      多进程模式下追加和查询前先读入其他工作进程追加的行（没有新行时只做一次 stat）
+
+    变更流 ID 在 ``state.json`` 丢失时重新生成：ID 不一致、since 早于最后一次 reset
+    或晚于最新序号的副本需要完整重新对账。
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        shared: bool = False,
+        max_size: int = REPLICATION_LOG_MAX_SIZE,
+        seq_block: int = REPLICATION_SEQ_BLOCK
+    ):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.path = os.path.join(directory, 'feed.log')
+        self.state_path = os.path.join(directory, 'state.json')
+        self.shared = shared
+        self.max_size = max_size
+        self.seq_block = max(1, seq_block)
+        self._lock = InterProcessLock(os.path.join(directory, 'feed.lock') if shared else None)
+        self.feed_id = ''
+        self.last_seq = 0
+        self.reset_seq = 0
+        self._reserved = 0
+        # 每个配置的最新变更；_log / _seqs 按序号排列，可能包含已被同一配置的新变更取代的条目
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        self._log: List[Dict[str, Any]] = []
+        self._seqs: List[int] = []
+        self._fd: Optional[int] = None
+        self._inode = 0
+        self._offset = 0
+        self._lines = 0
+        with self._lock:
+            if not self._load_state():
+                # 没有可信的序号预留时，旧的变更行不能再用
+                self.feed_id = os.urandom(8).hex()
+                with open(self.path, 'wb'):
+                    pass
+                self._save_state()
+            self._catch_up()
+            # 上次运行预留的序号可能已分配给崩溃时丢失的变更行
+            self._floor = self._reserved + 1
+
+    def _load_state(self) -> bool:
+        try:
+            with open(self.state_path, 'rb') as f:
+                state = json_decode(f.read())
+            self.feed_id, self._reserved = str(state['feed']), int(state['reserved'])
+        except (OSError, ValueError, KeyError, TypeError):
+            return False
+        return bool(self.feed_id)
+
+    def _save_state(self) -> None:
+        atomic_write(self.state_path, json_encode({'feed': self.feed_id, 'reserved': self._reserved}))
+
+    def _open(self) -> None:
+        if self._fd is not None:
+            os.close(self._fd)
+        self._fd = os.open(self.path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o600)
+        self._inode = os.fstat(self._fd).st_ino
+        self._offset = self._lines = 0
+
+    def _catch_up(self) -> None:
+        """读入文件中尚未读取的变更行（调用方持有 _lock）
+
+        文件被其他工作进程重写后从头读取，序号不大于 last_seq 的行都已读过或已失效，直接跳过。
+        """
+        if self._fd is not None and not self.shared:
+            return
         try:
-            with open(data_file, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except (json.JSONDecodeError, IOError):
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            stat = None
+        if self._fd is None or stat is None or stat.st_ino != self._inode:
+            if self._fd is not None:
+                # 重写后的文件里只剩有效变更，内存中被取代的条目也可以丢掉
+                self._trim()
+            self._open()
+            stat = os.fstat(self._fd)
+        if stat.st_size <= self._offset:
+            return
+
+        data = os.pread(self._fd, stat.st_size - self._offset, self._offset)
+        end = data.rfind(b'\n') + 1
+        if end < len(data):
+            # 只有崩溃才会留下写了一半的行（写入都在锁内一次完成），截掉后再追加
+            os.ftruncate(self._fd, self._offset + end)
+            data = data[:end]
+        self._offset += end
+        for line in data.splitlines():
+            self._lines += 1
+            try:
+                self._apply(json_decode(line))
+            except (ValueError, KeyError, TypeError):
+                continue
+
+    def _apply(self, entry: Dict[str, Any]) -> None:
+        seq = entry['seq']
+        if seq <= self.last_seq:
+            return
+        self.last_seq = seq
+        if entry['op'] == 'reset':
+            self.reset_seq = seq
+            self._entries.clear()
+            self._log.clear()
+            self._seqs.clear()
+            return
+        self._entries[entry['config']] = entry
+        self._log.append(entry)
+        self._seqs.append(seq)
+
+    def append(self, change: Dict[str, Any]) -> int:
+        """追加一条变更（``op`` / ``config`` 等字段，不含序号），返回分配的序号"""
+        with self._lock:
+            self._catch_up()
+            seq = max(self.last_seq + 1, self._floor)
+            if seq > self._reserved:
+                if self.shared:
+                    # 其他工作进程可能已经预留到更后面
+                    self._load_state()
+                if seq > self._reserved:
+                    self._reserved = seq + self.seq_block - 1
+                    self._save_state()
+            entry = {'seq': seq, **change}
+            line = json_encode(entry) + b'\n'
+            os.write(self._fd, line)
+            self._offset += len(line)
+            self._lines += 1
+            self._apply(entry)
+            if self._offset > self.max_size and self._lines > 2 * (len(self._entries) + 1):
+                self._compact()
+            return seq
+
+    def _trim(self) -> None:
+        """从按序号排列的列表中去掉已被取代的条目"""
+        self._log = [entry for entry in self._log if self._entries.get(entry['config']) is entry]
+        self._seqs = [entry['seq'] for entry in self._log]
+
+    def _compact(self) -> None:
+        """只保留最后一次 reset 和每个配置的最新变更，原子地重写文件（调用方持有 _lock）"""
+        self._trim()
+        lines = [json_encode({'seq': self.reset_seq, 'op': 'reset'}) + b'\n'] if self.reset_seq else []
+        lines += [json_encode(entry) + b'\n' for entry in self._log]
+        content = b''.join(lines)
+        atomic_write(self.path, content)
+        self._open()
+        self._offset, self._lines = len(content), len(lines)
+
+    def latest(self, config_name: str) -> Optional[Dict[str, Any]]:
+        """指定配置的最新变更"""
+        with self._lock:
+            self._catch_up()
+            return self._entries.get(config_name)
+
+    def live_configs(self) -> List[str]:
+        """最新变更为上传（尚未被清除）的配置"""
+        with self._lock:
+            self._catch_up()
+            return [name for name, entry in self._entries.items() if entry['op'] == 'put']
+
+    def changes(self, since: int, feed_id: Optional[str] = None, limit: int = REPLICATION_PAGE_SIZE) -> Dict[str, Any]:
+        """序号大于 since 的变更（每个配置只返回最新一条），最多 limit 条
+
+        ``feed_id`` 与本变更流不一致、since 早于最后一次 reset 或晚于最新序号时返回 ``reset: true``
+        和从头开始的全部有效变更，副本应完整对账。``next`` 是下一次请求的 since，
+        ``more`` 表示是否还有未返回的变更。
+        """
+        with self._lock:
+            self._catch_up()
+            reset = feed_id != self.feed_id or since < self.reset_seq or since > self.last_seq
+            if reset:
+                since = self.reset_seq
+            changes = []
+            next_seq = self.last_seq
+            for i in range(bisect.bisect_right(self._seqs, since), len(self._log)):
+                entry = self._log[i]
+                if self._entries.get(entry['config']) is not entry:
+                    continue
+                changes.append(entry)
+                if len(changes) >= limit:
+                    next_seq = entry['seq']
+                    break
             return {
-                'config_name': config_name,
-                'encrypted_data': None,
-                'last_updated': None,
-                'device_info': {}
+                'feed': self.feed_id,
+                'reset': reset,
+                'last_seq': self.last_seq,
+                'next': next_seq,
+                'more': next_seq < self.last_seq,
+                'changes': changes,
             }
 
-    def save_data(self, config_name: str, data: Dict[str, Any]) -> None:
-        """保存数据到文件"""
-        data_file = self.get_config_file(config_name)
-        data['last_updated'] = datetime.now().isoformat()
-        data['config_name'] = config_name
+    def close(self) -> None:
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        self._lock.close()
+
+
+def feed_change(config_name: Optional[str], data: Optional[Dict[str, Any]] = None, device_id: Optional[str] = None) -> Dict[str, Any]:
+    """复制变更流中的一条变更：上传了新版本（data 为保存后的配置记录）、清除单个配置，或清除全部（config_name 为 None）"""
+    if config_name is None:
+        return {'op': 'reset'}
+    if data is None:
+        return {'op': 'delete', 'config': config_name}
+    return {
+        'op': 'put',
+        'config': config_name,
+        'version': data['version'],
+        'hash': data['hash'],
+        'etag': data['etag'],
+        'size': data['size'],
+        'last_updated': data['last_updated'],
+        'device_id': device_id,
+        'device_info': data.get('device_info', {}),
+    }
+
+
+def etag_matches(header_value: Optional[str], etag: Optional[str], weak: bool = False) -> bool:
+    """判断 If-Match / If-None-Match 请求头是否命中当前 ETag
+
+    If-None-Match 使用弱比较（忽略 ``W/`` 前缀），If-Match 使用强比较。
+    """
+    if not header_value or not etag:
+        return False
+
+    for candidate in header_value.split(','):
+        candidate = candidate.strip()
+        if candidate == '*':
+            return True
+        if weak and candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+
+def validate_config_name(config_name: str) -> None:
+    """校验配置名称：只允许字母、数字、下划线、连字符"""
+    if not re.match(r'^[a-zA-Z0-9_-]+$', config_name):
+        raise ValueError(f"Invalid config name: {config_name}")
+
+
+def empty_config(config_name: str) -> Dict[str, Any]:
+    """尚未上传过数据的配置"""
+    return {
+        'config_name': config_name,
+        'last_updated': None,
+        'device_info': {}
+    }
+
+
+def update_timestamp(data: Dict[str, Any]) -> str:
+    """保存配置记录时的更新时间：副本应用主服务器的变更时沿用主服务器的时间（``data['upstream_updated']``）"""
+    return data.pop('upstream_updated', None) or datetime.now().isoformat()
+
+
+def display_backup_info(backup: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """用于展示的备份摘要（校验和只保留前 16 位）"""
+    backup_info = dict(backup or {})
+    if backup_info.get('checksum'):
+        backup_info['checksum'] = backup_info['checksum'][:16] + '...'
+    return backup_info
+
+
+def metadata_from_config(config_name: str, data: Dict[str, Any]) -> Dict[str, Any]:
+    """从配置记录中提取 /status 所需的元数据
+
+    ``hash`` / ``encoding`` / ``size`` 指向当前版本的备份内容，
+    ``hashes`` 是所有保留版本引用的备份，供垃圾回收判断引用关系。
+    """
+    versions = data.get('versions', [])
+    return {
+        'name': config_name,
+        'last_updated': data.get('last_updated'),
+        'has_data': data.get('etag') is not None,
+        'devices': list(data.get('device_info', {}).keys()),
+        'backup': display_backup_info(data.get('backup')),
+        'size': data.get('size', 0),
+        'etag': data.get('etag'),
+        'hash': data.get('hash'),
+        'version': data.get('version'),
+        'version_count': len(versions),
+        'encoding': data.get('encoding', 'identity'),
+        'stored_size': data.get('stored_size', data.get('size', 0)),
+        'hashes': [h for v in versions for h in version_blob_hashes(v)],
+    }
+
+
+def version_blob_hashes(record: Dict[str, Any]) -> List[str]:
+    """版本引用的备份：分块存储的版本引用各个数据块，否则引用整体备份"""
+    if record.get('chunks'):
+        return [chunk[0] for chunk in record['chunks']]
+    return [record['hash']]
+
+
+def version_summary(record: Dict[str, Any]) -> Dict[str, Any]:
+    """版本列表中展示的版本信息"""
+    return {
+        'version': record['version'],
+        'etag': record['etag'],
+        'size': record['size'],
+        'stored_at': record['stored_at'],
+        'device_id': record.get('device_id'),
+        'backup': display_backup_info(record.get('backup')),
+    }
+
+
+def normalize_timestamp(value: str) -> str:
+    """把 ISO 8601 时间转换为与 last_updated 相同格式（本地时间、无时区）的字符串，便于直接比较"""
+    moment = datetime.fromisoformat(value)
+    if moment.tzinfo is not None:
+        moment = moment.astimezone().replace(tzinfo=None)
+    return moment.isoformat()
+
+
+class MetadataQuery:
+    """/status 的查询条件：排序方式、游标位置和过滤条件
+
+    - ``sort`` 为 ``name`` / ``last_updated``，加 ``-`` 前缀表示倒序
+    - 游标记录上一页最后一个配置的排序键（配置名，或 (最后更新时间, 配置名)），
+      按键集分页：翻页期间有配置写入或删除，其余配置既不会重复也不会遗漏
+    - ``principal`` 为受限的令牌用户时只列出其可访问的配置
+    """
+
+    SORTS = ('name', '-name', 'last_updated', '-last_updated')
+
+    __slots__ = ('field', 'descending', 'after', 'updated_since', 'has_data', 'device', 'principal')
+
+    def __init__(
+        self,
+        sort: str = 'name',
+        cursor: Optional[str] = None,
+        updated_since: Optional[str] = None,
+        has_data: Optional[bool] = None,
+        device: Optional[str] = None,
+        principal: Optional['TokenPrincipal'] = None
+    ):
+        if sort not in self.SORTS:
+            raise ValueError(f'sort must be one of: {", ".join(self.SORTS)}')
+        self.descending = sort.startswith('-')
+        self.field = sort.lstrip('-')
+        self.after = self._decode_cursor(cursor) if cursor else None
+        try:
+            self.updated_since = normalize_timestamp(updated_since) if updated_since else None
+        except ValueError:
+            raise ValueError('updated_since must be an ISO 8601 timestamp')
+        self.has_data = has_data
+        self.device = device
+        self.principal = principal if principal is not None and not principal.all_configs else None
+
+    def sort_key(self, metadata: Dict[str, Any]) -> Any:
+        """配置在当前排序方式下的排序键"""
+        if self.field == 'name':
+            return metadata['name']
+        return metadata.get('last_updated') or '', metadata['name']
+
+    def matches(self, metadata: Dict[str, Any]) -> bool:
+        """配置是否满足过滤条件"""
+        if self.has_data is not None and bool(metadata.get('has_data')) != self.has_data:
+            return False
+        if self.updated_since is not None and (metadata.get('last_updated') or '') < self.updated_since:
+            return False
+        if self.device is not None and self.device not in metadata.get('devices', ()):
+            return False
+        if self.principal is not None and not self.principal.allows(metadata['name']):
+            return False
+        return True
+
+    def cursor_for(self, metadata: Dict[str, Any]) -> str:
+        """生成从该配置之后继续的游标"""
+        payload = json_encode([self.field, self.sort_key(metadata)])
+        return base64.urlsafe_b64encode(payload).decode('ascii').rstrip('=')
+
+    def _decode_cursor(self, cursor: str) -> Any:
+        try:
+            field, key = json_decode(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        except Exception:
+            raise ValueError('Invalid cursor')
+        if field != self.field:
+            raise ValueError('Cursor does not match the sort order')
+        if field == 'name' and isinstance(key, str):
+            return key
+        if field == 'last_updated' and isinstance(key, list) and len(key) == 2 and all(isinstance(k, str) for k in key):
+            return tuple(key)
+        raise ValueError('Invalid cursor')
+
+
+# 监控指标
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = '') -> str:
+    """按 Prometheus 文本格式拼接标签"""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"')
+        pairs.append(f'{name}="{value}"')
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    """按标签累加的计数器"""
+
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, *labels: str) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f'{self.name}{format_labels(self.labelnames, labels)} {value}' for labels, value in items]
+
+
+class Gauge:
+    """抓取时通过回调计算的瞬时值"""
+
+    kind = 'gauge'
+
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self.value: float = 0
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def samples(self) -> List[str]:
+        return [f'{self.name} {self.value}']
+
+
+class Histogram:
+    """按标签分组的直方图，只保存各分桶计数、总和与次数"""
+
+    kind = 'histogram'
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Tuple[str, ...] = (),
+        buckets: Tuple[float, ...] = LATENCY_BUCKETS
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        # 标签 -> [各分桶计数..., 总和, 次数]
+        self._values: Dict[Tuple[str, ...], List[float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels: str) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                state = self._values[labels] = [0] * (len(self.buckets) + 2)
+            if index < len(self.buckets):
+                state[index] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            items = sorted((labels, list(state)) for labels, state in self._values.items())
+
+        lines = []
+        for labels, state in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, state):
+                cumulative += count
+                le = format_labels(self.labelnames, labels, f'le="{bound}"')
+                lines.append(f'{self.name}_bucket{le} {cumulative}')
+            le = format_labels(self.labelnames, labels, 'le="+Inf"')
+            lines.append(f'{self.name}_bucket{le} {state[-1]}')
+            lines.append(f'{self.name}_sum{format_labels(self.labelnames, labels)} {state[-2]}')
+            lines.append(f'{self.name}_count{format_labels(self.labelnames, labels)} {state[-1]}')
+        return lines
+
+
+class MetricsRegistry:
+    """指标注册表，按 Prometheus 文本格式输出"""
+
+    def __init__(self):
+        self._metrics: List[Any] = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+metrics = MetricsRegistry()
+HTTP_REQUESTS = metrics.register(Counter(
+    'vaultsafe_http_requests_total', 'HTTP requests by route, method and status code',
+    ('route', 'method', 'status')
+))
+HTTP_LATENCY = metrics.register(Histogram(
+    'vaultsafe_http_request_duration_seconds', 'HTTP request latency by route, method and status code',
+    ('route', 'method', 'status')
+))
+HTTP_BYTES_IN = metrics.register(Counter(
+    'vaultsafe_http_request_bytes_total', 'HTTP request body bytes received (as sent on the wire)',
+    ('route',)
+))
+HTTP_BYTES_OUT = metrics.register(Counter(
+    'vaultsafe_http_response_bytes_total', 'HTTP response body bytes sent (as sent on the wire)',
+    ('route',)
+))
+STORAGE_LATENCY = metrics.register(Histogram(
+    'vaultsafe_storage_operation_duration_seconds', 'DataStore operation latency (including thread pool queueing)',
+    ('backend', 'operation')
+))
+LOCK_WAIT = metrics.register(Histogram(
+    'vaultsafe_config_lock_wait_seconds', 'Time spent waiting for a per-config write lock'
+))
+CONFIGS_TOTAL = metrics.register(Gauge('vaultsafe_configs', 'Number of stored configs'))
+STORED_BYTES = metrics.register(Gauge('vaultsafe_stored_bytes', 'Stored bytes of the current backup of all configs'))
+CHANGE_SUBSCRIBERS = metrics.register(Gauge('vaultsafe_change_subscribers', 'Open SSE and long-poll connections'))
+CACHE_HITS = metrics.register(Counter(
+    'vaultsafe_response_cache_hits_total', 'Backup downloads served from the in-memory response cache'
+))
+CACHE_MISSES = metrics.register(Counter(
+    'vaultsafe_response_cache_misses_total', 'Cacheable backup downloads that had to read storage'
+))
+CACHE_EVICTIONS = metrics.register(Counter(
+    'vaultsafe_response_cache_evictions_total', 'Entries evicted from the response cache to stay within its memory cap'
+))
+CACHE_BYTES = metrics.register(Gauge('vaultsafe_response_cache_bytes', 'Bytes held by the response cache'))
+REQUESTS_REJECTED = metrics.register(Counter(
+    'vaultsafe_requests_rejected_total', 'Requests rejected before reading the body, by reason',
+    ('reason',)
+))
+JOURNAL_COMMITS = metrics.register(Counter('vaultsafe_journal_commits_total', 'Journal writes committed'))
+JOURNAL_FSYNCS = metrics.register(Counter('vaultsafe_journal_fsyncs_total', 'Journal fsync calls (group commits)'))
+JOURNAL_COMPACTIONS = metrics.register(Counter('vaultsafe_journal_compactions_total', 'Journal segments compacted'))
+PURGED_BYTES = metrics.register(Counter('vaultsafe_purged_bytes_total', 'Bytes of cleared data deleted in the background'))
+SCRUB_CHECKS = metrics.register(Counter(
+    'vaultsafe_scrub_checks_total', 'Backups verified by the integrity scrubber', ('result',)
+))
+SCRUB_BYTES = metrics.register(Counter('vaultsafe_scrub_bytes_total', 'Stored bytes read by the integrity scrubber'))
+CORRUPT_CONFIGS = metrics.register(Gauge(
+    'vaultsafe_corrupt_configs', 'Configs whose current backup failed verification in the last complete scrub pass'
+))
+REPLICATION_SEQ = metrics.register(Gauge('vaultsafe_replication_seq', 'Latest sequence number of the replication change feed'))
+REPLICATION_APPLIED = metrics.register(Counter(
+    'vaultsafe_replication_applied_total', 'Changes applied by this replica, by operation', ('op',)
+))
+REPLICATION_LAG = metrics.register(Gauge(
+    'vaultsafe_replication_lag', 'Changes in the primary feed not yet applied by this replica'
+))
+
+
+class MetricsMiddleware:
+    """ASGI 中间件：记录每个请求的路由、状态码、耗时和收发字节数
+
+    路由标签取自匹配到的路由模板（如 ``/sync/{config_name}``），避免配置名进入标签。
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        bytes_in = 0
+        bytes_out = 0
+        status_code = 500
+
+        async def counting_receive():
+            nonlocal bytes_in
+            message = await receive()
+            if message['type'] == 'http.request':
+                bytes_in += len(message.get('body', b''))
+            return message
+
+        async def counting_send(message):
+            nonlocal bytes_out, status_code
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+            elif message['type'] == 'http.response.body':
+                bytes_out += len(message.get('body', b''))
+            await send(message)
+
+        try:
+            await self.app(scope, counting_receive, counting_send)
+        finally:
+            route = scope.get('route')
+            route_label = getattr(route, 'path', 'unmatched')
+            labels = (route_label, scope['method'], str(status_code))
+            HTTP_REQUESTS.inc(1, *labels)
+            HTTP_LATENCY.observe(time.perf_counter() - start, *labels)
+            HTTP_BYTES_IN.inc(bytes_in, route_label)
+            HTTP_BYTES_OUT.inc(bytes_out, route_label)
+
+
+# 结构化日志
+logger = logging.getLogger('vaultsafe.sync')
+
+
+class JSONLinesFormatter(logging.Formatter):
+    """每条日志输出为一行 JSON，附加字段通过 ``extra={'fields': {...}}`` 传入"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        entry.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exc'] = record.exc_text
+        return json_encode(entry, default=str).decode('utf-8')
+
+
+class SamplingFilter(logging.Filter):
+    """按比例采样标记为 ``sampled`` 的请求日志，警告及以上级别始终保留"""
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING or not getattr(record, 'sampled', False):
+            return True
+        return self.rate >= 1 or random.random() < self.rate
+
+
+def setup_logging(level: str = LOG_LEVEL, sample_rate: float = LOG_SAMPLE_RATE) -> QueueListener:
+    """配置结构化日志（JSON Lines 输出到 stdout），返回尚未启动的 QueueListener
+
+    在启动监听器之前（例如导入时初始化存储），日志在调用线程中直接写出；
+    服务运行期间由 start_log_listener 切换为队列日志。
+    """
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(JSONLinesFormatter())
+
+    logger.handlers = [stream_handler]
+    logger.filters = [SamplingFilter(sample_rate)]
+    logger.setLevel(level.upper())
+    logger.propagate = False
+
+    log_queue: 'queue.SimpleQueue[logging.LogRecord]' = queue.SimpleQueue()
+    return QueueListener(log_queue, stream_handler)
+
+
+def start_log_listener(listener: QueueListener) -> None:
+    """切换为队列日志：请求处理中只把记录放入队列，格式化和写 stdout 在后台线程完成"""
+    listener.start()
+    logger.handlers = [QueueHandler(listener.queue)]
+
+
+def stop_log_listener(listener: QueueListener) -> None:
+    """恢复为直接写出，并刷新队列中剩余的日志"""
+    logger.handlers = list(listener.handlers)
+    listener.stop()
+
+
+# 在创建数据存储之前配置日志，初始化过程中的警告同样输出为结构化日志
+log_listener = setup_logging(LOG_LEVEL, LOG_SAMPLE_RATE)
+
+
+def log_event(level: int, message: str, sampled: bool = False, **fields: Any) -> None:
+    """记录一条结构化日志；未启用对应级别时不做任何处理"""
+    if logger.isEnabledFor(level):
+        logger.log(level, message, extra={'fields': fields, 'sampled': sampled})
+
+
+class ResponseCache:
+    """热点备份的响应体缓存：按 (配置, 版本, 表示) 缓存序列化后的字节，LRU 淘汰，总字节数不超过 max_bytes
+
+    - 表示为落盘编码（原样返回压缩内容时）或 ``identity``（解压后的内容）
+    - 超过 max_entry_size 的备份不缓存，避免一个大备份挤掉所有热点配置
+    - 条目同时记录 ETag，不一致视为未命中：清除后重新上传时版本号会从 1 重新开始
+    - 写入和清除时按配置失效，释放旧版本占用的内存
+    """
+
+    def __init__(self, max_bytes: int, max_entry_size: Optional[int] = None):
+        self.max_bytes = max(0, int(max_bytes))
+        self.max_entry_size = self.max_bytes // 4 if max_entry_size is None else max_entry_size
+        self._entries: 'OrderedDict[Tuple[str, int, str], Tuple[str, bytes]]' = OrderedDict()
+        self._by_config: Dict[str, set] = {}
+        self._size = 0
+        self._lock = threading.Lock()
+        # 同一条目同时未命中时只读取一次存储（只在事件循环中访问）
+        self._loading: Dict[Tuple[str, int, str, str], asyncio.Future] = {}
+
+    def cacheable(self, size: int) -> bool:
+        """指定大小的响应体是否会被缓存"""
+        return 0 < size <= self.max_entry_size
+
+    def get(self, config_name: str, version: int, representation: str, etag: str) -> Optional[bytes]:
+        """查找缓存的响应体，并记录命中/未命中"""
+        key = (config_name, version, representation)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == etag:
+                self._entries.move_to_end(key)
+                CACHE_HITS.inc()
+                return entry[1]
+        CACHE_MISSES.inc()
+        return None
+
+    def put(self, config_name: str, version: int, representation: str, etag: str, body: bytes) -> None:
+        """缓存响应体，超出内存上限时从最久未使用的条目开始淘汰"""
+        if not self.cacheable(len(body)):
+            return
+        key = (config_name, version, representation)
+        with self._lock:
+            self._discard(key)
+            self._entries[key] = (etag, body)
+            self._by_config.setdefault(config_name, set()).add(key)
+            self._size += len(body)
+            while self._size > self.max_bytes:
+                self._discard(next(iter(self._entries)))
+                CACHE_EVICTIONS.inc()
+            CACHE_BYTES.set(self._size)
+
+    def _discard(self, key: Tuple[str, int, str]) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self._size -= len(entry[1])
+        keys = self._by_config.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_config[key[0]]
+
+    def invalidate(self, config_name: Optional[str] = None) -> None:
+        """丢弃指定配置（None 表示全部）的缓存条目"""
+        with self._lock:
+            if config_name is None:
+                self._entries.clear()
+                self._by_config.clear()
+                self._size = 0
+            else:
+                for key in list(self._by_config.get(config_name, ())):
+                    self._discard(key)
+            CACHE_BYTES.set(self._size)
+
+    async def fetch(self, config_name: str, version: int, representation: str, etag: str, load) -> bytes:
+        """返回缓存的响应体；未命中时调用 ``await load()`` 读取并缓存，并发的相同请求共享一次读取"""
+        body = self.get(config_name, version, representation, etag)
+        if body is not None:
+            return body
+
+        # 读取在独立的任务中进行：先到的请求断开也不影响共享同一次读取的其他请求
+        loading_key = (config_name, version, representation, etag)
+        task = self._loading.get(loading_key)
+        if task is None:
+            task = asyncio.ensure_future(load())
+            self._loading[loading_key] = task
+            task.add_done_callback(lambda done: self._loaded(loading_key, done))
+        return await asyncio.shield(task)
+
+    def _loaded(self, loading_key: Tuple[str, int, str, str], task: asyncio.Future) -> None:
+        self._loading.pop(loading_key, None)
+        # 调用 exception() 同时避免 "exception was never retrieved" 警告
+        if not task.cancelled() and task.exception() is None:
+            self.put(*loading_key, task.result())
+
+
+# 数据存储类
+class MetadataIndex:
+    """内存中的配置元数据索引：配置名 -> 元数据
+
+    另外按配置名、按 (最后更新时间, 配置名) 维护排好序的键，随写入增量更新，
+    /status 分页时二分定位游标，不需要每次排序。所有方法都是线程安全的。
+    """
+
+    def __init__(self):
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        self._by_name: List[str] = []
+        self._by_updated: List[Tuple[str, str]] = []
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def _updated_key(metadata: Dict[str, Any]) -> Tuple[str, str]:
+        return metadata.get('last_updated') or '', metadata['name']
+
+    @staticmethod
+    def _remove_sorted(keys: List[Any], key: Any) -> None:
+        i = bisect.bisect_left(keys, key)
+        if i < len(keys) and keys[i] == key:
+            del keys[i]
+
+    def get(self, config_name: str) -> Optional[Dict[str, Any]]:
+        return self._entries.get(config_name)
+
+    def set(self, config_name: str, metadata: Dict[str, Any]) -> None:
+        """写入或替换一个配置的元数据"""
+        with self._lock:
+            previous = self._entries.get(config_name)
+            if previous is None:
+                bisect.insort(self._by_name, config_name)
+            else:
+                self._remove_sorted(self._by_updated, self._updated_key(previous))
+            self._entries[config_name] = metadata
+            bisect.insort(self._by_updated, self._updated_key(metadata))
+
+    def remove(self, config_name: str) -> None:
+        """移除一个配置（不存在时无操作）"""
+        with self._lock:
+            previous = self._entries.pop(config_name, None)
+            if previous is not None:
+                self._remove_sorted(self._by_name, config_name)
+                self._remove_sorted(self._by_updated, self._updated_key(previous))
+
+    def annotate(self, config_name: str, version: int, fields: Dict[str, Any]) -> bool:
+        """为当前版本仍是 version 的配置补充字段（不影响排序）；配置已被覆盖或清除时不修改"""
+        with self._lock:
+            metadata = self._entries.get(config_name)
+            if metadata is None or metadata.get('version') != version:
+                return False
+            # 复制后替换，已经返回给调用方的元数据不会被修改
+            self._entries[config_name] = {**metadata, **fields}
+            return True
+
+    def replace(self, entries: Dict[str, Dict[str, Any]]) -> None:
+        """整体替换索引内容（启动时构建、全部清除时清空）"""
+        by_name = sorted(entries)
+        by_updated = sorted(self._updated_key(metadata) for metadata in entries.values())
+        with self._lock:
+            self._entries = entries
+            self._by_name = by_name
+            self._by_updated = by_updated
+
+    def page(self, query: MetadataQuery, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        """在排好序的键上二分定位游标，向后扫描并过滤，取到 limit 个为止"""
+        with self._lock:
+            keys = self._by_name if query.field == 'name' else self._by_updated
+            if query.descending:
+                end = bisect.bisect_left(keys, query.after) if query.after is not None else len(keys)
+                positions = range(end - 1, -1, -1)
+            else:
+                start = bisect.bisect_right(keys, query.after) if query.after is not None else 0
+                positions = range(start, len(keys))
+
+            result = []
+            for i in positions:
+                key = keys[i]
+                metadata = self._entries[key if query.field == 'name' else key[1]]
+                if query.matches(metadata):
+                    result.append(metadata)
+                    if limit is not None and len(result) >= limit:
+                        break
+            return result
+
+    def stats(self) -> Tuple[int, int]:
+        """(配置数量, 所有配置当前版本的落盘字节数)"""
+        with self._lock:
+            return len(self._entries), sum(m.get('stored_size', 0) for m in self._entries.values())
+
+    def referenced_hashes(self) -> Optional[set]:
+        """所有配置保留版本引用的备份哈希；有配置无法读取时返回 None"""
+        with self._lock:
+            referenced = set()
+            for metadata in self._entries.values():
+                if 'error' in metadata:
+                    return None
+                referenced.update(metadata['hashes'])
+        return referenced
+
+
+class DataStore(ABC):
+    """数据存储接口
+
+    子类负责具体的持久化方式（见 FileDataStore / SQLiteDataStore / JournalDataStore）。
+    备份内容按 SHA-256 内容寻址存放，相同内容只保存一份；每个配置保留最近
+    ``max_versions`` 个版本，不再被任何版本引用的备份由后台垃圾回收逐步清理。
+
+    同步方法直接读写存储；带 ``_async`` 后缀的方法把同一操作放到有界线程池中执行，
+    供异步路由调用，避免阻塞事件循环。
+
+    ``shared=True`` 时数据目录由多个工作进程共享：配置写锁同时持有 ``.locks/`` 下的文件锁，
+    写入和清除记录到共享变更日志，各进程据此失效本地缓存并推送变更通知。
+    """
+
+    backend = ''
+    # 流式上传的临时文件是否需要 fsync（直接改名为备份文件时需要）
+    stage_durable = True
+
+    def __init__(
+        self,
+        data_dir: str,
+        max_workers: int = STORAGE_WORKERS,
+        compression: str = STORAGE_COMPRESSION,
+        max_versions: int = MAX_VERSIONS,
+        shared: bool = False,
+        cache_size: int = int(CACHE_MAX_MB * 1024 * 1024)
+    ):
+        if compression not in supported_encodings():
+            raise ValueError(f"Unsupported storage compression: {compression}")
+
+        self.data_dir = data_dir
+        self.compression = compression
+        self.max_versions = max(1, max_versions)
+        os.makedirs(data_dir, exist_ok=True)
+        # 每个配置一把异步写锁，不再使用时自动回收
+        self._config_locks: 'weakref.WeakValueDictionary[str, asyncio.Lock]' = weakref.WeakValueDictionary()
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers,
+            thread_name_prefix='datastore'
+        )
+        # 热点备份的响应体缓存，写入和清除时按配置失效
+        self.cache = ResponseCache(cache_size)
+        # 整体备份按内容寻址、不再修改，切分结果可以按哈希缓存
+        self._chunk_cache: 'OrderedDict[str, List[List[Any]]]' = OrderedDict()
+        self._chunk_cache_lock = threading.Lock()
+
+        # 多进程协调：文件锁目录和共享变更日志
+        self.lock_dir: Optional[str] = None
+        self.changelog: Optional[ChangeLog] = None
+        self._pending_changes: List[Dict[str, Any]] = []
+        self._pending_lock = threading.Lock()
+        self._gc_lock_fd: Optional[int] = None
+        # 清除的数据先原子地移入回收目录（SQLite 为回收表），由后台任务限速删除
+        self.trash_dir = os.path.join(data_dir, '.trash')
+        self._purge_wakeup = asyncio.Event()
+        if shared:
+            self.lock_dir = os.path.join(data_dir, '.locks')
+            os.makedirs(self.lock_dir, exist_ok=True)
+            self.changelog = ChangeLog(os.path.join(data_dir, '.changelog'))
+        # 写入与清除全部数据之间的屏障，见 locked / clear_all_async
+        self.barrier = StoreBarrier(self.lock_path('store'))
+        # 复制变更流：每次写入和清除都追加一条带序号的变更，副本据此增量同步
+        self.feed = ReplicationFeed(os.path.join(data_dir, '.replication'), shared)
+        self._feed_updated = asyncio.Event()
+
+    def lock_path(self, name: str) -> Optional[str]:
+        """多进程模式下指定文件锁的路径，单进程模式返回 None"""
+        return os.path.join(self.lock_dir, f'{name}.lock') if self.lock_dir else None
+
+    def sync_changes(self) -> None:
+        """读取其他工作进程的变更并失效本地缓存（单进程模式下什么也不做）
+
+        读到的变更暂存起来，由 poll_changes_async 交给变更通知。
+        """
+        if self.changelog is None:
+            return
+        entries = self.changelog.read()
+        if not entries:
+            return
+        for entry in entries:
+            self.cache.invalidate(entry.get('config'))
+            self._invalidate(entry.get('config'))
+        with self._pending_lock:
+            self._pending_changes.extend(entries)
+
+    async def poll_changes_async(self) -> List[Dict[str, Any]]:
+        """取出其他工作进程的变更：``{'config': 配置名（全部清除时为 None）, 'device_id': ...}``
+
+        读取变更日志在存储线程池中执行；有变更时同时唤醒等待复制变更流的请求。
+        """
+        await self._run_io(self.sync_changes)
+        with self._pending_lock:
+            entries, self._pending_changes = self._pending_changes, []
+        if entries:
+            self._notify_feed()
+        return entries
+
+    def _invalidate(self, config_name: Optional[str]) -> None:
+        """其他工作进程修改了配置（None 表示全部清除），丢弃本进程缓存的相关数据"""
+
+    def lock(self, config_name: str) -> asyncio.Lock:
+        """获取指定配置的写锁，读-改-写流程需在锁内完成"""
+        lock = self._config_locks.get(config_name)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._config_locks[config_name] = lock
+        return lock
+
+    def stage_blob(self, content_encoding: str = 'identity', max_size: int = MAX_DECOMPRESSED_SIZE) -> StagedBlob:
+        """创建流式写入的备份临时文件，写完后传给 save_data(staged=...) 或 store_chunk"""
+        return StagedBlob(self.data_dir, self.compression, max_size, content_encoding, self.stage_durable)
+
+    def _store_blob(self, staged: StagedBlob) -> Tuple[str, int]:
+        """保存写完的临时文件，返回 (编码, 落盘大小)；内容已存在时只刷新其回收时间"""
+        existing = self._touch_blob(staged.hash)
+        if existing is not None:
+            return existing
+        self._put_blob(staged)
+        return staged.encoding, staged.stored_size
+
+    def _new_version(
+        self,
+        data: Dict[str, Any],
+        device_id: Optional[str],
+        blob: Optional[bytes] = None,
+        staged: Optional[StagedBlob] = None,
+        manifest: Optional[Dict[str, Any]] = None
+    ) -> Dict[str, Any]:
+        """保存备份内容并生成新版本记录，同时把当前版本信息写入 data
+
+        备份来自内存中的 blob、已写完的 staged 临时文件，或由 resolve_manifest 校验过的分块清单。
+        内容已存在时只刷新其回收时间，不重复压缩和写入。
+        """
+        chunks = None
+        if manifest is not None:
+            # 清单在配置锁之外校验，之后可能执行过清除全部数据，数据块已被移走
+            missing = [h for h in dict.fromkeys(chunk[0] for chunk in manifest['chunks']) if self.find_blob(h) is None]
+            if missing:
+                raise MissingChunksError(missing)
+            blob_hash, size, backup = manifest['hash'], manifest['size'], manifest['backup']
+            encoding, stored_size, chunks = CHUNKED_ENCODING, manifest['stored_size'], manifest['chunks']
+        elif staged is not None:
+            blob_hash, size, backup = staged.hash, staged.size, staged.backup
+            encoding, stored_size = self._store_blob(staged)
+        else:
+            blob_hash, size, backup = hashlib.sha256(blob).hexdigest(), len(blob), summarize_backup(blob)
+            existing = self._touch_blob(blob_hash)
+            if existing is not None:
+                encoding, stored_size = existing
+            else:
+                # 只在保存时压缩一次，下载时可原样返回压缩后的内容
+                staged = self.stage_blob()
+                try:
+                    staged.write(blob)
+                    staged.finish()
+                    self._put_blob(staged)
+                finally:
+                    staged.discard()
+                encoding, stored_size = staged.encoding, staged.stored_size
+
+        record = {
+            'version': (data.get('version') or 0) + 1,
+            'hash': blob_hash,
+            'etag': compute_etag(blob_hash),
+            'size': size,
+            'stored_size': stored_size,
+            'encoding': encoding,
+            'backup': backup,
+            'stored_at': data['last_updated'],
+            'device_id': device_id,
+        }
+        if chunks is not None:
+            record['chunks'] = chunks
+        for key in ('version', 'hash', 'etag', 'size', 'stored_size', 'encoding', 'backup'):
+            data[key] = record[key]
+        return record
+
+    def _append_version(
+        self,
+        data: Dict[str, Any],
+        device_id: Optional[str],
+        staged: Optional[StagedBlob] = None,
+        manifest: Optional[Dict[str, Any]] = None
+    ) -> None:
+        """``manifest`` / ``staged`` / ``data['encrypted_data']`` 若存在，追加为新版本，
+        超出保留数量的旧版本从列表中移除"""
+        encrypted_data = data.pop('encrypted_data', None)
+        if manifest is not None or staged is not None or encrypted_data is not None:
+            blob = backup_bytes(encrypted_data) if encrypted_data is not None else None
+            versions = data.setdefault('versions', [])
+            versions.append(self._new_version(data, device_id, blob=blob, staged=staged, manifest=manifest))
+            del versions[:-self.max_versions]
+
+    @abstractmethod
+    def _touch_blob(self, blob_hash: str) -> Optional[Tuple[str, int]]:
+        """备份内容已存在时刷新其回收时间，返回 (编码, 落盘大小)；不存在返回 None"""
+
+    @abstractmethod
+    def _put_blob(self, staged: StagedBlob) -> None:
+        """把写完的临时文件存为按内容寻址的备份"""
+
+    @abstractmethod
+    def find_blob(self, blob_hash: str) -> Optional[Tuple[str, int]]:
+        """查找按内容寻址的备份或数据块，返回 (编码, 落盘大小)；不存在返回 None"""
+
+    @abstractmethod
+    def open_blob(self, blob_hash: str, encoding: str) -> Tuple[BinaryIO, int]:
+        """打开落盘的（可能已压缩的）备份内容，返回文件对象和大小"""
+
+    def load_blob(self, blob_hash: str, encoding: str, size: int) -> bytes:
+        """读取并解压完整的备份内容（大备份应使用 open_blob 流式读取）"""
+        f, _ = self.open_blob(blob_hash, encoding)
+        with f:
+            stored = f.read()
+        return decompress_content(stored, encoding, max(size, 1))
+
+    def load_stored_blob(self, blob_hash: str, encoding: str) -> bytes:
+        """读取落盘的（可能已压缩的）完整备份内容，不解压"""
+        f, _ = self.open_blob(blob_hash, encoding)
+        with f:
+            return f.read()
+
+    def load_content(self, record: Dict[str, Any]) -> bytes:
+        """读取一个版本的完整内容（整体存储或分块存储）"""
+        if record['encoding'] == CHUNKED_ENCODING:
+            with ChunkedReader(self, record['chunks']) as reader:
+                return reader.read()
+        return self.load_blob(record['hash'], record['encoding'], record['size'])
+
+    def store_chunk(self, staged: StagedBlob) -> None:
+        """保存客户端上传的数据块（调用方已校验哈希）"""
+        self._store_blob(staged)
+
+    def chunk_blob(self, blob_hash: str, encoding: str) -> List[List[Any]]:
+        """把整体存储的备份按内容切分并存为数据块，返回 [哈希, 大小, 编码] 列表
+
+        数据块在被某个版本引用之前受垃圾回收宽限期保护；命中缓存时刷新各数据块的回收时间，
+        有数据块已被回收则重新切分。
+        """
+        with self._chunk_cache_lock:
+            cached = self._chunk_cache.get(blob_hash)
+            if cached is not None:
+                self._chunk_cache.move_to_end(blob_hash)
+        if cached is not None and all(self._touch_blob(chunk[0]) is not None for chunk in cached):
+            return cached
+
+        chunks = []
+        raw, _ = self.open_blob(blob_hash, encoding)
+        with raw, open_decoded(raw, encoding) as reader:
+            for data in iter_content_chunks(reader):
+                staged = self.stage_blob()
+                try:
+                    staged.write(data)
+                    staged.finish()
+                    chunk_encoding, _ = self._store_blob(staged)
+                finally:
+                    staged.discard()
+                chunks.append([staged.hash, len(data), chunk_encoding])
+
+        with self._chunk_cache_lock:
+            self._chunk_cache[blob_hash] = chunks
+            while len(self._chunk_cache) > CHUNK_CACHE_SIZE:
+                self._chunk_cache.popitem(last=False)
+        return chunks
+
+    def resolve_manifest(self, chunk_hashes: List[str]) -> Dict[str, Any]:
+        """校验分块清单：所有数据块必须已存在，按顺序读取一遍计算完整内容的哈希和摘要
+
+        缺少数据块时抛出 MissingChunksError。存在的数据块会刷新回收时间，
+        保证提交期间不会被垃圾回收。
+        """
+        found: Dict[str, Tuple[str, int]] = {}
+        missing = []
+        for chunk_hash in dict.fromkeys(chunk_hashes):
+            existing = self._touch_blob(chunk_hash)
+            if existing is None:
+                missing.append(chunk_hash)
+            else:
+                found[chunk_hash] = existing
+        if missing:
+            raise MissingChunksError(missing)
+
+        digest = BackupDigest()
+        chunks = []
+        for chunk_hash in chunk_hashes:
+            encoding = found[chunk_hash][0]
+            raw, _ = self.open_blob(chunk_hash, encoding)
+            size = 0
+            with raw, open_decoded(raw, encoding) as reader:
+                for data in iter(lambda: reader.read(1024 * 1024), b''):
+                    digest.update(data)
+                    size += len(data)
+            chunks.append([chunk_hash, size, encoding])
+
+        return {
+            'hash': digest.hexdigest(),
+            'size': digest.size,
+            'backup': digest.summary(),
+            'stored_size': sum(stored_size for _, stored_size in found.values()),
+            'chunks': chunks,
+        }
+
+    @abstractmethod
+    def get_metadata(self, config_name: str) -> Optional[Dict[str, Any]]:
+        """获取指定配置的元数据（不读取备份内容）"""
+
+    @abstractmethod
+    def list_metadata(self, query: Optional[MetadataQuery] = None, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        """按查询条件列出配置的元数据，默认按配置名称排序列出全部
+
+        ``query.after`` 不为空时从游标之后开始，最多返回 ``limit`` 个。
+        """
+
+    @abstractmethod
+    def list_versions(self, config_name: str) -> List[Dict[str, Any]]:
+        """列出指定配置保留的所有版本记录，最新的在前"""
+
+    @abstractmethod
+    def record_integrity(self, config_name: str, version: int, integrity: Dict[str, Any]) -> None:
+        """把完整性校验结果记入该配置的元数据（/status 的 ``integrity``）；当前版本已不是 version 时忽略"""
+
+    def get_version(self, config_name: str, version: int) -> Optional[Dict[str, Any]]:
+        """获取指定配置的某个版本记录"""
+        for record in self.list_versions(config_name):
+            if record['version'] == version:
+                return record
+        return None
+
+    @abstractmethod
+    def load_data(self, config_name: str) -> Dict[str, Any]:
+        """加载配置记录（设备信息、ETag 等，不包含备份内容）"""
+
+    @abstractmethod
+    def save_data(
+        self,
+        config_name: str,
+        data: Dict[str, Any],
+        device_id: Optional[str] = None,
+        staged: Optional[StagedBlob] = None,
+        manifest: Optional[Dict[str, Any]] = None
+    ) -> None:
+        """保存配置记录
+
+        ``manifest``（校验过的分块清单）、``staged``（流式上传写完的临时文件）
+        或 ``data['encrypted_data']``（str 或 bytes）若存在，会作为 ``device_id`` 上传的新版本保存，
+        配置记录中只保留其 ETag、大小和摘要信息。
+        """
+
+    @abstractmethod
+    def clear_config(self, config_name: str) -> None:
+        """清除指定配置的数据（备份内容由垃圾回收清理）"""
+
+    @abstractmethod
+    def clear_all(self) -> None:
+        """清除所有配置数据：一步原子地移出所有配置（重命名），物理删除由 purge_trash 在后台完成
+
+        调用方独占存储屏障（见 clear_all_async），期间没有进行中的写入。
+        """
+
+    @abstractmethod
+    def list_configs(self) -> List[str]:
+        """列出所有配置名称"""
+
+    @abstractmethod
+    def collect_garbage(self, grace_seconds: float = GC_GRACE_SECONDS) -> int:
+        """执行一步增量垃圾回收，删除不再被引用且超过宽限期的备份内容，返回删除数量"""
+
+    @abstractmethod
+    def storage_stats(self) -> Tuple[int, int]:
+        """返回 (配置数量, 所有配置当前版本的落盘字节数)"""
+
+    def count_configs(self) -> int:
+        """配置数量"""
+        return self.storage_stats()[0]
+
+    @asynccontextmanager
+    async def locked(self, config_name: str):
+        """以共享方式持有存储屏障（与清除全部数据互斥），再持有指定配置的写锁，并记录等待时间
+
+        多进程模式下再获取该配置的文件锁。文件锁以非阻塞方式重试，
+        等待期间不占用存储线程池：其他进程持锁时本进程的其他请求照常处理。
+        """
+        lock = self.lock(config_name)
+        start = time.perf_counter()
+        async with self.barrier.shared(), lock:
+            fd = None
+            if self.lock_dir is not None:
+                fd = os.open(self.lock_path(config_name), os.O_RDWR | os.O_CREAT, 0o600)
+                try:
+                    await flock_async(fd, fcntl.LOCK_EX)
+                except BaseException:
+                    os.close(fd)
+                    raise
+            LOCK_WAIT.observe(time.perf_counter() - start)
+            try:
+                yield
+            finally:
+                if fd is not None:
+                    # 关闭文件描述符即释放文件锁
+                    os.close(fd)
+
+    async def _run_io(self, func, *args):
+        """在存储线程池中执行阻塞的存储操作，并记录耗时（含排队时间）"""
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        try:
+            return await loop.run_in_executor(self._executor, func, *args)
+        finally:
+            STORAGE_LATENCY.observe(time.perf_counter() - start, self.backend, func.__name__)
+
+    async def storage_stats_async(self) -> Tuple[int, int]:
+        """异步统计配置数量和落盘字节数"""
+        return await self._run_io(self.storage_stats)
+
+    async def count_configs_async(self) -> int:
+        """异步统计配置数量"""
+        return await self._run_io(self.count_configs)
+
+    async def get_metadata_async(self, config_name: str) -> Optional[Dict[str, Any]]:
+        """异步获取指定配置的元数据"""
+        return await self._run_io(self.get_metadata, config_name)
+
+    async def list_metadata_async(
+        self,
+        query: Optional[MetadataQuery] = None,
+        limit: Optional[int] = None
+    ) -> List[Dict[str, Any]]:
+        """异步按查询条件列出配置的元数据"""
+        return await self._run_io(self.list_metadata, query, limit)
+
+    async def list_versions_async(self, config_name: str) -> List[Dict[str, Any]]:
+        """异步列出指定配置的版本记录"""
+        return await self._run_io(self.list_versions, config_name)
+
+    async def get_version_async(self, config_name: str, version: int) -> Optional[Dict[str, Any]]:
+        """异步获取指定配置的某个版本记录"""
+        return await self._run_io(self.get_version, config_name, version)
+
+    async def load_data_async(self, config_name: str) -> Dict[str, Any]:
+        """异步加载存储的数据"""
+        return await self._run_io(self.load_data, config_name)
+
+    async def load_blob_async(self, blob_hash: str, encoding: str, size: int) -> bytes:
+        """异步读取并解压备份内容"""
+        return await self._run_io(self.load_blob, blob_hash, encoding, size)
+
+    async def open_blob_async(self, blob_hash: str, encoding: str) -> Tuple[BinaryIO, int]:
+        """异步打开落盘的备份内容"""
+        return await self._run_io(self.open_blob, blob_hash, encoding)
+
+    async def load_stored_blob_async(self, blob_hash: str, encoding: str) -> bytes:
+        """异步读取落盘的完整备份内容"""
+        return await self._run_io(self.load_stored_blob, blob_hash, encoding)
+
+    async def load_content_async(self, record: Dict[str, Any]) -> bytes:
+        """异步读取一个版本的完整内容"""
+        return await self._run_io(self.load_content, record)
+
+    async def find_blob_async(self, blob_hash: str) -> Optional[Tuple[str, int]]:
+        """异步查找按内容寻址的备份或数据块"""
+        return await self._run_io(self.find_blob, blob_hash)
+
+    async def store_chunk_async(self, staged: StagedBlob) -> None:
+        """异步保存客户端上传的数据块"""
+        await self._run_io(self.store_chunk, staged)
+
+    async def chunk_blob_async(self, blob_hash: str, encoding: str) -> List[List[Any]]:
+        """异步把整体存储的备份切分为数据块"""
+        return await self._run_io(self.chunk_blob, blob_hash, encoding)
+
+    async def resolve_manifest_async(self, chunk_hashes: List[str]) -> Dict[str, Any]:
+        """异步校验分块清单"""
+        return await self._run_io(self.resolve_manifest, chunk_hashes)
+
+    async def stage_write_async(self, staged: StagedBlob, chunk: bytes) -> None:
+        """在线程池中向临时文件写入一块数据"""
+        await self._run_io(staged.write, chunk)
+
+    async def stage_finish_async(self, staged: StagedBlob) -> None:
+        """在线程池中写完临时文件"""
+        await self._run_io(staged.finish)
+
+    async def iter_file(
+        self,
+        f: BinaryIO,
+        start: int = 0,
+        length: Optional[int] = None,
+        closing: Tuple[BinaryIO, ...] = (),
+        chunk_size: int = 64 * 1024
+    ):
+        """在线程池中分块读取文件的 [start, start + length) 区间，读完后关闭 f 及 closing 中的文件"""
+        try:
+            if start:
+                await self._run_io(f.seek, start)
+            remaining = length
+            while remaining is None or remaining > 0:
+                size = chunk_size if remaining is None else min(chunk_size, remaining)
+                chunk = await self._run_io(f.read, size)
+                if not chunk:
+                    break
+                if remaining is not None:
+                    remaining -= len(chunk)
+                yield chunk
+        finally:
+            f.close()
+            for other in closing:
+                other.close()
+
+    async def save_data_async(
+        self,
+        config_name: str,
+        data: Dict[str, Any],
+        device_id: Optional[str] = None,
+        staged: Optional[StagedBlob] = None,
+        manifest: Optional[Dict[str, Any]] = None
+    ) -> None:
+        """异步保存数据"""
+        await self._run_io(self.save_data, config_name, data, device_id, staged, manifest)
+        await self._after_change(config_name, device_id, data)
+
+    async def clear_config_async(self, config_name: str) -> None:
+        """异步清除指定配置的数据"""
+        await self._run_io(self.clear_config, config_name)
+        await self._after_change(config_name)
+
+    async def clear_all_async(self) -> None:
+        """异步清除所有配置数据，并唤醒后台删除任务
+
+        独占存储屏障：等进行中的写入完成后再移走数据，清除期间新的写入排队等待，
+        清除标记也在之后的写入之前追加到复制变更流。
+        """
+        async with self.barrier.exclusive():
+            await self._run_io(self.clear_all)
+            self._purge_wakeup.set()
+            await self._after_change(None)
+
+    async def _after_change(
+        self,
+        config_name: Optional[str],
+        device_id: Optional[str] = None,
+        data: Optional[Dict[str, Any]] = None
+    ) -> None:
+        """写入或清除之后失效响应缓存，把变更追加到复制变更流并唤醒等待的副本；
+        多进程模式下再追加到共享变更日志（调用方仍持有配置写锁）"""
+        self.cache.invalidate(config_name)
+        await self._run_io(self._record_change, config_name, device_id, data)
+        self._notify_feed()
+
+    def _record_change(self, config_name: Optional[str], device_id: Optional[str], data: Optional[Dict[str, Any]]) -> None:
+        self.feed.append(feed_change(config_name, data, device_id))
+        if self.changelog is not None:
+            self.changelog.append({'config': config_name, 'device_id': device_id})
+
+    def _notify_feed(self) -> None:
+        """唤醒等待复制变更流的请求：set 当前事件并换上新的事件"""
+        event, self._feed_updated = self._feed_updated, asyncio.Event()
+        event.set()
+
+    def feed_updated(self) -> asyncio.Event:
+        """下一次有新变更时被 set 的事件（先取事件再查询变更，不会错过两者之间的写入）"""
+        return self._feed_updated
+
+    async def feed_changes_async(self, since: int, feed_id: Optional[str], limit: int) -> Dict[str, Any]:
+        """异步查询复制变更流"""
+        return await self._run_io(self.feed.changes, since, feed_id, limit)
+
+    def reconcile_feed(self) -> int:
+        """启动时对照存储中的实际数据补发复制变更流中缺失的变更（上次崩溃时未写入的行），返回补发数量"""
+        appended = 0
+        present = set()
+        for metadata in self.list_metadata():
+            if not metadata.get('has_data'):
+                continue
+            config_name = metadata['name']
+            present.add(config_name)
+            entry = self.feed.latest(config_name)
+            if (entry is not None and entry['op'] == 'put'
+                    and entry['version'] == metadata['version'] and entry['hash'] == metadata['hash']):
+                continue
+            record = self.get_version(config_name, metadata['version'])
+            data = self.load_data(config_name)
+            self.feed.append(feed_change(config_name, data, record.get('device_id') if record else None))
+            appended += 1
+        for config_name in self.feed.live_configs():
+            if config_name not in present:
+                self.feed.append(feed_change(config_name))
+                appended += 1
+        if appended:
+            log_event(logging.INFO, '复制变更流已补齐', event='replication', backend=self.backend, appended=appended)
+        return appended
+
+    def is_leader(self) -> bool:
+        """多进程模式下只由持有 gc 文件锁的一个工作进程执行后台任务（垃圾回收、校验、删除、副本同步）；
+        该进程退出后由其他进程接替"""
+        if self.lock_dir is None or self._gc_lock_fd is not None:
+            return True
+        fd = os.open(self.lock_path('gc'), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self._gc_lock_fd = fd
+        return True
+
+    async def run_garbage_collector(self, interval: float = GC_INTERVAL) -> None:
+        """后台垃圾回收任务：每隔 interval 秒执行一小步，不阻塞请求"""
+        while True:
+            await asyncio.sleep(interval)
+            if not self.is_leader():
+                continue
+            try:
+                async with self.barrier.shared():
+                    await self._run_io(self.collect_garbage)
+            except Exception as e:
+                log_event(logging.WARNING, '垃圾回收失败', event='gc', backend=self.backend, error=str(e))
+
+    # 每个文件（目录）至少按一个磁盘块计入删除量，大量小文件时每步删除的个数同样受限
+    PURGE_FILE_COST = 4096
+
+    def _new_trash_dir(self) -> str:
+        """为一次清除新建回收目录"""
+        path = os.path.join(self.trash_dir, f'{time.time_ns()}-{os.getpid()}')
+        os.makedirs(path)
+        return path
+
+    def purge_trash(self, max_bytes: int) -> int:
+        """删除回收目录中最多约 max_bytes 字节的数据，返回本步删除的字节数（回收目录已空时为 0）
+
+        比剩余额度大的文件只截断掉额度内的部分，大文件分多步释放，单步耗时有上限。
+        """
+        freed = 0
+        for directory, subdirs, filenames in os.walk(self.trash_dir):
+            for filename in filenames:
+                path = os.path.join(directory, filename)
+                budget = max_bytes - freed
+                try:
+                    size = os.path.getsize(path)
+                    if size > budget:
+                        os.truncate(path, size - budget)
+                        return max_bytes
+                    os.remove(path)
+                except FileNotFoundError:
+                    continue
+                freed += max(size, self.PURGE_FILE_COST)
+                if freed >= max_bytes:
+                    return freed
+            if not subdirs and not filenames and directory != self.trash_dir:
+                # 空目录在下一次遍历时由其父目录看到，逐层删除
+                try:
+                    os.rmdir(directory)
+                except OSError:
+                    continue
+                freed += self.PURGE_FILE_COST
+        return freed
+
+    async def run_purger(self, rate_mb: float = PURGE_RATE_MB, interval: float = GC_INTERVAL) -> None:
+        """后台删除任务：每步删除约 0.1 秒额度的数据，按速率上限休眠，只占用一个存储线程
+
+        没有待删除的数据时等待下一次清除，最多 interval 秒后再检查（多进程模式下其他进程的清除）。
+        """
+        rate = rate_mb * 1024 * 1024
+        step = max(int(rate / 10), self.PURGE_FILE_COST)
+        while True:
+            self._purge_wakeup.clear()
+            freed = 0
+            if self.is_leader():
+                try:
+                    freed = await self._run_io(self.purge_trash, step)
+                except Exception as e:
+                    log_event(logging.WARNING, '后台删除失败', event='purge', backend=self.backend, error=str(e))
+            if freed:
+                PURGED_BYTES.inc(freed)
+                await asyncio.sleep(freed / rate)
+                continue
+            try:
+                await asyncio.wait_for(self._purge_wakeup.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def verify_record(self, record: Dict[str, Any]) -> Tuple[Optional[str], int]:
+        """重新读取一个版本的备份内容并与版本记录比对，返回 (发现的问题，一致时为 None；读取的落盘字节数)
+
+        检查内容能否读取和解压、大小和 SHA-256 是否与记录一致，以及备份摘要是否仍能提取、
+        ``checksum`` 字段是否与保存时相同（该校验和由客户端对明文计算，服务器只能核对字段本身）。
+        """
+        stored = record.get('stored_size', record['size'])
+        digest = BackupDigest(record['size'])
+        raw = None
+        try:
+            if record['encoding'] == CHUNKED_ENCODING:
+                reader = ChunkedReader(self, record['chunks'])
+            else:
+                raw, _ = self.open_blob(record['hash'], record['encoding'])
+                reader = open_decoded(raw, record['encoding'])
+            with reader:
+                for data in iter(lambda: reader.read(1024 * 1024), b''):
+                    digest.update(data)
+        except FileNotFoundError:
+            return 'backup content is missing', 0
+        except OverflowError:
+            return 'size mismatch', stored
+        except CORRUPT_CONTENT_ERRORS + (OSError,) as e:
+            return f'unreadable: {e}', stored
+        finally:
+            if raw is not None:
+                raw.close()
+
+        if digest.size != record['size']:
+            return 'size mismatch', stored
+        if digest.hexdigest() != record['hash']:
+            return 'hash mismatch', stored
+        expected = record.get('backup') or {}
+        summary = digest.summary()
+        if any(expected.values()) and not any(summary.values()):
+            return 'backup is no longer valid JSON', stored
+        if expected.get('checksum') and summary.get('checksum') != expected['checksum']:
+            return 'checksum mismatch', stored
+        return None, stored
+
+    def scrub_step(self, cursor: Optional[str], max_bytes: int) -> Tuple[Optional[str], int, int]:
+        """从游标之后按配置名顺序校验各配置的当前版本，读取量达到 max_bytes 时停下
+
+        返回 (下一步的游标，本轮已检查完所有配置时为 None；读取的落盘字节数；发现的损坏数量)。
+        """
+        query = MetadataQuery(cursor=cursor, has_data=True)
+        page = self.list_metadata(query, SCRUB_BATCH_SIZE)
+        read = corrupt = 0
+        for metadata in page:
+            cursor = query.cursor_for(metadata)
+            # 元数据中的摘要只用于展示，需要完整的版本记录；期间被覆盖或清除时跳过
+            record = self.get_version(metadata['name'], metadata['version'])
+            if record is not None:
+                problem, stored = self.verify_record(record)
+                read += stored
+                self.record_integrity(metadata['name'], record['version'], {
+                    'status': 'corrupt' if problem else 'ok',
+                    'error': problem,
+                    'checked_at': datetime.now().isoformat(),
+                })
+                SCRUB_CHECKS.inc(1, 'corrupt' if problem else 'ok')
+                if problem:
+                    corrupt += 1
+                    log_event(logging.WARNING, '备份校验失败', event='scrub', config=metadata['name'],
+                              version=record['version'], error=problem)
+            if read >= max_bytes:
+                return cursor, read, corrupt
+        return (cursor if len(page) == SCRUB_BATCH_SIZE else None), read, corrupt
+
+    async def run_scrubber(self, rate_mb: float = SCRUB_RATE_MB, interval: float = SCRUB_INTERVAL) -> None:
+        """后台完整性校验任务：逐步校验所有配置的当前版本，读取速率不超过 rate_mb，只占用一个存储线程
+
+        每轮检查完所有配置后更新损坏数量指标，间隔 interval 秒再开始下一轮；rate_mb 为 0 时不校验。
+        """
+        if rate_mb <= 0:
+            return
+        rate = rate_mb * 1024 * 1024
+        step = max(int(rate / 10), 1)
+        cursor = None
+        corrupt = 0
+        while True:
+            if not self.is_leader():
+                await asyncio.sleep(interval)
+                continue
+            try:
+                # 与清除全部数据互斥，避免把正在被移走的备份误报为损坏
+                async with self.barrier.shared():
+                    cursor, read, found = await self._run_io(self.scrub_step, cursor, step)
+            except Exception as e:
+                log_event(logging.WARNING, '完整性校验失败', event='scrub', backend=self.backend, error=str(e))
+                cursor, corrupt = None, 0
+                await asyncio.sleep(interval)
+                continue
+            SCRUB_BYTES.inc(read)
+            corrupt += found
+            if cursor is None:
+                CORRUPT_CONFIGS.set(corrupt)
+                corrupt = 0
+                await asyncio.sleep(interval)
+            else:
+                await asyncio.sleep(read / rate)
+
+    def close(self) -> None:
+        """关闭存储线程池，等待进行中的写入完成"""
+        self._executor.shutdown(wait=True)
+        if self.changelog is not None:
+            self.changelog.close()
+        self.feed.close()
+        if self._gc_lock_fd is not None:
+            os.close(self._gc_lock_fd)
+            self._gc_lock_fd = None
+
+
+class FileDataStore(DataStore):
+    """文件存储
+
+    - ``configs/<配置名>.json``：配置记录（设备信息、当前版本和保留的版本列表）
+    - ``blobs/<哈希前两位>/<哈希>.<编码>``：按内容寻址的备份内容，写入后不再修改
+
+    早期版本把配置文件直接放在数据目录下，启动时移入 ``configs/``。
+    """
+
+    backend = 'file'
+
+    def __init__(
+        self,
+        data_dir: str,
+        max_workers: int = STORAGE_WORKERS,
+        compression: str = STORAGE_COMPRESSION,
+        max_versions: int = MAX_VERSIONS,
+        shared: bool = False,
+        cache_size: int = int(CACHE_MAX_MB * 1024 * 1024)
+    ):
+        super().__init__(data_dir, max_workers, compression, max_versions, shared, cache_size)
+        self.config_dir = os.path.join(data_dir, 'configs')
+        self.blob_dir = os.path.join(data_dir, 'blobs')
+        os.makedirs(self.config_dir, exist_ok=True)
+        os.makedirs(self.blob_dir, exist_ok=True)
+        # 元数据索引：启动时构建一次，写入/清除时增量更新，
+        # 多进程模式下其他进程的变更通过变更日志失效
+        self._index = MetadataIndex()
+        # 写入备份内容与垃圾回收删除之间互斥（多进程模式下跨进程互斥）
+        self._blob_lock = InterProcessLock(self.lock_path('blobs'))
+        self._gc_cursor = 0
+        self._remove_stale_temp_files()
+        self._move_legacy_configs()
+        self._build_index()
+
+    def _move_legacy_configs(self) -> None:
+        """把数据目录下旧位置的配置文件移入 configs/（多进程模式下各进程依次初始化，见 create_data_store）"""
+        moved = 0
+        for filename in os.listdir(self.data_dir):
+            if not filename.endswith('.json'):
+                continue
+            try:
+                validate_config_name(filename[:-5])
+            except ValueError:
+                continue
+            target = os.path.join(self.config_dir, filename)
+            if not os.path.exists(target):
+                os.rename(os.path.join(self.data_dir, filename), target)
+                moved += 1
+        if moved:
+            fsync_directory(self.config_dir)
+            fsync_directory(self.data_dir)
+            log_event(logging.INFO, '配置文件已移入 configs/', event='migrate', moved=moved)
+
+    def _read_metadata(self, config_name: str) -> Optional[Dict[str, Any]]:
+        """读取一个配置文件的元数据（旧格式会先迁移），文件不存在返回 None"""
+        try:
+            with open(self.get_config_file(config_name), 'rb') as f:
+                config_data = json_decode(f.read())
+            if 'versions' not in config_data:
+                config_data = self._migrate_legacy(config_name, config_data)
+            return metadata_from_config(config_name, config_data)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            return {
+                'name': config_name,
+                'error': f'Unable to read: {str(e)}'
+            }
+
+    def _build_index(self) -> None:
+        """扫描数据目录，构建元数据索引（只读取配置文件，不读取备份内容）"""
+        index = {}
+        for config_name in self.list_configs():
+            metadata = self._read_metadata(config_name)
+            if metadata is not None:
+                index[config_name] = metadata
+
+        self._index.replace(index)
+
+    def _invalidate(self, config_name: Optional[str]) -> None:
+        """其他工作进程修改了配置：重新读取该配置文件（全部清除时重建索引）"""
+        if config_name is None:
+            self._build_index()
+            return
+        metadata = self._read_metadata(config_name)
+        if metadata is None:
+            self._index.remove(config_name)
+        else:
+            self._index.set(config_name, metadata)
+
+    def _remove_stale_temp_files(self) -> None:
+        """清理上次异常退出时遗留的临时文件
+
+        多进程模式下其他工作进程可能正在写入临时文件，只清理超过垃圾回收宽限期的。
+        """
+        cutoff = time.time() - GC_GRACE_SECONDS if self.lock_dir else None
+        for directory, _, filenames in os.walk(self.data_dir):
+            for filename in filenames:
+                if filename.startswith('.') and filename.endswith('.tmp'):
+                    path = os.path.join(directory, filename)
+                    try:
+                        if cutoff is None or os.path.getmtime(path) < cutoff:
+                            os.remove(path)
+                    except OSError:
+                        pass
+
+    def _migrate_legacy(self, config_name: str, data: Dict[str, Any]) -> Dict[str, Any]:
+        """把旧格式迁移到按内容寻址的版本化存储
+
+        - 最早的格式把 encrypted_data 内嵌在配置文件中
+        - 之后的格式把备份单独保存为 ``<配置名>.blob``
+        """
+        legacy_blob_file = os.path.join(self.data_dir, f'{config_name}.blob')
+        blob = None
+        if data.get('encrypted_data') is not None:
+            blob = backup_bytes(data['encrypted_data'])
+        elif data.get('etag') and os.path.exists(legacy_blob_file):
+            with open(legacy_blob_file, 'rb') as f:
+                blob = decompress_content(f.read(), data.get('encoding', 'identity'), max(data.get('size', 0), 1))
+        data.pop('encrypted_data', None)
+
+        data['versions'] = []
+        data['version'] = None
+        if blob is not None:
+            data['versions'].append(self._new_version(data, None, blob=blob))
+        self._write_config(config_name, data)
+
+        if os.path.exists(legacy_blob_file):
+            os.remove(legacy_blob_file)
+        return data
+
+    def get_metadata(self, config_name: str) -> Optional[Dict[str, Any]]:
+        """获取指定配置的元数据（不读取数据文件）"""
+        self.sync_changes()
+        return self._index.get(config_name)
+
+    def list_metadata(self, query: Optional[MetadataQuery] = None, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        """按查询条件从元数据索引列出配置（不读取数据文件）"""
+        self.sync_changes()
+        return self._index.page(query or MetadataQuery(), limit)
+
+    def list_versions(self, config_name: str) -> List[Dict[str, Any]]:
+        """列出指定配置保留的所有版本记录，最新的在前"""
+        return list(reversed(self.load_data(config_name).get('versions', [])))
+
+    def record_integrity(self, config_name: str, version: int, integrity: Dict[str, Any]) -> None:
+        """校验结果保存在内存中的元数据索引里，重启后由下一轮校验重新得出"""
+        self._index.annotate(config_name, version, {'integrity': integrity})
+
+    def storage_stats(self) -> Tuple[int, int]:
+        """从元数据索引统计配置数量和落盘字节数"""
+        self.sync_changes()
+        return self._index.stats()
+
+    def count_configs(self) -> int:
+        """索引中的配置数量"""
+        self.sync_changes()
+        return len(self._index)
+
+    def get_config_file(self, config_name: str) -> str:
+        """获取配置文件路径"""
+        validate_config_name(config_name)
+        return os.path.join(self.config_dir, f"{config_name}.json")
+
+    def get_blob_file(self, blob_hash: str, encoding: str) -> str:
+        """获取按内容寻址的备份文件路径"""
+        return os.path.join(self.blob_dir, blob_hash[:2], f'{blob_hash}.{encoding}')
+
+    def find_blob(self, blob_hash: str) -> Optional[Tuple[str, int]]:
+        """查找备份文件，返回 (编码, 落盘大小)"""
+        for encoding in [self.compression] + supported_encodings():
+            try:
+                return encoding, os.path.getsize(self.get_blob_file(blob_hash, encoding))
+            except FileNotFoundError:
+                continue
+        return None
+
+    def _touch_blob(self, blob_hash: str) -> Optional[Tuple[str, int]]:
+        """备份内容已存在时刷新修改时间（推迟垃圾回收），返回 (编码, 落盘大小)"""
+        with self._blob_lock:
+            for encoding in [self.compression] + supported_encodings():
+                path = self.get_blob_file(blob_hash, encoding)
+                try:
+                    os.utime(path)
+                    return encoding, os.path.getsize(path)
+                except FileNotFoundError:
+                    continue
+        return None
+
+    def _put_blob(self, staged: StagedBlob) -> None:
+        """把已落盘的临时文件原子改名为按内容寻址的备份文件"""
+        path = self.get_blob_file(staged.hash, staged.encoding)
+        with self._blob_lock:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(staged.path, path)
+            fsync_directory(os.path.dirname(path))
+
+    def open_blob(self, blob_hash: str, encoding: str) -> Tuple[BinaryIO, int]:
+        """打开落盘的备份文件，返回文件对象和大小
+
+        备份文件按内容寻址、写入后不再修改，未被引用的文件也要过了宽限期才会删除，
+        因此无需加锁即可安全读取。
+        """
+        f = open(self.get_blob_file(blob_hash, encoding), 'rb')
+        return f, os.fstat(f.fileno()).st_size
+
+    def load_data(self, config_name: str) -> Dict[str, Any]:
+        """加载配置记录（设备信息、版本列表等，不包含备份内容）"""
+        data_file = self.get_config_file(config_name)
+
+        if not os.path.exists(data_file):
+            return empty_config(config_name)
+
+        # 写入是原子的，文件损坏说明磁盘出错，不能当作空配置覆盖掉已有设备信息
+        try:
+            with open(data_file, 'rb') as f:
+                return json_decode(f.read())
+        except json.JSONDecodeError as e:
+            raise IOError(f'Corrupt metadata file for config "{config_name}": {e}') from e
+
+    def save_data(
+        self,
+        config_name: str,
+        data: Dict[str, Any],
+        device_id: Optional[str] = None,
+        staged: Optional[StagedBlob] = None,
+        manifest: Optional[Dict[str, Any]] = None
+    ) -> None:
+        """保存数据到文件
+
+        ``manifest`` / ``staged`` / ``data['encrypted_data']`` 若存在，会追加为新版本
+        （备份存为按内容寻址的文件），超出保留数量的旧版本从列表中移除。
+        """
+        data['last_updated'] = update_timestamp(data)
+        data['config_name'] = config_name
+        self._append_version(data, device_id, staged, manifest)
+        self._write_config(config_name, data)
+
+    def _write_config(self, config_name: str, data: Dict[str, Any]) -> None:
+        """原子写入配置文件，并更新索引"""
+        content = json_encode(data, indent=True)
+        atomic_write(self.get_config_file(config_name), content)
+        fsync_directory(self.config_dir)
+
+        self._index.set(config_name, metadata_from_config(config_name, data))
+
+    def clear_config(self, config_name: str) -> None:
+        """清除指定配置的数据"""
+        data_file = self.get_config_file(config_name)
+        if os.path.exists(data_file):
+            os.remove(data_file)
+        self._index.remove(config_name)
+
+    def clear_all(self) -> None:
+        """把配置目录和备份目录依次重命名到回收目录，换上空目录（保留多进程协调用的锁文件和变更日志）
+
+        配置目录一次改名移走：读取方要么看到清除前的所有配置，要么一个也看不到。
+        之后才移走备份目录，中途失败时也不会留下引用了不存在备份的配置。
+        """
+        with self._blob_lock:
+            trash = self._new_trash_dir()
+            os.rename(self.config_dir, os.path.join(trash, 'configs'))
+            os.makedirs(self.config_dir)
+            self._index.replace({})
+            os.rename(self.blob_dir, os.path.join(trash, 'blobs'))
+            os.makedirs(self.blob_dir)
+            fsync_directory(self.data_dir)
+
+    def list_configs(self) -> List[str]:
+        """列出所有配置文件"""
+        try:
+            filenames = os.listdir(self.config_dir)
+        except FileNotFoundError:
+            # 清除全部数据时配置目录短暂不存在
+            return []
+
+        configs = []
+        for filename in filenames:
+            if filename.endswith('.json'):
+                configs.append(filename[:-5])  # 移除 .json 后缀
+        return configs
+
+    def _referenced_hashes(self) -> Optional[set]:
+        """所有配置保留版本引用的备份哈希；有配置文件无法读取时返回 None"""
+        self.sync_changes()
+        return self._index.referenced_hashes()
+
+    def collect_garbage(self, grace_seconds: float = GC_GRACE_SECONDS) -> int:
+        """每次只扫描一个哈希分片目录，删除其中未被引用且超过宽限期的备份文件"""
+        try:
+            shards = sorted(os.listdir(self.blob_dir))
+        except FileNotFoundError:
+            return 0
+        if not shards:
+            return 0
+
+        shard_dir = os.path.join(self.blob_dir, shards[self._gc_cursor % len(shards)])
+        self._gc_cursor += 1
+        # 引用关系不完整时宁可不删
+        referenced = self._referenced_hashes()
+        if referenced is None:
+            return 0
+
+        # 扫描之后新写入或复用的备份修改时间都很新，宽限期保证不会被误删
+        cutoff = time.time() - grace_seconds
+        removed = 0
+        for filename in os.listdir(shard_dir):
+            blob_hash = filename.split('.', 1)[0]
+            if filename.startswith('.') or blob_hash in referenced:
+                continue
+            path = os.path.join(shard_dir, filename)
+            with self._blob_lock:
+                try:
+                    if os.path.getmtime(path) >= cutoff:
+                        continue
+                    os.remove(path)
+                    removed += 1
+                except FileNotFoundError:
+                    continue
+        return removed
+
+
+class SQLiteDataStore(DataStore):
+    """SQLite 存储（WAL 模式）：配置记录、版本和备份内容分别保存在带索引的表中
+
+    适合配置数量很多的部署：状态查询、列表和单个配置的查找都是索引查询，
+    不再依赖目录扫描，也不会为每个配置占用 inode。
+    """
+
+    backend = 'sqlite'
+    # 临时文件只是复制进数据库的中转，由数据库事务保证持久化
+    stage_durable = False
+    DB_FILENAME = 'vaultsafe.db'
+    # 增量 BLOB I/O（Connection.blobopen）需要 Python 3.11+，更早的版本整块读写 data 列
+    BLOB_IO = hasattr(sqlite3.Connection, 'blobopen')
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS configs (
+            name TEXT PRIMARY KEY,
+            last_updated TEXT,
+            device_info TEXT NOT NULL DEFAULT '{}',
+            devices TEXT NOT NULL DEFAULT '[]',
+            etag TEXT,
+            hash TEXT,
+            version INTEGER,
+            size INTEGER NOT NULL DEFAULT 0,
+            stored_size INTEGER NOT NULL DEFAULT 0,
+            encoding TEXT NOT NULL DEFAULT 'identity',
+            backup TEXT NOT NULL DEFAULT '{}',
+            integrity TEXT
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_configs_updated ON configs (COALESCE(last_updated, ''));
+        CREATE TABLE IF NOT EXISTS versions (
+            name TEXT NOT NULL,
+            version INTEGER NOT NULL,
+            hash TEXT NOT NULL,
+            etag TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            stored_size INTEGER NOT NULL,
+            encoding TEXT NOT NULL,
+            backup TEXT NOT NULL DEFAULT '{}',
+            stored_at TEXT NOT NULL,
+            device_id TEXT,
+            chunks TEXT,
+            PRIMARY KEY (name, version)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_versions_hash ON versions (hash);
+        CREATE TABLE IF NOT EXISTS version_chunks (
+            name TEXT NOT NULL,
+            version INTEGER NOT NULL,
+            hash TEXT NOT NULL,
+            PRIMARY KEY (name, version, hash)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_version_chunks_hash ON version_chunks (hash);
+    """
+    # 备份表单独列出：全部清除时在事务中整表换新
+    BLOBS_SCHEMA = (
+        """
+        CREATE TABLE IF NOT EXISTS blobs (
+            hash TEXT PRIMARY KEY,
+            encoding TEXT NOT NULL,
+            data BLOB NOT NULL,
+            touched_at REAL NOT NULL
+        )
+        """,
+        'CREATE INDEX IF NOT EXISTS idx_blobs_touched_at ON blobs (touched_at)',
+    )
+    SCHEMA += ';'.join(BLOBS_SCHEMA) + ';'
+    TRASH_TABLE_PREFIX = 'blobs_trash_'
+    PURGE_BATCH_SIZE = 64  # 每步最多从回收表删除的行数
+
+    METADATA_COLUMNS = (
+        'c.name, c.last_updated, c.devices, c.etag, c.hash, c.version, c.size, c.stored_size, '
+        'c.encoding, c.backup, c.integrity, (SELECT COUNT(*) FROM versions v WHERE v.name = c.name) AS version_count'
+    )
+
+    def __init__(
+        self,
+        data_dir: str,
+        max_workers: int = STORAGE_WORKERS,
+        compression: str = STORAGE_COMPRESSION,
+        max_versions: int = MAX_VERSIONS,
+        shared: bool = False,
+        cache_size: int = int(CACHE_MAX_MB * 1024 * 1024)
+    ):
+        super().__init__(data_dir, max_workers, compression, max_versions, shared, cache_size)
+        self.db_path = os.path.join(data_dir, self.DB_FILENAME)
+        # sqlite3 连接不能跨线程使用，每个线程各自持有一个连接
+        self._local = threading.local()
+        self._connections: List[sqlite3.Connection] = []
+        self._connections_lock = threading.Lock()
+        self._migrate_schema()
+        self._connection().executescript(self.SCHEMA)
+
+    def _connection(self) -> sqlite3.Connection:
+        """获取当前线程的数据库连接"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            # 与文件存储的 fsync 语义保持一致：提交返回时数据已落盘
+            conn.execute('PRAGMA synchronous=FULL')
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    def _migrate_schema(self) -> None:
+        """把按配置名保存备份的旧表结构迁移为按内容寻址 + 版本表，并为版本表补充分块清单列、为配置表补充校验结果列
+
+        旧的 last_updated 索引换成 COALESCE 表达式索引（见 list_metadata），由 SCHEMA 重建。
+        """
+        conn = self._connection()
+        version_columns = [row['name'] for row in conn.execute('PRAGMA table_info(versions)')]
+        if version_columns and 'chunks' not in version_columns:
+            conn.execute('ALTER TABLE versions ADD COLUMN chunks TEXT')
+        config_columns = [row['name'] for row in conn.execute('PRAGMA table_info(configs)')]
+        if config_columns and 'integrity' not in config_columns:
+            conn.execute('ALTER TABLE configs ADD COLUMN integrity TEXT')
+        conn.execute('DROP INDEX IF EXISTS idx_configs_last_updated')
+
+        columns = [row['name'] for row in conn.execute('PRAGMA table_info(blobs)')]
+        if 'name' not in columns:
+            return
+
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute('ALTER TABLE blobs RENAME TO legacy_blobs')
+            conn.execute('ALTER TABLE configs ADD COLUMN hash TEXT')
+            conn.execute('ALTER TABLE configs ADD COLUMN version INTEGER')
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+        conn.executescript(self.SCHEMA)
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            rows = conn.execute(
+                'SELECT c.name, c.etag, c.size, c.stored_size, c.encoding, c.backup, c.last_updated, b.data '
+                'FROM legacy_blobs b JOIN configs c ON c.name = b.name'
+            ).fetchall()
+            now = time.time()
+            for row in rows:
+                blob_hash = row['etag'].strip('"')
+                conn.execute(
+                    'INSERT OR IGNORE INTO blobs (hash, encoding, data, touched_at) VALUES (?, ?, ?, ?)',
+                    (blob_hash, row['encoding'], row['data'], now)
+                )
+                conn.execute(
+                    'INSERT INTO versions (name, version, hash, etag, size, stored_size, encoding, backup, stored_at) '
+                    'VALUES (?, 1, ?, ?, ?, ?, ?, ?, ?)',
+                    (row['name'], blob_hash, row['etag'], row['size'], row['stored_size'],
+                     row['encoding'], row['backup'], row['last_updated'])
+                )
+                conn.execute('UPDATE configs SET hash = ?, version = 1 WHERE name = ?', (blob_hash, row['name']))
+            conn.execute('DROP TABLE legacy_blobs')
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def _transaction(self):
+        """开启写事务（BEGIN IMMEDIATE），配合 with 使用"""
+        return _SQLiteTransaction(self._connection())
+
+    @staticmethod
+    def _row_to_metadata(row: sqlite3.Row) -> Dict[str, Any]:
+        """把 configs 表的一行转换为元数据"""
+        return {
+            'name': row['name'],
+            'last_updated': row['last_updated'],
+            'has_data': row['etag'] is not None,
+            'devices': json_decode(row['devices']),
+            'backup': display_backup_info(json_decode(row['backup'])),
+            'size': row['size'],
+            'etag': row['etag'],
+            'hash': row['hash'],
+            'version': row['version'],
+            'version_count': row['version_count'],
+            'encoding': row['encoding'],
+            'stored_size': row['stored_size'],
+            'integrity': json_decode(row['integrity']) if row['integrity'] else None,
+        }
+
+    @staticmethod
+    def _row_to_version(row: sqlite3.Row) -> Dict[str, Any]:
+        """把 versions 表的一行转换为版本记录"""
+        record = dict(row)
+        record.pop('name', None)
+        record['backup'] = json_decode(record['backup'])
+        chunks = record.pop('chunks', None)
+        if chunks:
+            record['chunks'] = json_decode(chunks)
+        return record
+
+    def get_metadata(self, config_name: str) -> Optional[Dict[str, Any]]:
+        """按主键查询指定配置的元数据"""
+        row = self._connection().execute(
+            f'SELECT {self.METADATA_COLUMNS} FROM configs c WHERE c.name = ?',
+            (config_name,)
+        ).fetchone()
+        return self._row_to_metadata(row) if row else None
+
+    def list_metadata(self, query: Optional[MetadataQuery] = None, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        """按主键或 last_updated 索引的顺序查询，游标转换为键集条件，过滤条件下推到 SQL
+
+        last_updated 为 NULL 时按空字符串排序（与 MetadataQuery.sort_key 一致）：
+        否则与 NULL 的比较永远不成立，这些配置在第一页之后不会再出现。
+        """
+        query = query or MetadataQuery()
+        updated = "COALESCE(c.last_updated, '')"
+        columns = ['c.name'] if query.field == 'name' else [updated, 'c.name']
+        conditions: List[str] = []
+        params: List[Any] = []
+        if query.after is not None:
+            operator = '<' if query.descending else '>'
+            if query.field == 'name':
+                conditions.append(f'c.name {operator} ?')
+                params.append(query.after)
+            else:
+                # 表达式的行值比较不能用于索引定位，先用单独的范围条件让查询从游标处开始扫描
+                conditions.append(f'{updated} {operator}= ? AND ({updated}, c.name) {operator} (?, ?)')
+                params.append(query.after[0])
+                params.extend(query.after)
+        if query.has_data is not None:
+            conditions.append('c.etag IS NOT NULL' if query.has_data else 'c.etag IS NULL')
+        if query.updated_since is not None:
+            conditions.append(f'{updated} >= ?')
+            params.append(query.updated_since)
+        if query.device is not None:
+            conditions.append('EXISTS (SELECT 1 FROM json_each(c.devices) WHERE json_each.value = ?)')
+            params.append(query.device)
+        if query.principal is not None:
+            # 前缀用 substr 比较，不必转义 LIKE 的通配符
+            scope = [f'c.name IN ({", ".join("?" * len(query.principal.names))})'] if query.principal.names else []
+            params.extend(query.principal.names)
+            for prefix in query.principal.prefixes:
+                scope.append('substr(c.name, 1, ?) = ?')
+                params.extend((len(prefix), prefix))
+            conditions.append('(' + ' OR '.join(scope) + ')' if scope else '0')
+
+        direction = 'DESC' if query.descending else 'ASC'
+        sql = f'SELECT {self.METADATA_COLUMNS} FROM configs c'
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY ' + ', '.join(f'{column} {direction}' for column in columns)
+        if limit is not None:
+            sql += ' LIMIT ?'
+            params.append(limit)
+        rows = self._connection().execute(sql, params).fetchall()
+        return [self._row_to_metadata(row) for row in rows]
+
+    def list_versions(self, config_name: str) -> List[Dict[str, Any]]:
+        """列出指定配置保留的所有版本记录，最新的在前"""
+        validate_config_name(config_name)
+        rows = self._connection().execute(
+            'SELECT * FROM versions WHERE name = ? ORDER BY version DESC',
+            (config_name,)
+        ).fetchall()
+        return [self._row_to_version(row) for row in rows]
+
+    def record_integrity(self, config_name: str, version: int, integrity: Dict[str, Any]) -> None:
+        """校验结果写入配置表，新版本写入时清空"""
+        with self._transaction() as conn:
+            conn.execute(
+                'UPDATE configs SET integrity = ? WHERE name = ? AND version = ?',
+                (json_encode(integrity).decode('utf-8'), config_name, version)
+            )
+
+    def get_version(self, config_name: str, version: int) -> Optional[Dict[str, Any]]:
+        """按主键查询指定配置的某个版本记录"""
+        validate_config_name(config_name)
+        row = self._connection().execute(
+            'SELECT * FROM versions WHERE name = ? AND version = ?',
+            (config_name, version)
+        ).fetchone()
+        return self._row_to_version(row) if row else None
+
+    def storage_stats(self) -> Tuple[int, int]:
+        """统计配置数量和落盘字节数"""
+        row = self._connection().execute(
+            'SELECT COUNT(*), COALESCE(SUM(stored_size), 0) FROM configs'
+        ).fetchone()
+        return row[0], row[1]
+
+    def count_configs(self) -> int:
+        """统计配置数量"""
+        return self._connection().execute('SELECT COUNT(*) FROM configs').fetchone()[0]
+
+    def find_blob(self, blob_hash: str) -> Optional[Tuple[str, int]]:
+        """查找备份或数据块，返回 (编码, 落盘大小)"""
+        row = self._connection().execute(
+            'SELECT encoding, length(data) AS stored_size FROM blobs WHERE hash = ?',
+            (blob_hash,)
+        ).fetchone()
+        return (row['encoding'], row['stored_size']) if row else None
+
+    def _touch_blob(self, blob_hash: str) -> Optional[Tuple[str, int]]:
+        """备份内容已存在时刷新回收时间，返回 (编码, 落盘大小)"""
+        with self._transaction() as conn:
+            row = conn.execute(
+                'SELECT encoding, length(data) AS stored_size FROM blobs WHERE hash = ?',
+                (blob_hash,)
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute('UPDATE blobs SET touched_at = ? WHERE hash = ?', (time.time(), blob_hash))
+            return row['encoding'], row['stored_size']
+
+    def _put_blob(self, staged: StagedBlob) -> None:
+        """把临时文件分块复制进 blobs 表（增量 BLOB I/O，不把整个备份读入内存）"""
+        with self._transaction() as conn:
+            row = conn.execute('SELECT rowid FROM blobs WHERE hash = ?', (staged.hash,)).fetchone()
+            if row is not None:
+                conn.execute('UPDATE blobs SET touched_at = ? WHERE rowid = ?', (time.time(), row[0]))
+                return
+
+            if not self.BLOB_IO:
+                with open(staged.path, 'rb') as f:
+                    conn.execute(
+                        'INSERT INTO blobs (hash, encoding, data, touched_at) VALUES (?, ?, ?, ?)',
+                        (staged.hash, staged.encoding, f.read(), time.time())
+                    )
+                return
+
+            cursor = conn.execute(
+                'INSERT INTO blobs (hash, encoding, data, touched_at) VALUES (?, ?, zeroblob(?), ?)',
+                (staged.hash, staged.encoding, staged.stored_size, time.time())
+            )
+            with conn.blobopen('blobs', 'data', cursor.lastrowid) as blob, open(staged.path, 'rb') as f:
+                while True:
+                    chunk = f.read(1024 * 1024)
+                    if not chunk:
+                        break
+                    blob.write(chunk)
+
+    def open_blob(self, blob_hash: str, encoding: str) -> Tuple[BinaryIO, int]:
+        """以增量 BLOB 句柄打开落盘的备份内容
+
+        每个句柄使用独立连接：同一连接上对该行的任何修改（如刷新回收时间）都会使句柄失效。
+        不支持增量 BLOB I/O 时把内容整块读入内存。
+        """
+        if not self.BLOB_IO:
+            row = self._connection().execute('SELECT data FROM blobs WHERE hash = ?', (blob_hash,)).fetchone()
+            if row is None:
+                raise FileNotFoundError(f'Backup blob {blob_hash} does not exist')
+            return io.BytesIO(row[0]), len(row[0])
+
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None, check_same_thread=False)
+        try:
+            row = conn.execute('SELECT rowid FROM blobs WHERE hash = ?', (blob_hash,)).fetchone()
+            if row is None:
+                raise FileNotFoundError(f'Backup blob {blob_hash} does not exist')
+            reader = _SQLiteBlobReader(conn, conn.blobopen('blobs', 'data', row[0], readonly=True))
+        except BaseException:
+            conn.close()
+            raise
+        return reader, len(reader.blob)
+
+    def load_data(self, config_name: str) -> Dict[str, Any]:
+        """加载配置记录（设备信息、ETag 等，不包含备份内容）"""
+        validate_config_name(config_name)
+        row = self._connection().execute(
+            'SELECT * FROM configs WHERE name = ?',
+            (config_name,)
+        ).fetchone()
+        if row is None:
+            return empty_config(config_name)
+
+        return {
+            'config_name': row['name'],
+            'last_updated': row['last_updated'],
+            'device_info': json_decode(row['device_info']),
+            'etag': row['etag'],
+            'hash': row['hash'],
+            'version': row['version'],
+            'size': row['size'],
+            'stored_size': row['stored_size'],
+            'encoding': row['encoding'],
+            'backup': json_decode(row['backup']),
+        }
+
+    def save_data(
+        self,
+        config_name: str,
+        data: Dict[str, Any],
+        device_id: Optional[str] = None,
+        staged: Optional[StagedBlob] = None,
+        manifest: Optional[Dict[str, Any]] = None
+    ) -> None:
+        """在一个事务中保存配置记录和新版本，并删除超出保留数量的旧版本"""
+        validate_config_name(config_name)
+        data['last_updated'] = update_timestamp(data)
+        data['config_name'] = config_name
+
+        encrypted_data = data.pop('encrypted_data', None)
+        record = None
+        if manifest is not None or staged is not None or encrypted_data is not None:
+            blob = backup_bytes(encrypted_data) if encrypted_data is not None else None
+            record = self._new_version(data, device_id, blob=blob, staged=staged, manifest=manifest)
+
+        device_info = data.get('device_info', {})
+        with self._transaction() as conn:
+            conn.execute(
+                """
+                INSERT INTO configs (name, last_updated, device_info, devices, etag, hash, version,
+                                     size, stored_size, encoding, backup)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (name) DO UPDATE SET
+                    last_updated = excluded.last_updated,
+                    device_info = excluded.device_info,
+                    devices = excluded.devices,
+                    etag = excluded.etag,
+                    hash = excluded.hash,
+                    version = excluded.version,
+                    size = excluded.size,
+                    stored_size = excluded.stored_size,
+                    encoding = excluded.encoding,
+                    backup = excluded.backup,
+                    integrity = NULL
+                """,
+                (
+                    config_name,
+                    data['last_updated'],
+                    json_encode(device_info).decode('utf-8'),
+                    json_encode(list(device_info.keys())).decode('utf-8'),
+                    data.get('etag'),
+                    data.get('hash'),
+                    data.get('version'),
+                    data.get('size', 0),
+                    data.get('stored_size', 0),
+                    data.get('encoding', 'identity'),
+                    json_encode(data.get('backup') or {}).decode('utf-8'),
+                )
+            )
+            if record is not None:
+                conn.execute(
+                    'INSERT OR REPLACE INTO versions (name, version, hash, etag, size, stored_size, encoding, '
+                    'backup, stored_at, device_id, chunks) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (
+                        config_name, record['version'], record['hash'], record['etag'], record['size'],
+                        record['stored_size'], record['encoding'],
+                        json_encode(record['backup']).decode('utf-8'),
+                        record['stored_at'], record['device_id'],
+                        json_encode(record['chunks']).decode('utf-8') if 'chunks' in record else None,
+                    )
+                )
+                # 分块引用单独建表，垃圾回收可以按索引判断数据块是否仍被引用
+                conn.executemany(
+                    'INSERT OR IGNORE INTO version_chunks (name, version, hash) VALUES (?, ?, ?)',
+                    [(config_name, record['version'], chunk[0]) for chunk in record.get('chunks', [])]
+                )
+                for table in ('versions', 'version_chunks'):
+                    conn.execute(
+                        f'DELETE FROM {table} WHERE name = ? AND version <= ?',
+                        (config_name, record['version'] - self.max_versions)
+                    )
+
+    def clear_config(self, config_name: str) -> None:
+        """删除指定配置的记录和版本（备份内容由垃圾回收清理）"""
+        validate_config_name(config_name)
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM version_chunks WHERE name = ?', (config_name,))
+            conn.execute('DELETE FROM versions WHERE name = ?', (config_name,))
+            conn.execute('DELETE FROM configs WHERE name = ?', (config_name,))
+
+    def clear_all(self) -> None:
+        """删除所有配置记录和版本，把备份表整表重命名为回收表并换上空表（备份内容由后台任务删除）"""
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM version_chunks')
+            conn.execute('DELETE FROM versions')
+            conn.execute('DELETE FROM configs')
+            conn.execute(f'ALTER TABLE blobs RENAME TO {self.TRASH_TABLE_PREFIX}{time.time_ns()}')
+            # 索引名随表保留，删除后才能为新表重建
+            conn.execute('DROP INDEX idx_blobs_touched_at')
+            for statement in self.BLOBS_SCHEMA:
+                conn.execute(statement)
+
+    def purge_trash(self, max_bytes: int) -> int:
+        """从最早的回收表中分批删除备份，删空后删除该表；没有回收表时清理回收目录"""
+        row = self._connection().execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE ? ORDER BY name LIMIT 1",
+            (self.TRASH_TABLE_PREFIX + '%',)
+        ).fetchone()
+        if row is None:
+            return super().purge_trash(max_bytes)
+
+        table = row['name']
+        with self._transaction() as conn:
+            rows = conn.execute(
+                f'SELECT rowid, length(data) AS size FROM {table} LIMIT ?', (self.PURGE_BATCH_SIZE,)
+            ).fetchall()
+            if not rows:
+                conn.execute(f'DROP TABLE {table}')
+                return self.PURGE_FILE_COST
+            freed = 0
+            rowids = []
+            for item in rows:
+                rowids.append(item['rowid'])
+                freed += max(item['size'], self.PURGE_FILE_COST)
+                if freed >= max_bytes:
+                    break
+            conn.execute(
+                f'DELETE FROM {table} WHERE rowid IN ({",".join("?" * len(rowids))})', rowids
+            )
+        return freed
+
+    def list_configs(self) -> List[str]:
+        """按名称顺序列出所有配置"""
+        rows = self._connection().execute('SELECT name FROM configs ORDER BY name').fetchall()
+        return [row['name'] for row in rows]
+
+    def collect_garbage(self, grace_seconds: float = GC_GRACE_SECONDS, batch_size: int = GC_BATCH_SIZE) -> int:
+        """每次最多删除 batch_size 个未被引用且超过宽限期的备份"""
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                """
+                DELETE FROM blobs WHERE hash IN (
+                    SELECT b.hash FROM blobs b
+                    WHERE b.touched_at < ?
+                      AND NOT EXISTS (SELECT 1 FROM versions v WHERE v.hash = b.hash)
+                      AND NOT EXISTS (SELECT 1 FROM version_chunks c WHERE c.hash = b.hash)
+                    LIMIT ?
+                )
+                """,
+                (time.time() - grace_seconds, batch_size)
+            )
+            return cursor.rowcount
+
+    def close(self) -> None:
+        """关闭线程池和所有数据库连接"""
+        super().close()
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
+
+
+class _SQLiteBlobReader(io.RawIOBase):
+    """只读的增量 BLOB 文件对象，关闭时同时关闭其专用连接"""
+
+    def __init__(self, conn: sqlite3.Connection, blob: 'sqlite3.Blob'):
+        super().__init__()
+        self.conn = conn
+        self.blob = blob
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        data = self.blob.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def read(self, size: int = -1) -> bytes:
+        return self.blob.read(size)
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        self.blob.seek(offset, whence)
+        return self.blob.tell()
+
+    def tell(self) -> int:
+        return self.blob.tell()
+
+    def close(self) -> None:
+        if not self.closed:
+            self.blob.close()
+            self.conn.close()
+        super().close()
+
+
+class _SQLiteTransaction:
+    """BEGIN IMMEDIATE 写事务：正常退出时提交，异常时回滚"""
+
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+
+    def __enter__(self) -> sqlite3.Connection:
+        self.conn.execute('BEGIN IMMEDIATE')
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.conn.execute('ROLLBACK' if exc_type else 'COMMIT')
+
+
+class _JournalBlobReader(io.RawIOBase):
+    """日志段中一段区间的只读文件对象（读取位置相对于区间起点）"""
+
+    def __init__(self, f: BinaryIO, start: int, length: int):
+        super().__init__()
+        self.f = f
+        self.start = start
+        self.length = length
+        self.position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def read(self, size: int = -1) -> bytes:
+        remaining = self.length - self.position
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        if size <= 0:
+            return b''
+        data = os.pread(self.f.fileno(), size, self.start + self.position)
+        self.position += len(data)
+        return data
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.length
+        self.position = max(0, min(offset, self.length))
+        return self.position
+
+    def tell(self) -> int:
+        return self.position
+
+    def close(self) -> None:
+        if not self.closed:
+            self.f.close()
+        super().close()
+
+
+class JournalDataStore(DataStore):
+    """追加写日志存储：所有写入顺序追加到日志段，并发请求的 fsync 合并为一次（组提交）
+
+    - ``journal/<序号>.log``：日志段，依次追加备份内容、配置记录（紧凑 JSON）和清除标记，
+      每条记录带递增序号和 CRC32；写满 JOURNAL_SEGMENT_SIZE 后 fsync 并切换到新段
+    - 内存中保存每个配置的最新记录和每个备份所在的位置，以及元数据索引；
+      启动时顺序扫描所有日志段重建，最新段末尾写了一半的记录会被截掉
+    - 垃圾回收先丢弃未被引用且超过宽限期的备份，再挑一个有效数据比例低于
+      JOURNAL_COMPACT_RATIO 的已封存日志段，把其中仍有效的记录复制到最新段后删除该段
+
+    索引只保存在本进程内存中，不支持多个工作进程共享数据目录。
+    """
+
+    backend = 'journal'
+    # 临时文件会被复制进日志段，由日志的 fsync 保证持久化
+    stage_durable = False
+    JOURNAL_DIRNAME = 'journal'
+    HEADER = struct.Struct('<4sBHQQI')  # magic、类型、键长度、序号、内容长度、CRC32（键 + 内容）
+    MAGIC = b'VSJ1'
+    BLOB, CONFIG, CLEAR = 1, 2, 3
+
+    def __init__(
+        self,
+        data_dir: str,
+        max_workers: int = STORAGE_WORKERS,
+        compression: str = STORAGE_COMPRESSION,
+        max_versions: int = MAX_VERSIONS,
+        shared: bool = False,
+        cache_size: int = int(CACHE_MAX_MB * 1024 * 1024),
+        segment_size: int = JOURNAL_SEGMENT_SIZE
+    ):
+        if shared:
+            raise ValueError('The journal storage backend does not support multiple workers')
+        super().__init__(data_dir, max_workers, compression, max_versions, shared, cache_size)
+        self.journal_dir = os.path.join(data_dir, self.JOURNAL_DIRNAME)
+        os.makedirs(self.journal_dir, exist_ok=True)
+        self.segment_size = segment_size
+        self._index = MetadataIndex()
+
+        # 记录位置均为 (段序号, 记录起点, 记录长度, 内容起点)
+        self._configs: Dict[str, Tuple[int, int, int, int]] = {}
+        self._tombstones: Dict[str, Tuple[int, int, int, int]] = {}
+        self._blobs: Dict[str, Tuple[str, Tuple[int, int, int, int]]] = {}
+        self._blob_touched: Dict[str, float] = {}
+        # 已追加、尚未提交的配置记录：压缩时不能搬动这些配置
+        self._pending: set = set()
+        # 每个日志段的文件描述符（读写共用）、大小和仍有效的字节数
+        self._segments: Dict[int, int] = {}
+        self._segment_sizes: Dict[int, int] = {}
+        self._segment_live: Dict[int, int] = {}
+        self._active = 0
+        self._seq = 0
+        # _lock 保护内存索引和段表；_write_lock 串行化追加；_commit_cond 协调组提交
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._commit_cond = threading.Condition()
+        self._synced: Tuple[int, int] = (0, 0)
+        self._syncing = False
+
+        self._remove_stale_temp_files()
+        self._recover()
+
+    def _segment_path(self, segment: int) -> str:
+        return os.path.join(self.journal_dir, f'{segment:08d}.log')
+
+    def _remove_stale_temp_files(self) -> None:
+        """清理上次异常退出时遗留的上传临时文件"""
+        for filename in os.listdir(self.data_dir):
+            if filename.startswith('.upload-') and filename.endswith('.tmp'):
+                try:
+                    os.remove(os.path.join(self.data_dir, filename))
+                except OSError:
+                    pass
+
+    def _read_header(self, fd: int, offset: int, size: int) -> Optional[Tuple[int, bytes, int, int, int]]:
+        """读取 offset 处的记录头和键，返回 (类型, 键, 序号, 内容长度, CRC)；不完整或损坏时返回 None"""
+        header = os.pread(fd, self.HEADER.size, offset)
+        if len(header) < self.HEADER.size:
+            return None
+        magic, record_type, key_length, seq, length, crc = self.HEADER.unpack(header)
+        if magic != self.MAGIC or offset + self.HEADER.size + key_length + length > size:
+            return None
+        key = os.pread(fd, key_length, offset + self.HEADER.size)
+        return record_type, key, seq, length, crc
+
+    def _record_crc(self, fd: int, key: bytes, start: int, length: int) -> int:
+        crc = zlib.crc32(key)
+        end = start + length
+        while start < end:
+            data = os.pread(fd, min(1024 * 1024, end - start), start)
+            if not data:
+                break
+            crc = zlib.crc32(data, crc)
+            start += len(data)
+        return crc
+
+    def _recover(self) -> None:
+        """按顺序扫描所有日志段，重建内存索引
+
+        同一配置以序号最大的记录为准（压缩会把记录连同原序号复制到新段）。
+        已封存的段在切换时已经 fsync，只校验配置记录；最新段的所有记录都校验 CRC，
+        从第一条不完整或损坏的记录处截断。
+        """
+        segments = sorted(
+            int(filename[:-4]) for filename in os.listdir(self.journal_dir)
+            if filename.endswith('.log') and filename[:-4].isdigit()
+        )
+        winners: Dict[str, Tuple[int, int, Tuple[int, int, int, int]]] = {}
+        now = time.time()
+
+        for segment in segments:
+            fd = os.open(self._segment_path(segment), os.O_RDWR)
+            size = os.fstat(fd).st_size
+            last = segment == segments[-1]
+            self._segments[segment] = fd
+            self._segment_live[segment] = 0
+            offset = 0
+            while offset < size:
+                parsed = self._read_header(fd, offset, size)
+                if parsed is None:
+                    break
+                record_type, key, seq, length, crc = parsed
+                data_offset = offset + self.HEADER.size + len(key)
+                if (last or record_type != self.BLOB) and self._record_crc(fd, key, data_offset, length) != crc:
+                    break
+                location = (segment, offset, data_offset + length - offset, data_offset)
+                self._seq = max(self._seq, seq)
+
+                if record_type == self.BLOB:
+                    blob_hash, encoding = key.decode('utf-8').split('.', 1)
+                    previous = self._blobs.get(blob_hash)
+                    if previous is not None:
+                        self._account(previous[1], -1)
+                    self._blobs[blob_hash] = (encoding, location)
+                    self._blob_touched[blob_hash] = now
+                    self._account(location, 1)
+                elif record_type in (self.CONFIG, self.CLEAR):
+                    name = key.decode('utf-8')
+                    previous = winners.get(name)
+                    if previous is None or seq > previous[0]:
+                        if previous is not None:
+                            self._account(previous[2], -1)
+                        winners[name] = (seq, record_type, location)
+                        self._account(location, 1)
+                offset = location[1] + location[2]
+
+            if offset < size:
+                if last:
+                    log_event(logging.WARNING, '日志末尾有不完整的记录，已截断', event='journal_recover',
+                              segment=segment, offset=offset, size=size)
+                    os.ftruncate(fd, offset)
+                    os.fsync(fd)
+                else:
+                    log_event(logging.WARNING, '已封存的日志段有损坏的记录，忽略之后的内容', event='journal_recover',
+                              segment=segment, offset=offset, size=size)
+            self._segment_sizes[segment] = offset
+
+        index = {}
+        for name, (_, record_type, location) in winners.items():
+            if record_type == self.CLEAR:
+                self._tombstones[name] = location
+                continue
+            data = json_decode(self._read_data(location))
+            self._configs[name] = location
+            index[name] = metadata_from_config(name, data)
+        self._index.replace(index)
+
+        if segments:
+            self._active = segments[-1]
+        else:
+            self._open_segment(1)
+        self._synced = (self._active, self._segment_sizes[self._active])
+
+    def _account(self, location: Tuple[int, int, int, int], sign: int) -> None:
+        """记录变为有效（sign=1）或失效（sign=-1）时更新所在段的有效字节数"""
+        segment, _, length, _ = location
+        if segment in self._segment_live:
+            self._segment_live[segment] += sign * length
+
+    def _open_segment(self, segment: int) -> None:
+        fd = os.open(self._segment_path(segment), os.O_RDWR | os.O_CREAT, 0o600)
+        fsync_directory(self.journal_dir)
+        with self._lock:
+            self._segments[segment] = fd
+            self._segment_sizes[segment] = 0
+            self._segment_live[segment] = 0
+            self._active = segment
+
+    def _rotate(self) -> None:
+        """封存写满的段：fsync 后切换到新段（调用方持有 _write_lock）"""
+        sealed = self._active
+        os.fsync(self._segments[sealed])
+        with self._commit_cond:
+            self._synced = max(self._synced, (sealed, self._segment_sizes[sealed]))
+            self._commit_cond.notify_all()
+        self._open_segment(sealed + 1)
+
+    def _append(self, record_type: int, key: str, data: Optional[bytes] = None,
+                path: Optional[str] = None, seq: Optional[int] = None) -> Tuple[int, int, int, int]:
+        """追加一条记录（内容来自 data 或文件 path），返回其位置；不等待落盘
+
+        记录头最后写入：进程在写入中途崩溃时，恢复时会因记录头无效而截掉这条记录。
+        调用方持有 _write_lock。
+        """
+        if self._segment_sizes[self._active] >= self.segment_size:
+            self._rotate()
+        if seq is None:
+            self._seq += 1
+            seq = self._seq
+
+        fd = self._segments[self._active]
+        offset = self._segment_sizes[self._active]
+        key_bytes = key.encode('utf-8')
+        data_offset = offset + self.HEADER.size + len(key_bytes)
+        crc = zlib.crc32(key_bytes)
+        length = 0
+        os.pwrite(fd, key_bytes, offset + self.HEADER.size)
+        if data is not None:
+            os.pwrite(fd, data, data_offset)
+            crc = zlib.crc32(data, crc)
+            length = len(data)
+        else:
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    os.pwrite(fd, chunk, data_offset + length)
+                    crc = zlib.crc32(chunk, crc)
+                    length += len(chunk)
+        os.pwrite(fd, self.HEADER.pack(self.MAGIC, record_type, len(key_bytes), seq, length, crc), offset)
+
+        with self._lock:
+            self._segment_sizes[self._active] = data_offset + length
+        return self._active, offset, data_offset + length - offset, data_offset
+
+    def _copy_record(self, location: Tuple[int, int, int, int]) -> Tuple[int, int, int, int]:
+        """把一条记录原样（包括序号）复制到最新段，供压缩使用（调用方持有 _write_lock）"""
+        if self._segment_sizes[self._active] >= self.segment_size:
+            self._rotate()
+        segment, offset, length, data_offset = location
+        source = self._segments[segment]
+        target = self._segments[self._active]
+        target_offset = self._segment_sizes[self._active]
+        copied = 0
+        while copied < length:
+            chunk = os.pread(source, min(1024 * 1024, length - copied), offset + copied)
+            if not chunk:
+                raise IOError(f'Journal segment {segment} is truncated')
+            os.pwrite(target, chunk, target_offset + copied)
+            copied += len(chunk)
+        with self._lock:
+            self._segment_sizes[self._active] = target_offset + length
+        return self._active, target_offset, length, target_offset + data_offset - offset
+
+    def _commit(self, position: Tuple[int, int]) -> None:
+        """等待 position 之前追加的记录落盘（组提交）
+
+        同一时刻只有一个线程执行 fsync；其他线程追加完记录后在这里等待，
+        下一次 fsync 会把它们一起落盘，吞吐量取决于顺序写带宽而不是 fsync 次数。
+        """
+        with self._commit_cond:
+            while self._synced < position:
+                if not self._syncing:
+                    self._syncing = True
+                    break
+                self._commit_cond.wait()
+            else:
+                JOURNAL_COMMITS.inc()
+                return
+
+        target = None
+        try:
+            with self._lock:
+                target = (self._active, self._segment_sizes[self._active])
+                fd = self._segments[self._active]
+            os.fsync(fd)
+            JOURNAL_FSYNCS.inc()
+            JOURNAL_COMMITS.inc()
+        finally:
+            with self._commit_cond:
+                self._syncing = False
+                if target is not None:
+                    self._synced = max(self._synced, target)
+                self._commit_cond.notify_all()
+
+    def _tail(self) -> Tuple[int, int]:
+        with self._write_lock:
+            return self._active, self._segment_sizes[self._active]
+
+    def _read_data(self, location: Tuple[int, int, int, int]) -> bytes:
+        segment, offset, length, data_offset = location
+        return os.pread(self._segments[segment], offset + length - data_offset, data_offset)
+
+    def get_metadata(self, config_name: str) -> Optional[Dict[str, Any]]:
+        """从元数据索引获取指定配置的元数据"""
+        return self._index.get(config_name)
+
+    def list_metadata(self, query: Optional[MetadataQuery] = None, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        """按查询条件从元数据索引列出配置"""
+        return self._index.page(query or MetadataQuery(), limit)
+
+    def list_versions(self, config_name: str) -> List[Dict[str, Any]]:
+        """列出指定配置保留的所有版本记录，最新的在前"""
+        return list(reversed(self.load_data(config_name).get('versions', [])))
+
+    def record_integrity(self, config_name: str, version: int, integrity: Dict[str, Any]) -> None:
+        """校验结果保存在内存中的元数据索引里，重启后由下一轮校验重新得出"""
+        self._index.annotate(config_name, version, {'integrity': integrity})
+
+    def storage_stats(self) -> Tuple[int, int]:
+        """从元数据索引统计配置数量和落盘字节数"""
+        return self._index.stats()
+
+    def count_configs(self) -> int:
+        """索引中的配置数量"""
+        return len(self._index)
+
+    def list_configs(self) -> List[str]:
+        """列出所有配置名称"""
+        with self._lock:
+            return list(self._configs)
+
+    def load_data(self, config_name: str) -> Dict[str, Any]:
+        """按内存索引读取配置的最新记录"""
+        validate_config_name(config_name)
+        with self._lock:
+            location = self._configs.get(config_name)
+            if location is None:
+                return empty_config(config_name)
+            content = self._read_data(location)
+        return json_decode(content)
+
+    def find_blob(self, blob_hash: str) -> Optional[Tuple[str, int]]:
+        """查找备份或数据块，返回 (编码, 落盘大小)"""
+        with self._lock:
+            entry = self._blobs.get(blob_hash)
+        if entry is None:
+            return None
+        encoding, (_, offset, length, data_offset) = entry
+        return encoding, offset + length - data_offset
+
+    def _touch_blob(self, blob_hash: str) -> Optional[Tuple[str, int]]:
+        """备份内容已存在时刷新回收时间，返回 (编码, 落盘大小)"""
+        with self._lock:
+            if blob_hash in self._blobs:
+                self._blob_touched[blob_hash] = time.time()
+        return self.find_blob(blob_hash)
+
+    def open_blob(self, blob_hash: str, encoding: str) -> Tuple[BinaryIO, int]:
+        """打开日志段中的备份内容
+
+        在 _lock 内打开所在的段文件：压缩删除旧段也在 _lock 内进行，
+        已打开的文件在段被删除后仍可读取。
+        """
+        with self._lock:
+            entry = self._blobs.get(blob_hash)
+            if entry is None or entry[0] != encoding:
+                raise FileNotFoundError(f'Blob {blob_hash}.{encoding} not found')
+            segment, offset, length, data_offset = entry[1]
+            f = open(self._segment_path(segment), 'rb')
+        size = offset + length - data_offset
+        return _JournalBlobReader(f, data_offset, size), size
+
+    def _put_blob(self, staged: StagedBlob) -> None:
+        """把临时文件追加到日志段（由之后的配置记录或数据块提交一起落盘）"""
+        with self._write_lock:
+            location = self._append(self.BLOB, f'{staged.hash}.{staged.encoding}', path=staged.path)
+            with self._lock:
+                previous = self._blobs.get(staged.hash)
+                if previous is not None:
+                    self._account(previous[1], -1)
+                self._blobs[staged.hash] = (staged.encoding, location)
+                self._blob_touched[staged.hash] = time.time()
+                self._account(location, 1)
+
+    def store_chunk(self, staged: StagedBlob) -> None:
+        """保存客户端上传的数据块并等待落盘"""
+        super().store_chunk(staged)
+        self._commit(self._tail())
+
+    def _write_record(self, config_name: str, record_type: int, data: bytes = b'') -> None:
+        """追加配置记录或清除标记，等待落盘后再更新内存索引"""
+        with self._write_lock:
+            location = self._append(record_type, config_name, data)
+            self._pending.add(config_name)
+        try:
+            self._commit((location[0], location[1] + location[2]))
+        except BaseException:
+            with self._lock:
+                self._pending.discard(config_name)
+            raise
+
+        with self._lock:
+            self._pending.discard(config_name)
+            previous = self._configs.pop(config_name, None) or self._tombstones.pop(config_name, None)
+            if previous is not None:
+                self._account(previous, -1)
+            if record_type == self.CONFIG:
+                self._configs[config_name] = location
+            else:
+                self._tombstones[config_name] = location
+            self._account(location, 1)
+
+    def save_data(
+        self,
+        config_name: str,
+        data: Dict[str, Any],
+        device_id: Optional[str] = None,
+        staged: Optional[StagedBlob] = None,
+        manifest: Optional[Dict[str, Any]] = None
+    ) -> None:
+        """把配置记录以紧凑 JSON 追加到日志（本次上传的备份内容在它之前追加），组提交后更新索引"""
+        validate_config_name(config_name)
+        data['last_updated'] = update_timestamp(data)
+        data['config_name'] = config_name
+        self._append_version(data, device_id, staged, manifest)
+
+        content = json_encode(data)
+        self._write_record(config_name, self.CONFIG, content)
+        self._index.set(config_name, metadata_from_config(config_name, data))
+
+    def clear_config(self, config_name: str) -> None:
+        """追加清除标记（备份内容由垃圾回收清理）"""
+        validate_config_name(config_name)
+        with self._lock:
+            exists = config_name in self._configs
+        if exists:
+            self._write_record(config_name, self.CLEAR)
+        self._index.remove(config_name)
+
+    def clear_all(self) -> None:
+        """把整个日志目录一次改名移入回收目录（由后台任务删除），从一个空的新段重新开始
+
+        段序号接着之前的编号，已打开的备份读取方仍可读完旧段。
+        """
+        with self._write_lock, self._commit_cond:
+            while self._syncing:
+                self._commit_cond.wait()
+            with self._lock:
+                segments = list(self._segments)
+                trash = self._new_trash_dir()
+                os.rename(self.journal_dir, os.path.join(trash, self.JOURNAL_DIRNAME))
+                os.makedirs(self.journal_dir)
+                fsync_directory(self.data_dir)
+                for segment in segments:
+                    os.close(self._segments.pop(segment))
+                self._segment_sizes.clear()
+                self._segment_live.clear()
+                self._configs.clear()
+                self._tombstones.clear()
+                self._blobs.clear()
+                self._blob_touched.clear()
+                self._index.replace({})
+            next_segment = max(segments) + 1 if segments else 1
+            self._open_segment(next_segment)
+            self._synced = (next_segment, 0)
+
+    def collect_garbage(self, grace_seconds: float = GC_GRACE_SECONDS, batch_size: int = GC_BATCH_SIZE) -> int:
+        """丢弃最多 batch_size 个未被引用且超过宽限期的备份，然后压缩一个有效数据比例最低的已封存段"""
+        referenced = self._index.referenced_hashes()
+        if referenced is None:
+            return 0
+
+        cutoff = time.time() - grace_seconds
+        removed = 0
+        with self._lock:
+            for blob_hash in list(self._blobs):
+                if blob_hash in referenced or self._blob_touched.get(blob_hash, 0) >= cutoff:
+                    continue
+                _, location = self._blobs.pop(blob_hash)
+                self._blob_touched.pop(blob_hash, None)
+                self._account(location, -1)
+                removed += 1
+                if removed >= batch_size:
+                    break
+
+            candidates = [
+                (self._segment_live[segment] / max(self._segment_sizes[segment], 1), segment)
+                for segment in self._segments if segment != self._active
+            ]
+        candidates = [c for c in candidates if c[0] < JOURNAL_COMPACT_RATIO]
+        if candidates:
+            self.compact_segment(min(candidates)[1])
+        return removed
+
+    def compact_segment(self, segment: int) -> bool:
+        """把一个已封存段中仍有效的记录复制到最新段，落盘后删除该段
+
+        有配置正在提交时放弃本次压缩（下次重试），避免把旧记录复制到新记录之后。
+        清除标记只有在该段是最旧的段时才可以丢弃，否则随之复制，防止更旧的段中的记录复活。
+        """
+        with self._write_lock:
+            if segment == self._active or segment not in self._segments:
+                return False
+            with self._lock:
+                oldest = segment == min(self._segments)
+                configs = [(name, loc) for name, loc in self._configs.items() if loc[0] == segment]
+                tombstones = [(name, loc) for name, loc in self._tombstones.items() if loc[0] == segment]
+                blobs = [(h, entry) for h, entry in self._blobs.items() if entry[1][0] == segment]
+                if any(name in self._pending for name, _ in configs + tombstones):
+                    return False
+
+            moved = {}
+            for name, location in configs + ([] if oldest else tombstones):
+                moved[name] = self._copy_record(location)
+            moved_blobs = {h: (encoding, self._copy_record(location)) for h, (encoding, location) in blobs}
+            tail = (self._active, self._segment_sizes[self._active])
+
+        self._commit(tail)
+
+        with self._commit_cond:
+            while self._syncing:
+                self._commit_cond.wait()
+            with self._lock:
+                for name, location in moved.items():
+                    table = self._configs if name in self._configs else self._tombstones
+                    if table.get(name, (None,))[0] == segment:
+                        table[name] = location
+                        self._account(location, 1)
+                if oldest:
+                    for name, _ in tombstones:
+                        if self._tombstones.get(name, (None,))[0] == segment:
+                            del self._tombstones[name]
+                for blob_hash, (encoding, location) in moved_blobs.items():
+                    current = self._blobs.get(blob_hash)
+                    if current is not None and current[1][0] == segment:
+                        self._blobs[blob_hash] = (encoding, location)
+                        self._account(location, 1)
+                os.close(self._segments.pop(segment))
+                self._segment_sizes.pop(segment)
+                self._segment_live.pop(segment)
+                os.remove(self._segment_path(segment))
+        JOURNAL_COMPACTIONS.inc()
+        log_event(logging.INFO, '日志段已压缩', event='journal_compact', segment=segment,
+                  configs=len(configs), blobs=len(blobs))
+        return True
+
+    def close(self) -> None:
+        """关闭存储线程池和所有日志段"""
+        super().close()
+        with self._lock:
+            for fd in self._segments.values():
+                os.close(fd)
+            self._segments.clear()
+
+
+STORAGE_BACKENDS = {
+    FileDataStore.backend: FileDataStore,
+    SQLiteDataStore.backend: SQLiteDataStore,
+    JournalDataStore.backend: JournalDataStore,
+}
+
+
+def create_data_store(
+    backend: str,
+    data_dir: str,
+    max_workers: int = STORAGE_WORKERS,
+    compression: str = STORAGE_COMPRESSION,
+    max_versions: int = MAX_VERSIONS,
+    shared: bool = False,
+    cache_size: int = int(CACHE_MAX_MB * 1024 * 1024)
+) -> DataStore:
+    """按后端名称创建数据存储实例，并对照已有数据补齐复制变更流
+
+    ``shared=True``（多个工作进程共享数据目录）时，各进程依次初始化，
+    避免同时迁移旧数据或建表。
+    """
+    if backend not in STORAGE_BACKENDS:
+        raise ValueError(
+            f"Unknown storage backend: {backend} (available: {', '.join(STORAGE_BACKENDS)})"
+        )
+    if not shared:
+        store = STORAGE_BACKENDS[backend](data_dir, max_workers, compression, max_versions, cache_size=cache_size)
+        store.reconcile_feed()
+        return store
+
+    lock_dir = os.path.join(data_dir, '.locks')
+    os.makedirs(lock_dir, exist_ok=True)
+    startup_lock = InterProcessLock(os.path.join(lock_dir, 'startup.lock'))
+    try:
+        with startup_lock:
+            store = STORAGE_BACKENDS[backend](data_dir, max_workers, compression, max_versions, True, cache_size)
+            store.reconcile_feed()
+            return store
+    finally:
+        startup_lock.close()
+
+
+class ChangeNotifier:
+    """配置变更通知
+
+    每个订阅者持有一个小的 asyncio 队列，空闲连接只占用一个队列对象，
+    不轮询存储。队列满时丢弃最旧的事件：客户端只关心最新版本。
+    """
+
+    def __init__(self, queue_size: int = 16):
+        self.queue_size = queue_size
+        self._subscribers: Dict[str, set] = {}
+
+    def subscribe(self, config_name: str) -> asyncio.Queue:
+        """订阅指定配置的变更事件"""
+        queue: asyncio.Queue = asyncio.Queue(self.queue_size)
+        self._subscribers.setdefault(config_name, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, config_name: str, queue: asyncio.Queue) -> None:
+        """取消订阅"""
+        queues = self._subscribers.get(config_name)
+        if queues is not None:
+            queues.discard(queue)
+            if not queues:
+                del self._subscribers[config_name]
+
+    def publish(self, config_name: str, event: Dict[str, Any]) -> None:
+        """向指定配置的所有订阅者推送事件（需在事件循环中调用）"""
+        for queue in self._subscribers.get(config_name, ()):
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(event)
+
+    def configs(self) -> List[str]:
+        """当前有订阅者的配置名称"""
+        return list(self._subscribers)
+
+    def subscriber_count(self) -> int:
+        """当前订阅连接数"""
+        return sum(len(queues) for queues in self._subscribers.values())
+
+
+def change_event(config_name: str, metadata: Optional[Dict[str, Any]], device_id: Optional[str] = None) -> Dict[str, Any]:
+    """由配置元数据构造变更事件，配置已清除时 metadata 为 None"""
+    metadata = metadata or {}
+    return {
+        'config_name': config_name,
+        'version': metadata.get('version'),
+        'etag': metadata.get('etag'),
+        'last_updated': metadata.get('last_updated'),
+        'has_data': bool(metadata.get('has_data')),
+        'device_id': device_id,
+    }
+
+
+async def watch_changes(interval: float = CHANGE_POLL_INTERVAL) -> None:
+    """后台任务：读取共享变更日志，把其他工作进程的上传和清除推送给本进程的订阅者"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            for entry in await data_store.poll_changes_async():
+                config_name = entry.get('config')
+                if config_name is None:
+                    for subscribed in change_notifier.configs():
+                        change_notifier.publish(subscribed, change_event(subscribed, None))
+                else:
+                    metadata = await data_store.get_metadata_async(config_name)
+                    change_notifier.publish(config_name, change_event(config_name, metadata, entry.get('device_id')))
+        except Exception as e:
+            log_event(logging.WARNING, '读取变更日志失败', event='changelog', error=str(e))
+
+
+class UpstreamClient:
+    """副本访问主服务器的 HTTP 客户端：标准库 http.client，阻塞请求在专用线程池中执行
+
+    每个线程复用一个 keep-alive 连接，复用的连接已被对方关闭时换新连接重试一次（只发送 GET）。
+    主服务器地址中带 ``user:password@`` 时使用 Basic 认证，否则使用 Bearer 令牌。
+    close 时关闭所有连接，正在长轮询的请求立即返回。
+    """
+
+    def __init__(self, url: str, token: Optional[str] = None, timeout: float = REPLICA_POLL_WAIT + 30,
+                 max_workers: int = REPLICA_CONCURRENCY):
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ('http', 'https') or not parts.hostname:
+            raise ValueError(f'Invalid upstream URL: {url}')
+        self._connection_class = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+        self._host, self._port = parts.hostname, parts.port
+        self._base_path = parts.path.rstrip('/')
+        host = f'[{parts.hostname}]' if ':' in parts.hostname else parts.hostname
+        # 日志和状态中展示的地址，不含密码
+        self.url = f"{parts.scheme}://{host}{f':{parts.port}' if parts.port else ''}{self._base_path}"
+        self._headers = {}
+        if parts.username:
+            credentials = f'{urllib.parse.unquote(parts.username)}:{urllib.parse.unquote(parts.password or "")}'
+            self._headers['Authorization'] = 'Basic ' + base64.b64encode(credentials.encode('utf-8')).decode('ascii')
+        elif token:
+            self._headers['Authorization'] = f'Bearer {token}'
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='replica')
+        self._local = threading.local()
+        self._connections: set = set()
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def _connection(self) -> http.client.HTTPConnection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._connection_class(self._host, self._port, timeout=self.timeout)
+            with self._lock:
+                if self._closed:
+                    raise ConnectionError('Upstream client is closed')
+                self._connections.add(conn)
+            self._local.conn = conn
+        return conn
+
+    def _discard(self) -> None:
+        conn = self._local.__dict__.pop('conn', None)
+        if conn is not None:
+            conn.close()
+            with self._lock:
+                self._connections.discard(conn)
+
+    def get(self, path: str, consume: Callable[[http.client.HTTPResponse], Any],
+            headers: Optional[Dict[str, str]] = None) -> Any:
+        """发送 GET 请求，由 consume 在本线程中读完响应体并返回结果"""
+        for attempt in range(2):
+            conn = self._connection()
+            reused = conn.sock is not None
+            try:
+                conn.request('GET', self._base_path + path, headers={**self._headers, **(headers or {})})
+                response = conn.getresponse()
+            except (ConnectionError, http.client.HTTPException):
+                self._discard()
+                if reused and not attempt and not self._closed:
+                    continue
+                raise
+            except BaseException:
+                self._discard()
+                raise
+            try:
+                result = consume(response)
+                if not response.isclosed():
+                    response.read()
+            except BaseException:
+                self._discard()
+                raise
+            if response.will_close:
+                self._discard()
+            return result
+
+    async def get_async(self, path: str, consume: Callable[[http.client.HTTPResponse], Any],
+                        headers: Optional[Dict[str, str]] = None) -> Any:
+        """在客户端线程池中执行 get"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self.get, path, consume, headers)
+
+    def close(self) -> None:
+        """关闭所有连接（阻塞中的请求随即失败返回），不等待线程池中的请求结束"""
+        with self._lock:
+            self._closed = True
+            connections, self._connections = self._connections, set()
+        for conn in connections:
+            if conn.sock is not None:
+                try:
+                    conn.sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+        self._executor.shutdown(wait=False)
+
+
+def read_json_response(response: http.client.HTTPResponse) -> Any:
+    """读取 JSON 响应，非 200 时抛出 IOError（附带服务器返回的 detail）"""
+    body = response.read()
+    if response.status != 200:
+        try:
+            detail = json_decode(body).get('detail')
+        except (ValueError, AttributeError):
+            detail = body[:200].decode('utf-8', 'replace')
+        raise IOError(f'Upstream returned {response.status}: {detail}')
+    return json_decode(body)
+
+
+class Replicator:
+    """副本模式：长轮询主服务器的 /replication/changes，按批下载并应用变更
+
+    - 每批最多 REPLICATION_PAGE_SIZE 条变更（同一配置只有最新一条），并发下载对应版本的备份，
+      按主服务器的版本号、更新时间和设备信息保存；本地已是该版本的配置直接跳过，重复应用没有副作用
+    - 一批全部应用后才把 (变更流 ID, 序号) 写入 ``.replication/replica.json``，重启后从该位置继续
+    - 主服务器返回 ``reset``（首次同步、主服务器清除过全部配置或变更流 ID 变化）时完整对账：
+      应用完所有现存配置后删除本地多出的配置，对账完成前不保存同步位置
+    - 本地应用的变更同样写入本地的复制变更流，副本可以再作为其他副本的上游
+    - 多进程模式下只在一个工作进程中运行，其他进程通过共享变更日志得知更新
+    """
+
+    def __init__(self, store: DataStore, client: UpstreamClient, concurrency: int = REPLICA_CONCURRENCY):
+        self.store = store
+        self.client = client
+        self.state_path = os.path.join(store.feed.directory, 'replica.json')
+        self.feed_id: Optional[str] = None
+        self.seq = 0
+        self._semaphore = asyncio.Semaphore(concurrency)
+        # 完整对账期间看到的仍存在的配置，None 表示不在对账中
+        self._reconciling: Optional[set] = None
+        try:
+            with open(self.state_path, 'rb') as f:
+                state = json_decode(f.read())
+            if state.get('upstream') == client.url:
+                self.feed_id, self.seq = state['feed'], int(state['seq'])
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+    def _save_state(self) -> None:
+        atomic_write(self.state_path, json_encode({'upstream': self.client.url, 'feed': self.feed_id, 'seq': self.seq}))
+
+    def _download(self, response: http.client.HTTPResponse) -> Optional[StagedBlob]:
+        """把备份下载到临时文件（按 Content-Encoding 解压并计算哈希），版本已不存在（404）时返回 None"""
+        if response.status == status.HTTP_404_NOT_FOUND:
+            return None
+        if response.status != status.HTTP_200_OK:
+            read_json_response(response)
+        staged = self.store.stage_blob((response.getheader('Content-Encoding') or 'identity').strip().lower())
+        try:
+            for chunk in iter(lambda: response.read(1024 * 1024), b''):
+                staged.write(chunk)
+            staged.finish()
+        except BaseException:
+            staged.discard()
+            raise
+        return staged
+
+    async def _apply_put(self, entry: Dict[str, Any]) -> bool:
+        """下载并保存主服务器上的一个版本，本地已是该版本或它已被取代时返回 False"""
+        config_name = entry['config']
+        metadata = await self.store.get_metadata_async(config_name) or {}
+        if metadata.get('version') == entry['version'] and metadata.get('hash') == entry['hash']:
+            return False
+
+        # 主服务器原样返回落盘的压缩内容，边下载边解压校验
+        staged = await self.client.get_async(
+            f"/sync/{config_name}/versions/{entry['version']}", self._download,
+            {'Accept-Encoding': ', '.join(supported_encodings())}
+        )
+        # 版本已被新的上传或清除取代，后面会有对应的新变更
+        if staged is None:
+            return False
+        try:
+            if staged.hash != entry['hash']:
+                log_event(logging.WARNING, '副本下载的备份与变更不一致，等待下一次变更', event='replication',
+                          config=config_name, version=entry['version'])
+                return False
+            async with self.store.locked(config_name):
+                data = await self.store.load_data_async(config_name)
+                if (data.get('version') or 0) >= entry['version']:
+                    # 主服务器上该配置被清除后重新上传过，本地保留的是旧配置的历史
+                    await self.store.clear_config_async(config_name)
+                    data = empty_config(config_name)
+                data['version'] = entry['version'] - 1
+                data['device_info'] = entry.get('device_info') or {}
+                data['upstream_updated'] = entry['last_updated']
+                await self.store.save_data_async(config_name, data, entry.get('device_id'), staged)
+        finally:
+            staged.discard()
+        change_notifier.publish(
+            config_name, change_event(config_name, metadata_from_config(config_name, data), entry.get('device_id'))
+        )
+        return True
+
+    async def _apply_delete(self, config_name: str) -> bool:
+        if await self.store.get_metadata_async(config_name) is None:
+            return False
+        async with self.store.locked(config_name):
+            await self.store.clear_config_async(config_name)
+        change_notifier.publish(config_name, change_event(config_name, None))
+        return True
+
+    async def _apply(self, entry: Dict[str, Any]) -> None:
+        async with self._semaphore:
+            if entry['op'] == 'put':
+                applied = await self._apply_put(entry)
+            else:
+                applied = await self._apply_delete(entry['config'])
+        if applied:
+            REPLICATION_APPLIED.inc(1, entry['op'])
+
+    async def pull_batch(self, wait: float = 0) -> bool:
+        """拉取并应用一批变更，返回主服务器上是否还有未拉取的变更"""
+        position = (self.feed_id, self.seq)
+        params = {'since': self.seq, 'limit': REPLICATION_PAGE_SIZE, 'wait': wait}
+        if self.feed_id:
+            params['feed'] = self.feed_id
+        page = await self.client.get_async('/replication/changes?' + urllib.parse.urlencode(params), read_json_response)
+        if page['reset']:
+            log_event(logging.INFO, '副本开始与主服务器完整对账', event='replication', upstream=self.client.url)
+            self.feed_id = page['feed']
+            self._reconciling = set()
+
+        await asyncio.gather(*(self._apply(entry) for entry in page['changes']))
+        self.seq = page['next']
+        REPLICATION_LAG.set(page['last_seq'] - self.seq)
+
+        if self._reconciling is not None:
+            for entry in page['changes']:
+                if entry['op'] == 'put':
+                    self._reconciling.add(entry['config'])
+                else:
+                    self._reconciling.discard(entry['config'])
+            if page['more']:
+                return True
+            stale = [
+                metadata['name'] for metadata in await self.store.list_metadata_async()
+                if metadata['name'] not in self._reconciling
+            ]
+            for config_name in stale:
+                if await self._apply_delete(config_name):
+                    REPLICATION_APPLIED.inc(1, 'delete')
+            self._reconciling = None
+            position = None
+            log_event(logging.INFO, '副本完整对账完成', event='replication', upstream=self.client.url,
+                      seq=self.seq, removed=len(stale))
+
+        if (self.feed_id, self.seq) != position:
+            await run_in_threadpool(self._save_state)
+        return page['more']
+
+    async def run(self, interval: float = REPLICA_RETRY_SECONDS) -> None:
+        """后台同步任务：有积压时连续拉取，追上后长轮询等待新变更；失败时间隔 interval 秒重试"""
+        more = True
+        while True:
+            if not self.store.is_leader():
+                await asyncio.sleep(interval)
+                continue
+            try:
+                more = await self.pull_batch(0 if more else REPLICA_POLL_WAIT)
+            except Exception as e:
+                log_event(logging.WARNING, '副本同步失败', event='replication', upstream=self.client.url, error=str(e))
+                more = True
+                await asyncio.sleep(interval)
+
+    def close(self) -> None:
+        self.client.close()
+
+
+# 数据存储、变更通知和副本同步在 lifespan 中由 open_data_store 创建：
+# 导入本模块不会创建数据目录，`python sync_server.py` 再由 uvicorn 导入一次时也只打开一个存储
+data_store: Optional[DataStore] = None
+change_notifier: Optional[ChangeNotifier] = None
+replicator: Optional[Replicator] = None
+
+
+def open_data_store(
+    backend: str = STORAGE_BACKEND,
+    data_dir: str = DATA_DIR,
+    max_workers: int = STORAGE_WORKERS
+) -> DataStore:
+    """创建数据存储、变更通知和（副本模式下的）副本同步，并设为本模块的全局实例"""
+    global data_store, change_notifier, replicator
+    data_store = create_data_store(
+        backend, data_dir, max_workers, STORAGE_COMPRESSION, MAX_VERSIONS, shared=WORKERS > 1
+    )
+    change_notifier = ChangeNotifier()
+    # 副本模式：从主服务器同步，只提供读取
+    replicator = Replicator(data_store, UpstreamClient(REPLICA_OF, REPLICA_TOKEN)) if REPLICA_OF else None
+    return data_store
+
+
+def close_data_store() -> None:
+    """关闭 open_data_store 创建的实例"""
+    global data_store, change_notifier, replicator
+    if replicator is not None:
+        replicator.close()
+    if data_store is not None:
+        data_store.close()
+    data_store = change_notifier = replicator = None
+
+
+def hash_token(token: str) -> str:
+    """令牌的 SHA-256 摘要，令牌表只保存和比较摘要"""
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+def secret_equals(a: Optional[str], b: Optional[str]) -> bool:
+    """常数时间比较两个密钥，避免按前缀逐字节猜测"""
+    if a is None or b is None:
+        return False
+    return hmac.compare_digest(a.encode('utf-8'), b.encode('utf-8'))
+
+
+class TokenPrincipal:
+    """令牌文件中的一个用户：名称和允许访问的配置
+
+    ``configs`` 中的每一项是精确的配置名，或以 ``*`` 结尾的前缀；单独的 ``*`` 表示全部配置。
+    """
+
+    __slots__ = ('name', 'names', 'prefixes', 'all_configs')
+
+    def __init__(self, name: str, configs: List[str]):
+        self.name = name
+        self.names = frozenset(c for c in configs if not c.endswith('*'))
+        self.prefixes = tuple(c[:-1] for c in configs if c.endswith('*'))
+        self.all_configs = '' in self.prefixes
+
+    def allows(self, config_name: str) -> bool:
+        """是否可以访问指定配置"""
+        return self.all_configs or config_name in self.names or config_name.startswith(self.prefixes)
+
+
+class TokenStore:
+    """从 JSON 令牌文件加载的多用户令牌表，按令牌的 SHA-256 摘要做 O(1) 查找
+
+    文件格式::
+
+        {"tokens": [
+            {"name": "alice", "token_sha256": "<64 位十六进制>", "configs": ["alice", "alice-*"]},
+            {"name": "ops", "token": "<明文令牌>", "configs": ["*"]}
+        ]}
+
+    - 查找先对请求中的令牌做 SHA-256，再以摘要查表，耗时与令牌表大小和令牌内容无关
+    - 每隔 reload_interval 秒检查一次文件的 mtime / 大小 / inode，变化时重新加载，无需重启；
+      新文件格式错误时记录警告并继续使用旧的令牌表
+    - 多进程模式下每个工作进程各自检查文件，修改后所有进程都会在 reload_interval 内生效
+    """
+
+    def __init__(self, path: str, reload_interval: float = TOKEN_RELOAD_INTERVAL):
+        self.path = path
+        self.reload_interval = reload_interval
+        self._tokens: Dict[str, TokenPrincipal] = {}
+        self._signature: Optional[Tuple[int, int, int]] = None
+        self._checked_at = time.monotonic()
+        # 启动时加载失败直接报错，而不是以空令牌表拒绝所有请求
+        self._tokens = self._load(self._stat())
+
+    def __len__(self) -> int:
+        return len(self._tokens)
+
+    def _stat(self) -> Tuple[int, int, int]:
+        st = os.stat(self.path)
+        return st.st_mtime_ns, st.st_size, st.st_ino
+
+    def _load(self, signature: Tuple[int, int, int]) -> Dict[str, TokenPrincipal]:
+        """解析令牌文件，返回 摘要 -> 用户 的映射"""
+        with open(self.path, 'rb') as f:
+            document = json_decode(f.read())
+        entries = document.get('tokens') if isinstance(document, dict) else None
+        if not isinstance(entries, list):
+            raise ValueError('Token file must contain a "tokens" list')
+
+        tokens: Dict[str, TokenPrincipal] = {}
+        for i, entry in enumerate(entries):
+            if not isinstance(entry, dict) or not isinstance(entry.get('name'), str) or not entry['name']:
+                raise ValueError(f'Token entry {i} must have a name')
+            configs = entry.get('configs')
+            if not isinstance(configs, list) or not all(isinstance(c, str) and c for c in configs):
+                raise ValueError(f'Token entry "{entry["name"]}" must have a list of configs')
+
+            if isinstance(entry.get('token_sha256'), str):
+                digest = entry['token_sha256'].lower()
+                if not CHUNK_HASH_PATTERN.match(digest):
+                    raise ValueError(f'Token entry "{entry["name"]}" has an invalid token_sha256')
+            elif isinstance(entry.get('token'), str) and entry['token']:
+                digest = hash_token(entry['token'])
+            else:
+                raise ValueError(f'Token entry "{entry["name"]}" must have a token or token_sha256')
+
+            if digest in tokens:
+                raise ValueError(f'Token entry "{entry["name"]}" reuses the token of "{tokens[digest].name}"')
+            tokens[digest] = TokenPrincipal(entry['name'], configs)
+
+        self._signature = signature
+        return tokens
+
+    def maybe_reload(self) -> None:
+        """距上次检查超过 reload_interval 且文件发生变化时重新加载"""
+        now = time.monotonic()
+        if now - self._checked_at < self.reload_interval:
+            return
+        self._checked_at = now
+        try:
+            signature = self._stat()
+            if signature == self._signature:
+                return
+            tokens = self._load(signature)
+        except Exception as e:
+            log_event(logging.WARNING, '重新加载令牌文件失败，继续使用旧的令牌表', event='token_reload', error=str(e))
+            return
+        self._tokens = tokens
+        log_event(logging.INFO, '令牌文件已重新加载', event='token_reload', tokens=len(tokens))
+
+    def authenticate(self, token: str) -> Optional[TokenPrincipal]:
+        """按令牌查找用户，未知令牌返回 None"""
+        self.maybe_reload()
+        # 以摘要查表：字典比较的是摘要而不是令牌本身，耗时不会泄露令牌内容
+        return self._tokens.get(hash_token(token))
+
+
+token_store = TokenStore(TOKEN_FILE) if TOKEN_FILE else None
+
+
+def check_config_access(principal: Optional[TokenPrincipal], config_name: str) -> None:
+    """令牌无权访问指定配置时抛出 403；principal 为 None 表示不受限制"""
+    if principal is not None and not principal.allows(config_name):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail=f'Token is not allowed to access config "{config_name}"'
+        )
+
+
+def rate_limit_identity(authorization: Optional[str]) -> Optional[str]:
+    """限流使用的凭据标识：Authorization 头能通过认证时返回它的摘要，否则返回 None（按 IP 计数）
+
+    与 verify_auth 的判断一致；未通过认证的请求头不单独分配令牌桶，
+    否则每次换一个伪造的请求头就能拿到一个新的令牌桶，并挤掉正常客户端的令牌桶。
+    """
+    if not authorization:
+        return None
+    scheme, _, credentials = authorization.partition(' ')
+    scheme, credentials = scheme.lower(), credentials.strip()
+
+    verified = False
+    if scheme == 'bearer':
+        verified = (
+            (token_store is not None and token_store.authenticate(credentials) is not None)
+            or (bool(API_TOKEN) and secret_equals(credentials, API_TOKEN))
+        )
+    elif scheme == 'basic':
+        try:
+            username, _, password = base64.b64decode(credentials).decode('ascii').partition(':')
+        except ValueError:
+            return None
+        principal = token_store.authenticate(password) if token_store is not None else None
+        verified = (
+            (principal is not None and secret_equals(principal.name, username))
+            or (not API_TOKEN and bool(BASIC_AUTH_USERNAME and BASIC_AUTH_PASSWORD)
+                and secret_equals(username, BASIC_AUTH_USERNAME) & secret_equals(password, BASIC_AUTH_PASSWORD))
+        )
+    return hash_token(authorization)[:16] if verified else None
+
+
+# 依赖项：认证检查
+async def verify_auth(
+    request: Request,
+    bearer_credentials: Optional[HTTPAuthorizationCredentials] = Depends(security_bearer),
+    basic_credentials: Optional[HTTPAuthorizationCredentials] = Depends(security_basic)
+) -> Optional[TokenPrincipal]:
+    """认证检查依赖项
+
+    返回令牌文件中的用户，路径中有配置名时同时检查访问范围；
+    使用全局 Token / Basic 认证或未启用认证时返回 None（不受限制）。
+    """
+
+    # 令牌文件中的用户：Bearer 令牌，或 Basic 认证的用户名 + 令牌
+    if token_store is not None:
+        principal = None
+        if bearer_credentials:
+            principal = token_store.authenticate(bearer_credentials.credentials)
+        elif basic_credentials:
+            principal = token_store.authenticate(basic_credentials.password)
+            if principal is not None and not secret_equals(principal.name, basic_credentials.username):
+                principal = None
+        if principal is not None:
+            config_name = request.path_params.get('config_name')
+            if config_name is not None:
+                check_config_access(principal, config_name)
+            return principal
+
+    # 检查 Bearer Token
+    if API_TOKEN:
+        if bearer_credentials and secret_equals(bearer_credentials.credentials, API_TOKEN):
+            return None
+
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid Bearer Token",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+
+    # 检查 Basic Auth
+    if BASIC_AUTH_USERNAME and BASIC_AUTH_PASSWORD:
+        if (basic_credentials and
+            secret_equals(basic_credentials.username, BASIC_AUTH_USERNAME) &
+            secret_equals(basic_credentials.password, BASIC_AUTH_PASSWORD)):
+            return None
+
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid credentials",
+            headers={"WWW-Authenticate": "Basic"},
+        )
+
+    if token_store is not None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid Bearer Token",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    return None
+
+
+def check_writable() -> None:
+    """副本只读：写入请求返回 403"""
+    if REPLICA_OF:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail='This server is a read-only replica; send writes to the primary'
+        )
+
+
+async def verify_write_auth(principal: Optional[TokenPrincipal] = Depends(verify_auth)) -> Optional[TokenPrincipal]:
+    """写入端点的认证依赖项：认证通过后，副本模式下再拒绝写入"""
+    check_writable()
+    return principal
+
+
+# 请求体解压
+class DecompressingRequest(Request):
+    """按 Content-Encoding（gzip / zstd）透明解压请求体的 Request"""
+
+    async def body(self) -> bytes:
+        if not hasattr(self, '_body'):
+            body = await super().body()
+            encoding = self.headers.get('content-encoding', 'identity').strip().lower()
+
+            if encoding != 'identity' and body:
+                try:
+                    body = await run_in_threadpool(decompress_content, body, encoding)
+                except OverflowError as e:
+                    raise HTTPException(
+                        status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                        detail=str(e)
+                    )
+                except ValueError as e:
+                    raise HTTPException(
+                        status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+                        detail=str(e)
+                    )
+                except Exception:
+                    raise HTTPException(
+                        status_code=status.HTTP_400_BAD_REQUEST,
+                        detail=f"Invalid {encoding} request body"
+                    )
+
+            self._body = body
+        return self._body
+
+
+class DecompressingRoute(APIRoute):
+    """所有路由统一使用 DecompressingRequest"""
+
+    def get_route_handler(self):
+        original_route_handler = super().get_route_handler()
+
+        async def route_handler(request: Request) -> Response:
+            return await original_route_handler(DecompressingRequest(request.scope, request.receive))
+
+        return route_handler
+
+
+class TokenBucket:
+    """令牌桶：每秒补充 rate 个令牌，最多积累 capacity 个"""
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate: float, capacity: float, now: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def take(self, now: float) -> float:
+        """取一个令牌，成功返回 0，否则返回还需等待的秒数"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class RequestBodyTooLarge(OverflowError):
+    """未声明 Content-Length 的请求体在读取过程中超过了限制"""
+
+
+class RateLimitMiddleware:
+    """ASGI 中间件：在读取请求体之前执行限流和配额检查
+
+    - 令牌桶限流：每个凭据（未携带或未通过认证时每个 IP）、每个 IP、每个配置的上传分别计数，超出返回 429 和 ``Retry-After``
+    - 上传大小：``Content-Length`` 超过请求体上限或单配置配额时直接返回 413；
+      未声明长度的请求体边读边计数，超过时同样返回 413
+    - 全局配额：所有配置当前备份的落盘大小加上本次上传超过 ``STORAGE_QUOTA_MB`` 时返回 413
+
+    令牌桶保存在本进程内存中，多进程模式下每个工作进程各自计数。
+    """
+
+    SYNC_PATH_PATTERN = re.compile(r'^/sync/([^/]+)(/manifest|/chunks/[^/]+)?$')
+    EXEMPT_PATHS = ('/health', '/metrics')
+    MAX_BUCKETS = 100000
+    USAGE_TTL = 1.0
+
+    def __init__(self, app):
+        self.app = app
+        self._buckets: 'OrderedDict[str, TokenBucket]' = OrderedDict()
+        self._usage: Optional[Tuple[float, int]] = None
+
+    def _take(self, key: str, rate: float, now: float) -> float:
+        """从指定令牌桶取一个令牌，桶的数量有上限，最久未使用的先丢弃"""
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(rate, max(1.0, rate * RATE_LIMIT_BURST_SECONDS), now)
+            self._buckets[key] = bucket
+            if len(self._buckets) > self.MAX_BUCKETS:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+        return bucket.take(now)
+
+    async def _storage_used(self) -> int:
+        """所有配置当前备份的落盘字节数（缓存 1 秒，避免每次上传都统计）"""
+        now = time.monotonic()
+        if self._usage is None or now - self._usage[0] > self.USAGE_TTL:
+            _, stored_bytes = await data_store.storage_stats_async()
+            self._usage = (now, stored_bytes)
+        return self._usage[1]
+
+    @staticmethod
+    async def _reject(send, status_code: int, reason: str, detail: str, headers: Optional[Dict[str, str]] = None) -> None:
+        REQUESTS_REJECTED.inc(1, reason)
+        body = json_encode({'detail': detail})
+        raw_headers = [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())]
+        raw_headers += [(k.lower().encode(), v.encode()) for k, v in (headers or {}).items()]
+        await send({'type': 'http.response.start', 'status': status_code, 'headers': raw_headers})
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['method'] == 'OPTIONS' or scope['path'] in self.EXEMPT_PATHS:
+            await self.app(scope, receive, send)
+            return
+
+        headers = {k.decode('latin-1'): v.decode('latin-1') for k, v in scope['headers']}
+        match = self.SYNC_PATH_PATTERN.match(scope['path'])
+        config_name = match.group(1) if match and match.group(1) != 'batch' else None
+        is_upload = scope['method'] in ('POST', 'PUT') and scope['path'].startswith('/sync/')
+
+        # 限流
+        now = time.monotonic()
+        client_ip = (scope.get('client') or ('unknown',))[0]
+        authorization = headers.get('authorization')
+        limits = []
+        if RATE_LIMIT > 0:
+            identity = rate_limit_identity(authorization)
+            client_key = f"auth:{identity}" if identity else f"ip:{client_ip}"
+            limits.append(('client', client_key, RATE_LIMIT))
+        if IP_RATE_LIMIT > 0:
+            limits.append(('ip', f"ip-only:{client_ip}", IP_RATE_LIMIT))
+        if CONFIG_WRITE_RATE_LIMIT > 0 and is_upload and config_name and not (match.group(2) or '').startswith('/chunks'):
+            limits.append(('config', f"config:{config_name}", CONFIG_WRITE_RATE_LIMIT))
+        for reason, key, rate in limits:
+            wait = self._take(key, rate, now)
+            if wait:
+                await self._reject(
+                    send, status.HTTP_429_TOO_MANY_REQUESTS, f'rate_{reason}',
+                    f'Too many requests ({reason} limit {rate:g}/s)',
+                    {'Retry-After': str(max(1, int(wait + 0.999)))}
+                )
+                return
+
+        if not is_upload:
+            await self.app(scope, receive, send)
+            return
+
+        # 上传大小与配额：先按声明的长度检查，未声明时边读边计数
+        limit, reason, detail = MAX_DECOMPRESSED_SIZE, 'body_size', f'Request body exceeds {MAX_DECOMPRESSED_SIZE} bytes'
+        config_quota = int(CONFIG_QUOTA_MB * 1024 * 1024)
+        if config_quota and config_name and config_quota < limit:
+            limit, reason, detail = config_quota, 'config_quota', f'Backup exceeds the per-config quota of {config_quota} bytes'
+        storage_quota = int(STORAGE_QUOTA_MB * 1024 * 1024)
+        if storage_quota:
+            metadata = await data_store.get_metadata_async(config_name) if config_name else None
+            current = (metadata or {}).get('stored_size', 0)
+            remaining = max(0, storage_quota - await self._storage_used() + current)
+            if remaining < limit:
+                limit, reason, detail = remaining, 'storage_quota', 'Storage quota exceeded'
+
+        try:
+            content_length = int(headers.get('content-length', ''))
+        except ValueError:
+            content_length = None
+        if content_length is not None and content_length > limit:
+            await self._reject(send, status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, reason, detail)
+            return
+
+        received = 0
+        exceeded = False
+        response_started = False
+        rejected = False
+
+        async def limited_receive():
+            nonlocal received, exceeded
+            message = await receive()
+            if message['type'] == 'http.request':
+                received += len(message.get('body', b''))
+                if received > limit:
+                    exceeded = True
+                    raise RequestBodyTooLarge(detail)
+            return message
+
+        async def checked_send(message):
+            nonlocal response_started, rejected
+            if exceeded:
+                # 路由自行处理了异常（如转换为 500）时改为返回 413
+                if message['type'] == 'http.response.start' and not response_started:
+                    response_started = rejected = True
+                    await self._reject(send, status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, reason, detail)
+                return
+            if message['type'] == 'http.response.start':
+                response_started = True
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, checked_send)
+        except RequestBodyTooLarge:
+            if rejected:
+                return
+            if response_started:
+                raise
+            await self._reject(send, status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, reason, detail)
+
+
+# 应用生命周期管理
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    """应用生命周期管理"""
+    open_data_store()
+    print(f"\n📁 数据目录: {os.path.abspath(DATA_DIR)}")
+    print(f"🗄️  存储后端: {data_store.backend}")
+    print(f"🧮 JSON 编解码: {JSON_CODEC}")
+    if WORKERS > 1:
+        print(f"👷 工作进程: {WORKERS}（PID {os.getpid()}）")
+    if replicator is not None:
+        print(f"🔁 副本模式: 从 {replicator.client.url} 同步（只读）")
+    print(f"🌐 同步端点: http://localhost:{PORT}/sync/<配置名>")
+    print(f"📊 状态查询: http://localhost:{PORT}/status")
+    print(f"📈 监控指标: http://localhost:{PORT}/metrics")
+    print(f"📚 API 文档: http://localhost:{PORT}/docs")
+
+    if token_store is not None:
+        print(f"🎫 令牌文件: {os.path.abspath(TOKEN_FILE)}（{len(token_store)} 个令牌）")
+    if API_TOKEN:
+        print(f"🔐 Bearer Token: {API_TOKEN[:10]}...")
+    elif BASIC_AUTH_USERNAME:
+        print(f"🔑 Basic Auth: {BASIC_AUTH_USERNAME}:*****")
+    elif token_store is None:
+        print("⚠️  警告: 未启用认证，任何人都可以访问数据！")
+
+    print("\n启动服务器...\n")
+    start_log_listener(log_listener)
+    # 后台增量回收不再被任何版本引用的备份
+    gc_task = asyncio.create_task(data_store.run_garbage_collector(GC_INTERVAL))
+    # 后台限速校验已保存备份的完整性
+    scrub_task = asyncio.create_task(data_store.run_scrubber(SCRUB_RATE_MB, SCRUB_INTERVAL))
+    # 后台限速删除 /clear 移入回收目录的数据
+    purge_task = asyncio.create_task(data_store.run_purger(PURGE_RATE_MB))
+    # 多进程模式下把其他工作进程的写入推送给本进程的订阅者
+    watch_task = asyncio.create_task(watch_changes(CHANGE_POLL_INTERVAL)) if data_store.changelog else None
+    # 副本模式下从主服务器拉取变更
+    replica_task = asyncio.create_task(replicator.run()) if replicator is not None else None
+    yield
+    gc_task.cancel()
+    purge_task.cancel()
+    scrub_task.cancel()
+    if watch_task is not None:
+        watch_task.cancel()
+    if replica_task is not None:
+        replica_task.cancel()
+    close_data_store()
+    stop_log_listener(log_listener)
+    print("\n服务器已关闭")
+
+
+# 创建 FastAPI 应用
+app = FastAPI(
+    title="VaultSafe Sync Server",
+    description="VaultSafe 密码管理器同步服务器 - 支持多配置文件存储",
+    version="1.0.0",
+    lifespan=lifespan
+)
+
+# 支持压缩的请求体
+app.router.route_class = DecompressingRoute
+
+# 限流和上传配额（在 CORS 之内，被拒绝的响应同样带有 CORS 头）
+app.add_middleware(RateLimitMiddleware)
+
+# 配置 CORS
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+    expose_headers=["ETag", "Accept-Ranges", "Content-Range", "Retry-After"],
+)
+
+# 请求指标（最外层，包含 CORS 等中间件的开销）
+app.add_middleware(MetricsMiddleware)
+
+
+async def backup_response(request: Request, record: Dict[str, Any], config_name: Optional[str] = None) -> Response:
+    """流式返回一个备份版本的内容，内存占用与备份大小无关
+
+    - 指定 ``config_name`` 时，不太大的备份整体下载经过响应缓存，热点配置直接从内存返回
+    - 客户端接受落盘编码时原样返回落盘内容
+    - 否则边读边解压
+    - 分块存储的版本按顺序拼接各数据块，以未压缩内容返回
+    - 带 ``Range`` 时返回未压缩内容的对应区间（206），``If-Range`` 与 ETag 不一致时返回完整内容
+
+    备份按内容寻址、写入后不再修改，因此无需持有配置锁：
+    ETag 与内容始终对应同一份数据。
+    """
+    etag = record['etag']
+    size = record['size']
+    headers = {'ETag': etag, 'Vary': 'Accept-Encoding', 'Accept-Ranges': 'bytes'}
+
+    # 条件请求：备份未变化时只比较请求头，不读取备份内容
+    if etag_matches(request.headers.get('if-none-match'), etag, weak=True):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+
+    byte_range = None
+    if_range = request.headers.get('if-range')
+    if not if_range or etag_matches(if_range, etag):
+        try:
+            byte_range = parse_range(request.headers.get('range'), size)
+        except ValueError:
+            return Response(
+                status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+                headers={'Content-Range': f'bytes */{size}', 'ETag': etag}
+            )
+
+    encoding = record['encoding']
+    if byte_range is None and config_name is not None:
+        if encoding != CHUNKED_ENCODING and accepts_encoding(request.headers.get('accept-encoding'), encoding):
+            representation, body_size = encoding, record['stored_size']
+        else:
+            representation, body_size = 'identity', size
+        if data_store.cache.cacheable(body_size):
+            if representation == 'identity':
+                load = lambda: data_store.load_content_async(record)
+            else:
+                load = lambda: data_store.load_stored_blob_async(record['hash'], encoding)
+            try:
+                body = await data_store.cache.fetch(config_name, record['version'], representation, etag, load)
+            except FileNotFoundError:
+                # 读取期间配置已被清除
+                raise HTTPException(
+                    status_code=status.HTTP_404_NOT_FOUND,
+                    detail='Backup no longer exists'
+                )
+            if representation != 'identity':
+                headers['Content-Encoding'] = representation
+            return Response(content=body, media_type='application/json', headers=headers)
+
+    if encoding == CHUNKED_ENCODING:
+        reader = ChunkedReader(data_store, record['chunks'])
+        if byte_range is None:
+            headers['Content-Length'] = str(size)
+            return StreamingResponse(data_store.iter_file(reader), media_type='application/json', headers=headers)
+        start, end = byte_range
+        headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+        headers['Content-Length'] = str(end - start + 1)
+        return StreamingResponse(
+            data_store.iter_file(reader, start, end - start + 1),
+            status_code=status.HTTP_206_PARTIAL_CONTENT,
+            media_type='application/json',
+            headers=headers
+        )
+
+    try:
+        blob_file, stored_size = await data_store.open_blob_async(record['hash'], encoding)
+    except FileNotFoundError:
+        # 读取期间配置已被清除
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail='Backup no longer exists'
+        )
+
+    if byte_range is not None:
+        # 区间针对未压缩的内容，与 ETag 对应同一表示
+        start, end = byte_range
+        headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+        headers['Content-Length'] = str(end - start + 1)
+        reader = open_decoded(blob_file, encoding)
+        return StreamingResponse(
+            data_store.iter_file(reader, start, end - start + 1, closing=(blob_file,)),
+            status_code=status.HTTP_206_PARTIAL_CONTENT,
+            media_type='application/json',
+            headers=headers
+        )
+
+    if accepts_encoding(request.headers.get('accept-encoding'), encoding):
+        # 直接流式返回落盘内容，不做任何 JSON 解析或重新压缩
+        if encoding != 'identity':
+            headers['Content-Encoding'] = encoding
+        headers['Content-Length'] = str(stored_size)
+        body = data_store.iter_file(blob_file)
+    else:
+        # 客户端不接受落盘编码时边读边解压
+        headers['Content-Length'] = str(size)
+        body = data_store.iter_file(open_decoded(blob_file, encoding), closing=(blob_file,))
+    return StreamingResponse(body, media_type='application/json', headers=headers)
+
+
+async def resolve_record(config_name: str, metadata: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """分块存储的当前版本需要完整的版本记录（含数据块列表），其余情况直接使用元数据"""
+    if metadata.get('encoding') != CHUNKED_ENCODING:
+        return metadata
+    return await data_store.get_version_async(config_name, metadata['version'])
+
+
+async def wait_for_change(config_name: str, etag: Optional[str], timeout: float) -> Optional[Dict[str, Any]]:
+    """等待配置的 ETag 发生变化或超时，返回最新的元数据"""
+    queue = change_notifier.subscribe(config_name)
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    try:
+        while True:
+            # 订阅之后再检查一次，避免错过订阅前刚完成的写入；
+            # 多进程模式下可能收到订阅前的旧变更，ETag 未变时继续等待
+            metadata = await data_store.get_metadata_async(config_name)
+            remaining = deadline - loop.time()
+            if (metadata or {}).get('etag') != etag or remaining <= 0:
+                return metadata
+            try:
+                await asyncio.wait_for(queue.get(), remaining)
+            except asyncio.TimeoutError:
+                return await data_store.get_metadata_async(config_name)
+    finally:
+        change_notifier.unsubscribe(config_name, queue)
+
+
+async def wait_for_feed(since: int, feed_id: Optional[str], limit: int, timeout: float) -> Dict[str, Any]:
+    """等待复制变更流中出现 since 之后的变更或超时，返回最新的查询结果"""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while True:
+        # 先取事件再查询，查询之后追加的变更一定会 set 这个事件
+        updated = data_store.feed_updated()
+        page = await data_store.feed_changes_async(since, feed_id, limit)
+        remaining = deadline - loop.time()
+        if page['changes'] or page['reset'] or remaining <= 0:
+            return page
+        try:
+            await asyncio.wait_for(updated.wait(), remaining)
+        except asyncio.TimeoutError:
+            pass
+
+
+def format_sse(event: Dict[str, Any]) -> str:
+    """把变更事件编码为 SSE 消息，以版本号作为事件 ID"""
+    lines = []
+    if event.get('version') is not None:
+        lines.append(f"id: {event['version']}")
+    lines.append('event: update')
+    lines.append(f"data: {json_encode(event).decode('utf-8')}")
+    return '\n'.join(lines) + '\n\n'
+
+
+class CodecJSONResponse(JSONResponse):
+    """由 JSON 编解码层渲染的 JSON 响应（直接返回，跳过 FastAPI 的逐字段转换）"""
+
+    def render(self, content: Any) -> bytes:
+        return json_encode(content)
+
+
+def json_body(model: type, required: bool = True):
+    """请求体依赖：用 JSON 编解码层直接解析原始字节，再交给 ``model`` 校验
+
+    替代 FastAPI 默认的标准库 json 解析；Pydantic 校验字符串字段时不复制，
+    大备份的 ``encrypted_data`` 只在解析时生成一次。``required`` 为 False 时没有请求体返回 None。
+    校验失败与 FastAPI 一样返回 422。
+    """
+    async def parse(request: Request):
+        body = await request.body()
+        if not body:
+            if not required:
+                return None
+            raise RequestValidationError([{'type': 'missing', 'loc': ('body',), 'msg': 'Field required', 'input': None}])
+        try:
+            return model.model_validate(json_decode(body))
+        except ValidationError as e:
+            raise RequestValidationError([
+                {**error, 'loc': ('body', *error['loc'])} for error in e.errors(include_url=False)
+            ])
+        except ValueError as e:
+            raise RequestValidationError([{
+                'type': 'json_invalid', 'loc': ('body', getattr(e, 'pos', 0)), 'msg': 'JSON decode error',
+                'input': {}, 'ctx': {'error': getattr(e, 'msg', str(e))}
+            }])
+    return parse
+
+
+async def store_upload(
+    config_name: str,
+    upload_data: SyncUploadData,
+    if_match: Optional[str] = None,
+    staged: Optional[StagedBlob] = None,
+    manifest: Optional[Dict[str, Any]] = None
+) -> Dict[str, Any]:
+    """保存一次上传（作为新版本），通知订阅者并记录日志，返回保存后的配置记录
+
+    备份内容取自已校验的分块清单 ``manifest``、已写完的 ``staged`` 临时文件（流式上传），
+    否则取自 ``upload_data.encrypted_data``。
+    ``if_match`` 与当前 ETag 不一致时抛出 412。
+    """
+    # 读-改-写在配置锁内完成，避免并发上传互相覆盖设备信息
+    async with data_store.locked(config_name):
+        # 加载现有数据
+        data = await data_store.load_data_async(config_name)
+
+        # 条件上传：拒绝基于过期版本的覆盖
+        if if_match and not etag_matches(if_match, data.get('etag')):
+            raise HTTPException(
+                status_code=status.HTTP_412_PRECONDITION_FAILED,
+                detail=f'Backup of config "{config_name}" has been modified by another device'
+            )
+
+        # 更新加密数据
+        if staged is None and manifest is None:
+            data['encrypted_data'] = upload_data.encrypted_data
+
+        # 更新设备信息
+        if upload_data.device_id:
+            data['device_info'][upload_data.device_id] = {
+                'last_upload': datetime.now().isoformat(),
+                'timestamp': upload_data.timestamp,
+                'version': upload_data.version
+            }
+
+        # 保存数据（作为新版本追加到历史中）
+        await data_store.save_data_async(config_name, data, upload_data.device_id, staged, manifest)
+
+    # 通知等待该配置变更的设备
+    change_notifier.publish(
+        config_name,
+        change_event(config_name, metadata_from_config(config_name, data), upload_data.device_id)
+    )
+
+    # 日志字段取自保存时已解析的备份摘要，不再重新解析上传内容
+    log_event(
+        logging.INFO, '数据已更新', sampled=True,
+        event='upload', config=config_name, backend=data_store.backend,
+        device_id=upload_data.device_id, version=data['version'], size=data['size'],
+        backup_version=data['backup'].get('version'), exported_at=data['backup'].get('exportedAt')
+    )
+    return data
+
+
+def batch_line(entry: Dict[str, Any]) -> bytes:
+    """批量同步响应中的一行 NDJSON"""
+    return json_encode(entry) + b'\n'
+
+
+async def batch_upload_result(upload: BatchUploadData, principal: Optional[TokenPrincipal] = None) -> Dict[str, Any]:
+    """执行批量请求中的一个上传，失败时返回错误条目而不是中断整个批次"""
+    try:
+        validate_config_name(upload.config_name)
+        check_config_access(principal, upload.config_name)
+        if not upload.encrypted_data:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="encrypted_data is required")
+        data = await store_upload(upload.config_name, upload, upload.if_match)
+    except ValueError as e:
+        return {'config_name': upload.config_name, 'status': 'error', 'code': 400, 'detail': str(e)}
+    except HTTPException as e:
+        state = 'conflict' if e.status_code == status.HTTP_412_PRECONDITION_FAILED else 'error'
+        return {'config_name': upload.config_name, 'status': state, 'code': e.status_code, 'detail': e.detail}
+    except Exception as e:
+        logger.exception('批量上传失败', extra={'fields': {'event': 'sync_error', 'config': upload.config_name}})
+        return {'config_name': upload.config_name, 'status': 'error', 'code': 500, 'detail': str(e)}
+
+    return {
+        'config_name': upload.config_name,
+        'status': 'uploaded',
+        'etag': data['etag'],
+        'version': data['version'],
+        'stored_at': data['last_updated'],
+    }
+
+
+async def batch_fetch_result(item: BatchFetchItem, principal: Optional[TokenPrincipal] = None) -> Dict[str, Any]:
+    """批量请求中的一个下载：未变化时只返回状态，变化时附带备份内容"""
+    try:
+        validate_config_name(item.name)
+        check_config_access(principal, item.name)
+    except ValueError as e:
+        return {'config_name': item.name, 'status': 'error', 'code': 400, 'detail': str(e)}
+    except HTTPException as e:
+        return {'config_name': item.name, 'status': 'error', 'code': e.status_code, 'detail': e.detail}
+
+    metadata = await data_store.get_metadata_async(item.name)
+    if not metadata or not metadata.get('has_data'):
+        return {'config_name': item.name, 'status': 'not_found'}
+
+    entry = {
+        'config_name': item.name,
+        'etag': metadata['etag'],
+        'version': metadata.get('version'),
+        'last_updated': metadata['last_updated'],
+    }
+    unchanged = (
+        etag_matches(item.etag, metadata['etag'], weak=True)
+        or (item.last_updated is not None and item.last_updated == metadata['last_updated'])
+    )
+    if unchanged:
+        entry['status'] = 'unchanged'
+        return entry
+
+    try:
+        record = await resolve_record(item.name, metadata)
+        if record is None:
+            return {'config_name': item.name, 'status': 'not_found'}
+        if data_store.cache.cacheable(record['size']):
+            blob = await data_store.cache.fetch(
+                item.name, record['version'], 'identity', record['etag'],
+                lambda: data_store.load_content_async(record)
+            )
+        else:
+            blob = await data_store.load_content_async(record)
+    except FileNotFoundError:
+        # 读取期间配置已被清除
+        return {'config_name': item.name, 'status': 'not_found'}
+    entry['status'] = 'changed'
+    entry['encrypted_data'] = blob.decode('utf-8')
+    return entry
+
+
+# 路由：批量同步（需在 /sync/{config_name} 之前注册）
+@app.post("/sync/batch")
+async def sync_batch(
+    batch: BatchSyncRequest = Depends(json_body(BatchSyncRequest)),
+    principal: Optional[TokenPrincipal] = Depends(verify_auth)
+):
+    """
+    批量同步多个配置，只认证一次
+
+    - **uploads**: 并发提交多个配置的上传，每项可带 `if_match`
+    - **configs**: 要下载的配置及客户端已知的 `etag` / `last_updated`，只返回有变化的备份
+
+    响应为 NDJSON 流（每个配置一行）：先返回所有上传结果，再逐个返回下载结果，
+    `status` 为 `uploaded` / `conflict` / `changed` / `unchanged` / `not_found` / `error`，
+    令牌无权访问的配置返回 `code` 为 403 的 `error` 条目。
+    """
+
+    if batch.uploads:
+        check_writable()
+    if len(batch.uploads) + len(batch.configs) > MAX_BATCH_SIZE:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f'A batch may contain at most {MAX_BATCH_SIZE} items'
+        )
+
+    # 不同配置的上传持有各自的配置锁，可以并发提交
+    upload_results = await asyncio.gather(*(batch_upload_result(upload, principal) for upload in batch.uploads))
+
+    async def stream():
+        for entry in upload_results:
+            yield batch_line(entry)
+        for item in batch.configs:
+            entry = await batch_fetch_result(item, principal)
+            # 备份可能很大，JSON 编码放到线程池中完成
+            if 'encrypted_data' in entry:
+                yield await run_in_threadpool(batch_line, entry)
+            else:
+                yield batch_line(entry)
+
+    return StreamingResponse(stream(), media_type='application/x-ndjson')
+
+
+# 路由：同步端点
+@app.post(
+    "/sync/{config_name}",
+    # 请求体由 json_body 依赖解析，在接口文档中单独声明
+    openapi_extra={'requestBody': {'content': {'application/json': {'schema': SyncUploadData.model_json_schema()}}}}
+)
+@app.get("/sync/{config_name}")
+async def sync(
+    config_name: str,
+    request: Request,
+    response: Response,
+    upload_data: Optional[SyncUploadData] = Depends(json_body(SyncUploadData, required=False)),
+    wait: Optional[float] = None,
+    _: None = Depends(verify_auth)
+):
+    """
+    同步端点 - 支持 GET 和 POST
+
+    - **POST**: 上传加密数据，携带 `If-Match` 时仅在 ETag 一致时覆盖
+    - **GET**: 下载加密数据，携带 `If-None-Match` 且未变化时返回 304；
+      同时指定 `?wait=秒数` 时挂起等待，直到有新版本或超时（长轮询）
+    """
+
+    try:
+        # 验证配置名称
+        validate_config_name(config_name)
+
+        if request.method == "POST":
+            check_writable()
+
+            # 上传数据
+            if not upload_data:
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail="No data provided"
+                )
+
+            if not upload_data.encrypted_data:
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail="encrypted_data is required"
+                )
+
+            data = await store_upload(config_name, upload_data, request.headers.get('if-match'))
+
+            response.headers['ETag'] = data['etag']
+            return {
+                'status': 'success',
+                'config_name': config_name,
+                'message': 'Data uploaded successfully',
+                'stored_at': data['last_updated'],
+                'etag': data['etag'],
+                'version': data['version']
+            }
+
+        else:  # GET
+            metadata = await data_store.get_metadata_async(config_name)
+
+            # 长轮询：客户端已是最新（或尚无数据）时等待下一次变更
+            if wait and wait > 0:
+                current_etag = metadata.get('etag') if metadata else None
+                if current_etag is None or etag_matches(request.headers.get('if-none-match'), current_etag, weak=True):
+                    metadata = await wait_for_change(config_name, current_etag, min(wait, MAX_WAIT_SECONDS))
+
+            if not metadata or not metadata.get('has_data'):
+                raise HTTPException(
+                    status_code=status.HTTP_404_NOT_FOUND,
+                    detail=f'No backup has been uploaded for config "{config_name}" yet'
+                )
+
+            backup = metadata.get('backup', {})
+            log_event(
+                logging.INFO, '数据已下载', sampled=True,
+                event='download', config=config_name, version=metadata.get('version'),
+                last_updated=metadata['last_updated'], size=metadata['size'],
+                backup_version=backup.get('version'), exported_at=backup.get('exportedAt')
+            )
+
+            record = await resolve_record(config_name, metadata)
+            if record is None:
+                # 读取期间版本已被清除
+                raise HTTPException(
+                    status_code=status.HTTP_404_NOT_FOUND,
+                    detail='Backup no longer exists'
+                )
+            return await backup_response(request, record, config_name)
+
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=str(e)
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception('同步失败', extra={'fields': {'event': 'sync_error', 'config': config_name}})
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=str(e)
+        )
+
+
+# 路由：流式上传
+@app.put("/sync/{config_name}")
+async def sync_stream_upload(
+    config_name: str,
+    request: Request,
+    response: Response,
+    device_id: str,
+    timestamp: int,
+    version: str = "1.0",
+    _: None = Depends(verify_write_auth)
+):
+    """
+    流式上传：请求体就是备份 JSON 本身（可带 `Content-Encoding: gzip/zstd`），
+    设备信息通过查询参数传递。边接收边写入临时文件并计算哈希，内存占用与备份大小无关。
+    支持 `If-Match`，语义与 POST 相同。
+    """
+
+    try:
+        validate_config_name(config_name)
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=str(e)
+        )
+
+    try:
+        staged = data_store.stage_blob(request.headers.get('content-encoding', 'identity').strip().lower())
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+            detail=str(e)
+        )
+
+    try:
+        async for chunk in request.stream():
+            if chunk:
+                await data_store.stage_write_async(staged, chunk)
+        await data_store.stage_finish_async(staged)
+        if not staged.size:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Backup body is required"
+            )
+
+        upload_data = SyncUploadData(device_id=device_id, timestamp=timestamp, encrypted_data='', version=version)
+        data = await store_upload(config_name, upload_data, request.headers.get('if-match'), staged)
+    except OverflowError:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"Backup exceeds {MAX_DECOMPRESSED_SIZE} bytes"
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception('流式上传失败', extra={'fields': {'event': 'sync_error', 'config': config_name}})
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST if isinstance(e, CORRUPT_CONTENT_ERRORS) else status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=str(e)
+        )
+    finally:
+        staged.discard()
+
+    response.headers['ETag'] = data['etag']
+    return {
+        'status': 'success',
+        'config_name': config_name,
+        'message': 'Data uploaded successfully',
+        'stored_at': data['last_updated'],
+        'etag': data['etag'],
+        'version': data['version']
+    }
+
+
+async def current_chunks(config_name: str) -> Tuple[Dict[str, Any], List[List[Any]]]:
+    """当前版本及其数据块列表；整体存储的版本按需切分。没有数据时抛出 404"""
+    metadata = await data_store.get_metadata_async(config_name)
+    record = await resolve_record(config_name, metadata) if metadata and metadata.get('has_data') else None
+    if record is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f'No backup has been uploaded for config "{config_name}" yet'
+        )
+    if 'chunks' in record:
+        return record, record['chunks']
+    try:
+        return record, await data_store.chunk_blob_async(record['hash'], record['encoding'])
+    except FileNotFoundError:
+        # 读取期间配置已被清除
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail='Backup no longer exists'
+        )
+
+
+def validate_chunk_hash(chunk_hash: str) -> None:
+    """数据块哈希必须是小写十六进制的 SHA-256，同时防止路径穿越"""
+    if not CHUNK_HASH_PATTERN.match(chunk_hash):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Invalid chunk hash: {chunk_hash}"
+        )
+
+
+# 路由：分块清单
+@app.get("/sync/{config_name}/manifest")
+async def get_manifest(
+    config_name: str,
+    _: None = Depends(verify_auth)
+):
+    """
+    获取当前版本的分块清单：数据块按顺序拼接即为完整备份（未压缩）。
+
+    客户端用相同的切分参数（`chunker`）切分本地备份，只上传服务器没有的数据块，
+    再通过 `POST /sync/{config_name}/manifest` 提交新版本。
+    """
 
-        with open(data_file, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=2, ensure_ascii=False)
+    try:
+        validate_config_name(config_name)
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=str(e)
+        )
 
-    def clear_config(self, config_name: str) -> None:
-        """清除指定配置的数据"""
-        data_file = self.get_config_file(config_name)
-        if os.path.exists(data_file):
-            os.remove(data_file)
+    record, chunks = await current_chunks(config_name)
+    return {
+        'config_name': config_name,
+        'version': record['version'],
+        'etag': record['etag'],
+        'size': record['size'],
+        'chunker': {
+            'min_size': CHUNK_MIN_SIZE,
+            'max_size': CHUNK_MAX_SIZE,
+            'boundary': CHUNK_BOUNDARY.decode('ascii'),
+        },
+        'chunks': [{'hash': chunk_hash, 'size': size} for chunk_hash, size, _ in chunks],
+    }
 
-    def clear_all(self) -> None:
-        """清除所有配置数据"""
-        if os.path.exists(self.data_dir):
-            shutil.rmtree(self.data_dir)
-        os.makedirs(self.data_dir)
 
-    def list_configs(self) -> List[str]:
-        """列出所有配置文件"""
-        if not os.path.exists(self.data_dir):
-            return []
+# 路由：提交分块清单
+@app.post(
+    "/sync/{config_name}/manifest",
+    # 请求体由 json_body 依赖解析，在接口文档中单独声明
+    openapi_extra={'requestBody': {'content': {'application/json': {'schema': ManifestUploadData.model_json_schema()}}}}
+)
+async def post_manifest(
+    config_name: str,
+    request: Request,
+    response: Response,
+    manifest_data: ManifestUploadData = Depends(json_body(ManifestUploadData)),
+    _: None = Depends(verify_write_auth)
+):
+    """
+    按分块清单保存新版本：所有数据块须已存在（已在服务器上或刚通过 `PUT .../chunks/{hash}` 上传），
+    缺少数据块时返回 409 并在 `detail.missing` 中列出。支持 `If-Match`，语义与 POST 上传相同。
 
-        configs = []
-        for filename in os.listdir(self.data_dir):
-            if filename.endswith('.json'):
-                configs.append(filename[:-5])  # 移除 .json 后缀
-        return configs
+    上传的数据块在宽限期（`GC_GRACE_SECONDS`）内未被清单引用会被垃圾回收。
+    """
 
+    try:
+        validate_config_name(config_name)
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=str(e)
+        )
+    if not manifest_data.chunks:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="chunks is required"
+        )
+    for chunk_hash in manifest_data.chunks:
+        validate_chunk_hash(chunk_hash)
 
-# 创建数据存储实例
-data_store = DataStore(DATA_DIR)
+    try:
+        manifest = await data_store.resolve_manifest_async(manifest_data.chunks)
+        if manifest['size'] > MAX_DECOMPRESSED_SIZE:
+            raise OverflowError
+        upload_data = SyncUploadData(
+            device_id=manifest_data.device_id,
+            timestamp=manifest_data.timestamp,
+            encrypted_data='',
+            version=manifest_data.version
+        )
+        data = await store_upload(config_name, upload_data, request.headers.get('if-match'), manifest=manifest)
+    except MissingChunksError as e:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail={'message': str(e), 'missing': e.missing}
+        )
+    except OverflowError:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"Backup exceeds {MAX_DECOMPRESSED_SIZE} bytes"
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception('分块上传失败', extra={'fields': {'event': 'sync_error', 'config': config_name}})
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=str(e)
+        )
 
+    response.headers['ETag'] = data['etag']
+    return {
+        'status': 'success',
+        'config_name': config_name,
+        'message': 'Data uploaded successfully',
+        'stored_at': data['last_updated'],
+        'etag': data['etag'],
+        'version': data['version']
+    }
 
-# 依赖项：认证检查
-async def verify_auth(
-    bearer_credentials: Optional[HTTPAuthorizationCredentials] = Depends(security_bearer),
-    basic_credentials: Optional[HTTPAuthorizationCredentials] = Depends(security_basic)
-) -> None:
-    """认证检查依赖项"""
 
-    # 检查 Bearer Token
-    if API_TOKEN:
-        if bearer_credentials and bearer_credentials.credentials == API_TOKEN:
-            return
+# 路由：上传数据块
+@app.put("/sync/{config_name}/chunks/{chunk_hash}")
+async def put_chunk(
+    config_name: str,
+    chunk_hash: str,
+    request: Request,
+    _: None = Depends(verify_write_auth)
+):
+    """
+    上传一个数据块：请求体为未压缩内容的 SHA-256 等于 `chunk_hash` 的数据（可带 `Content-Encoding`）。
+    数据块已存在时不重复保存。
+    """
 
+    try:
+        validate_config_name(config_name)
+    except ValueError as e:
         raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Invalid Bearer Token",
-            headers={"WWW-Authenticate": "Bearer"},
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=str(e)
         )
+    validate_chunk_hash(chunk_hash)
 
-    # 检查 Basic Auth
-    if BASIC_AUTH_USERNAME and BASIC_AUTH_PASSWORD:
-        if (basic_credentials and
-            basic_credentials.username == BASIC_AUTH_USERNAME and
-            basic_credentials.password == BASIC_AUTH_PASSWORD):
-            return
+    try:
+        staged = data_store.stage_blob(
+            request.headers.get('content-encoding', 'identity').strip().lower(),
+            CHUNK_UPLOAD_MAX_SIZE
+        )
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+            detail=str(e)
+        )
 
+    try:
+        async for chunk in request.stream():
+            if chunk:
+                await data_store.stage_write_async(staged, chunk)
+        await data_store.stage_finish_async(staged)
+        if not staged.size:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Chunk body is required"
+            )
+        if staged.hash != chunk_hash:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Chunk content does not match hash {chunk_hash}"
+            )
+        await data_store.store_chunk_async(staged)
+    except OverflowError:
         raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Invalid credentials",
-            headers={"WWW-Authenticate": "Basic"},
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"Chunk exceeds {CHUNK_UPLOAD_MAX_SIZE} bytes"
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception('数据块上传失败', extra={'fields': {'event': 'sync_error', 'config': config_name}})
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST if isinstance(e, CORRUPT_CONTENT_ERRORS) else status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=str(e)
         )
+    finally:
+        staged.discard()
 
+    return {'status': 'success', 'hash': chunk_hash, 'size': staged.size}
 
-# 应用生命周期管理
-@asynccontextmanager
-async def lifespan(_app: FastAPI):
-    """应用生命周期管理"""
-    print(f"\n📁 数据目录: {os.path.abspath(DATA_DIR)}")
-    print(f"🌐 同步端点: http://localhost:{PORT}/sync/<配置名>")
-    print(f"📊 状态查询: http://localhost:{PORT}/status")
-    print(f"📚 API 文档: http://localhost:{PORT}/docs")
 
-    if API_TOKEN:
-        print(f"🔐 Bearer Token: {API_TOKEN[:10]}...")
-    elif BASIC_AUTH_USERNAME:
-        print(f"🔑 Basic Auth: {BASIC_AUTH_USERNAME}:*****")
-    else:
-        print("⚠️  警告: 未启用认证，任何人都可以访问数据！")
+# 路由：下载数据块
+@app.get("/sync/{config_name}/chunks/{chunk_hash}")
+async def get_chunk(
+    config_name: str,
+    chunk_hash: str,
+    request: Request,
+    _: None = Depends(verify_auth)
+):
+    """
+    下载当前版本的一个数据块（客户端只需下载本地没有的数据块）。
+    客户端接受落盘编码时原样返回，否则返回未压缩内容。
+    """
 
-    print("\n启动服务器...\n")
-    yield
-    print("\n服务器已关闭")
+    try:
+        validate_config_name(config_name)
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=str(e)
+        )
+    validate_chunk_hash(chunk_hash)
 
+    # 只提供当前版本引用的数据块，不能借此读取其他配置的内容
+    _, chunks = await current_chunks(config_name)
+    entry = next((chunk for chunk in chunks if chunk[0] == chunk_hash), None)
+    found = await data_store.find_blob_async(chunk_hash) if entry is not None else None
+    if found is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f'Chunk {chunk_hash} is not part of the current version of config "{config_name}"'
+        )
 
-# 创建 FastAPI 应用
-app = FastAPI(
-    title="VaultSafe Sync Server",
-    description="VaultSafe 密码管理器同步服务器 - 支持多配置文件存储",
-    version="1.0.0",
-    lifespan=lifespan
-)
+    etag = compute_etag(chunk_hash)
+    if etag_matches(request.headers.get('if-none-match'), etag, weak=True):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
 
-# 配置 CORS
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+    encoding, stored_size = found
+    try:
+        blob_file, _ = await data_store.open_blob_async(chunk_hash, encoding)
+    except FileNotFoundError:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail='Chunk no longer exists'
+        )
 
+    headers = {'ETag': etag, 'Vary': 'Accept-Encoding'}
+    if accepts_encoding(request.headers.get('accept-encoding'), encoding):
+        if encoding != 'identity':
+            headers['Content-Encoding'] = encoding
+        headers['Content-Length'] = str(stored_size)
+        body = data_store.iter_file(blob_file)
+    else:
+        headers['Content-Length'] = str(entry[1])
+        body = data_store.iter_file(open_decoded(blob_file, encoding), closing=(blob_file,))
+    return StreamingResponse(body, media_type='application/octet-stream', headers=headers)
 
-# 路由：同步端点
-@app.post("/sync/{config_name}")
-@app.get("/sync/{config_name}")
-async def sync(
+
+# 路由：变更通知（SSE）
+@app.get("/sync/{config_name}/events")
+async def sync_events(
     config_name: str,
     request: Request,
-    upload_data: Optional[SyncUploadData] = None,
     _: None = Depends(verify_auth)
 ):
     """
-    同步端点 - 支持 GET 和 POST
+    订阅指定配置的变更通知（Server-Sent Events）
 
-    - **POST**: 上传加密数据
-    - **GET**: 下载加密数据
+    连接建立时先推送当前版本（与 `Last-Event-ID` 相同则跳过），
+    之后每次上传或清除都会立即推送一条 `update` 事件。
     """
 
     try:
-        # 验证配置名称
-        data_store.get_config_file(config_name)
-
-        if request.method == "POST":
-            # 上传数据
-            if not upload_data:
-                raise HTTPException(
-                    status_code=status.HTTP_400_BAD_REQUEST,
-                    detail="No data provided"
-                )
-
-            if not upload_data.encrypted_data:
-                raise HTTPException(
-                    status_code=status.HTTP_400_BAD_REQUEST,
-                    detail="encrypted_data is required"
-                )
-
-            # 加载现有数据
-            data = data_store.load_data(config_name)
+        validate_config_name(config_name)
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=str(e)
+        )
 
-            # 更新加密数据
-            data['encrypted_data'] = upload_data.encrypted_data
+    last_event_id = request.headers.get('last-event-id')
 
-            # 更新设备信息
-            if upload_data.device_id:
-                data['device_info'][upload_data.device_id] = {
-                    'last_upload': datetime.now().isoformat(),
-                    'timestamp': upload_data.timestamp,
-                    'version': upload_data.version
-                }
+    async def event_stream():
+        # 在生成器内订阅，客户端提前断开时也能在 finally 中取消
+        queue = change_notifier.subscribe(config_name)
+        try:
+            metadata = await data_store.get_metadata_async(config_name)
+            if metadata and metadata.get('has_data') and str(metadata.get('version')) != last_event_id:
+                yield format_sse(change_event(config_name, metadata))
 
-            # 保存数据
-            data_store.save_data(config_name, data)
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), SSE_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    # 心跳注释，防止代理关闭空闲连接
+                    yield ': keepalive\n\n'
+                    continue
+                yield format_sse(event)
+        finally:
+            change_notifier.unsubscribe(config_name, queue)
 
-            # 日志输出
-            try:
-                backup = json.loads(upload_data.encrypted_data)
-                print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] 数据已更新")
-                print(f"  配置名称: {config_name}")
-                print(f"  数据文件: {data_store.get_config_file(config_name)}")
-                print(f"  设备ID: {upload_data.device_id}")
-                print(f"  备份版本: {backup.get('version', 'N/A')}")
-                print(f"  导出时间: {backup.get('exportedAt', 'N/A')}")
-            except:
-                print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] 数据已更新")
-                print(f"  配置名称: {config_name}")
-                print(f"  数据文件: {data_store.get_config_file(config_name)}")
-                print(f"  设备ID: {upload_data.device_id}")
+    return StreamingResponse(
+        event_stream(),
+        media_type='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
 
-            return {
-                'status': 'success',
-                'config_name': config_name,
-                'message': 'Data uploaded successfully',
-                'stored_at': data['last_updated']
-            }
 
-        else:  # GET
-            # 下载数据
-            data = data_store.load_data(config_name)
+# 路由：历史版本列表
+@app.get("/sync/{config_name}/versions")
+async def list_versions(
+    config_name: str,
+    _: None = Depends(verify_auth)
+):
+    """
+    列出指定配置保留的历史版本（最新的在前）
+    """
 
-            if data['encrypted_data'] is None:
-                raise HTTPException(
-                    status_code=status.HTTP_404_NOT_FOUND,
-                    detail=f'No backup has been uploaded for config "{config_name}" yet'
-                )
+    try:
+        validate_config_name(config_name)
+        records = await data_store.list_versions_async(config_name)
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=str(e)
+        )
 
-            # 日志输出
-            print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] 数据已下载")
-            print(f"  配置名称: {config_name}")
-            print(f"  最后更新: {data['last_updated']}")
+    return {
+        'config_name': config_name,
+        'versions': [version_summary(record) for record in records]
+    }
 
-            try:
-                backup = json.loads(data['encrypted_data'])
-                print(f"  备份版本: {backup.get('version', 'N/A')}")
-                print(f"  导出时间: {backup.get('exportedAt', 'N/A')}")
-            except:
-                pass
 
-            # 返回完整的备份数据
-            return ORJSONResponse(content=json.loads(data['encrypted_data']))
+# 路由：下载历史版本
+@app.get("/sync/{config_name}/versions/{version}")
+async def get_version(
+    config_name: str,
+    version: int,
+    request: Request,
+    _: None = Depends(verify_auth)
+):
+    """
+    下载指定配置的某个历史版本，支持 `If-None-Match`
+    """
 
+    try:
+        validate_config_name(config_name)
+        record = await data_store.get_version_async(config_name, version)
     except ValueError as e:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail=str(e)
         )
-    except HTTPException:
-        raise
-    except Exception as e:
-        print(f"同步失败: {e}")
+
+    if record is None:
         raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=str(e)
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f'Version {version} of config "{config_name}" does not exist'
         )
 
+    return await backup_response(request, record, config_name)
+
+
+CONFIG_RESPONSE_FIELDS = [(name, field.get_default()) for name, field in ConfigResponse.model_fields.items()]
+
+
+def config_summary(metadata: Dict[str, Any]) -> Dict[str, Any]:
+    """/status 中一个配置的字段（与 ConfigResponse 一致），元数据已是正确类型，不再逐个构造模型"""
+    return {name: metadata.get(name, default) for name, default in CONFIG_RESPONSE_FIELDS}
+
+
+def status_lines(page: List[Dict[str, Any]]) -> bytes:
+    """NDJSON 导出中的一页配置（每个配置一行）"""
+    return b''.join(json_encode(config_summary(metadata)) + b'\n' for metadata in page)
+
+
+async def stream_status(query: MetadataQuery, limit: Optional[int]):
+    """按页从存储读取并逐页输出，内存占用与配置总数无关"""
+    remaining = limit
+    while remaining is None or remaining > 0:
+        size = STATUS_PAGE_SIZE if remaining is None else min(remaining, STATUS_PAGE_SIZE)
+        page = await data_store.list_metadata_async(query, size)
+        if page:
+            yield await run_in_threadpool(status_lines, page)
+        if len(page) < size:
+            return
+        query.after = query.sort_key(page[-1])
+        if remaining is not None:
+            remaining -= len(page)
+
 
 # 路由：状态查询
 @app.get("/status", response_model=StatusResponse)
-async def get_status():
+async def get_status(
+    limit: Optional[int] = Query(None, ge=1),
+    cursor: Optional[str] = None,
+    sort: str = 'name',
+    updated_since: Optional[str] = None,
+    has_data: Optional[bool] = None,
+    device: Optional[str] = None,
+    output: str = Query('json', alias='format'),
+    principal: Optional[TokenPrincipal] = Depends(verify_auth)
+):
     """
     获取服务器状态
 
-    返回所有配置文件的信息，包括：
+    返回配置文件的信息，包括：
     - 配置名称
     - 最后更新时间
     - 是否有数据
     - 设备列表
     - 备份信息
-    """
+    - 备份大小
 
-    configs = []
-    config_names = data_store.list_configs()
+    - **limit** / **cursor**: 分页，每页最多 `STATUS_PAGE_SIZE` 个；还有下一页时返回 `next_cursor`。
+      不带 `limit` 时返回全部匹配的配置
+    - **sort**: `name`（默认）/ `last_updated`，加 `-` 前缀倒序
+    - **updated_since** / **has_data** / **device**: 过滤条件
+    - **format=ndjson**: 流式导出匹配的配置（每行一个），`limit` 为最多输出的行数
 
-    for config_name in config_names:
-        config_file = data_store.get_config_file(config_name)
-        try:
-            with open(config_file, 'r', encoding='utf-8') as f:
-                config_data = json.load(f)
+    令牌文件中的受限用户只能看到其可访问的配置，`total_configs` 也只统计这些配置。
+    """
+
+    try:
+        query = MetadataQuery(sort, cursor, updated_since, has_data, device, principal)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
 
-            has_data = config_data.get('encrypted_data') is not None
-            backup_info = {}
+    if output == 'ndjson':
+        return StreamingResponse(stream_status(query, limit), media_type='application/x-ndjson')
+    if output != 'json':
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='format must be json or ndjson')
 
-            if has_data:
-                try:
-                    backup = json.loads(config_data['encrypted_data'])
-                    backup_info = {
-                        'version': backup.get('version'),
-                        'exportedAt': backup.get('exportedAt'),
-                        'checksum': backup.get('checksum', '')[:16] + '...'
-                    }
-                except:
-                    pass
+    # 直接从元数据索引构建响应，不读取任何数据文件；多取一个用来判断是否还有下一页
+    page_size = min(limit, STATUS_PAGE_SIZE) if limit is not None else None
+    page = await data_store.list_metadata_async(query, page_size + 1 if page_size is not None else None)
+    next_cursor = None
+    if page_size is not None and len(page) > page_size:
+        page = page[:page_size]
+        next_cursor = query.cursor_for(page[-1])
+    if query.principal is None:
+        total_configs = await data_store.count_configs_async()
+    else:
+        total_configs = len(await data_store.list_metadata_async(MetadataQuery(principal=query.principal)))
 
-            configs.append(ConfigResponse(
-                name=config_name,
-                last_updated=config_data.get('last_updated'),
-                has_data=has_data,
-                devices=list(config_data.get('device_info', {}).keys()),
-                backup=backup_info
-            ))
-        except Exception as e:
-            configs.append(ConfigResponse(
-                name=config_name,
-                error=f'Unable to read: {str(e)}'
-            ))
-
-    return StatusResponse(
-        status="running",
-        data_dir=os.path.abspath(DATA_DIR),
-        total_configs=len(configs),
-        configs=configs
-    )
+    # 结构与 StatusResponse 一致（response_model 仍用于接口文档），直接编码以免逐个构造模型
+    return CodecJSONResponse({
+        'status': 'running',
+        'data_dir': os.path.abspath(DATA_DIR),
+        'total_configs': total_configs,
+        'configs': [config_summary(metadata) for metadata in page],
+        'next_cursor': next_cursor
+    })
 
 
 # 路由：清除指定配置
 @app.post("/clear/{config_name}")
 async def clear_config(
     config_name: str,
-    _: None = Depends(verify_auth)
+    _: None = Depends(verify_write_auth)
 ):
     """
     清除指定配置的数据
     """
 
     try:
-        data_store.clear_config(config_name)
+        validate_config_name(config_name)
+        async with data_store.locked(config_name):
+            await data_store.clear_config_async(config_name)
+        change_notifier.publish(config_name, change_event(config_name, None))
 
-        print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] 配置已清除: {config_name}")
+        log_event(logging.INFO, '配置已清除', event='clear', config=config_name)
 
         return {
             'status': 'success',
@@ -414,16 +6039,24 @@ async def clear_config(
 # 路由：清除所有配置
 @app.post("/clear")
 async def clear_all(
-    _: None = Depends(verify_auth)
+    principal: Optional[TokenPrincipal] = Depends(verify_write_auth)
 ):
     """
-    清除所有配置数据
+    清除所有配置数据（令牌文件中的用户需要有 `*` 权限）
     """
 
+    if principal is not None and not principal.all_configs:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail='Token is not allowed to clear all configs'
+        )
+
     try:
-        data_store.clear_all()
+        await data_store.clear_all_async()
+        for config_name in change_notifier.configs():
+            change_notifier.publish(config_name, change_event(config_name, None))
 
-        print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] 所有配置已清除")
+        log_event(logging.INFO, '所有配置已清除', event='clear_all')
 
         return {
             'status': 'success',
@@ -436,6 +6069,58 @@ async def clear_all(
         )
 
 
+# 路由：复制变更流
+@app.get("/replication/changes")
+async def replication_changes(
+    since: int = Query(0, ge=0),
+    feed: Optional[str] = None,
+    limit: int = Query(REPLICATION_PAGE_SIZE, ge=1),
+    wait: Optional[float] = None,
+    principal: Optional[TokenPrincipal] = Depends(verify_auth)
+):
+    """
+    复制变更流：返回序号大于 `since` 的变更（每个配置只返回最新一条），供副本增量同步
+    （令牌文件中的用户需要有 `*` 权限）
+
+    - **since** / **feed**: 上次响应中的 `next` 和 `feed`；首次同步不带 `feed`
+    - **limit**: 最多返回的变更数量（不超过 `REPLICATION_PAGE_SIZE`）
+    - **wait**: 没有新变更时挂起等待的秒数（长轮询）
+
+    `changes` 中每条变更的 `op` 为 `put`（新版本，内容从 `/sync/<配置名>/versions/<version>` 下载）
+    或 `delete`（配置已清除）；`reset` 为 true 时副本应完整对账，删除本地多出的配置。
+    `more` 为 true 时应立即继续拉取。
+    """
+
+    if principal is not None and not principal.all_configs:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail='Token is not allowed to read the replication feed'
+        )
+
+    limit = min(limit, REPLICATION_PAGE_SIZE)
+    if wait and wait > 0:
+        page = await wait_for_feed(since, feed, limit, min(wait, MAX_WAIT_SECONDS))
+    else:
+        page = await data_store.feed_changes_async(since, feed, limit)
+    return CodecJSONResponse(page)
+
+
+# 路由：监控指标
+@app.get("/metrics")
+async def get_metrics():
+    """
+    Prometheus 文本格式的监控指标
+    """
+
+    config_count, stored_bytes = await data_store.storage_stats_async()
+    CONFIGS_TOTAL.set(config_count)
+    STORED_BYTES.set(stored_bytes)
+    CHANGE_SUBSCRIBERS.set(change_notifier.subscriber_count())
+    REPLICATION_SEQ.set(data_store.feed.last_seq)
+
+    return Response(content=metrics.render(), media_type='text/plain; version=0.0.4; charset=utf-8')
+
+
 # 路由：健康检查
 @app.get("/health")
 async def health_check():
@@ -459,23 +6144,14 @@ def print_banner():
 
 
 if __name__ == '__main__':
-    # 从环境变量读取配置（可选）
-    API_TOKEN = os.getenv('VAULTSAFE_API_TOKEN', API_TOKEN)
-    BASIC_AUTH_USERNAME = os.getenv('VAULTSAFE_USERNAME', BASIC_AUTH_USERNAME)
-    BASIC_AUTH_PASSWORD = os.getenv('VAULTSAFE_PASSWORD', BASIC_AUTH_PASSWORD)
-    PORT = int(os.getenv('VAULTSAFE_PORT', PORT))
-    DATA_DIR = os.getenv('VAULTSAFE_DATA_DIR', DATA_DIR)
-
-    # 更新数据存储实例
-    data_store = DataStore(DATA_DIR)
-
     print_banner()
 
-    # 启动服务器
+    # 启动服务器（多个工作进程时 uvicorn 在每个进程中重新导入本模块）
     uvicorn.run(
         "sync_server:app",
         host="0.0.0.0",
         port=PORT,
+        workers=WORKERS,
         reload=False,
         access_log=False
     )
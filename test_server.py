@@ -5,8 +5,11 @@ VaultSafe 同步服务器测试脚本
 """
 
 import requests
+import hashlib
 import json
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 # 默认配置
 BASE_URL = "http://localhost:5000"
@@ -16,11 +19,24 @@ USERNAME = None   # 如果设置了Basic Auth，在这里填写
 PASSWORD = None
 
 
+def request_auth():
+    """按上面的认证设置返回请求头和 Basic Auth，供各测试的请求使用"""
+    headers = {}
+    if API_TOKEN:
+        headers["Authorization"] = f"Bearer {API_TOKEN}"
+
+    auth = None
+    if USERNAME and PASSWORD:
+        auth = (USERNAME, PASSWORD)
+    return headers, auth
+
+
 def test_status():
     """测试状态接口"""
     print("\n📊 测试状态接口...")
+    headers, auth = request_auth()
     try:
-        response = requests.get(f"{BASE_URL}/status", timeout=5)
+        response = requests.get(f"{BASE_URL}/status", headers=headers, auth=auth, timeout=5)
         print(f"   状态码: {response.status_code}")
         if response.status_code == 200:
             data = response.json()
@@ -173,6 +189,304 @@ def test_multiple_configs():
     return all(r[1] for r in results)
 
 
+def test_concurrent_uploads():
+    """并发压力测试：多个设备同时上传同一配置，不应丢失任何设备信息，下载也不应读到半截数据"""
+    config = "stress"
+    device_count = 40
+    print(f"\n🔀 测试并发上传 (配置: {config}, 设备数: {device_count})...")
+
+    headers, auth = request_auth()
+
+    def upload(index):
+        test_data = {
+            "device_id": f"stress-device-{index}",
+            "timestamp": 1704067200 + index,
+            "encrypted_data": json.dumps({
+                "version": "1.0",
+                "index": index,
+                "padding": "x" * 65536
+            }),
+            "version": "1.0"
+        }
+        response = requests.post(
+            f"{BASE_URL}/sync/{config}",
+            json=test_data,
+            headers=headers,
+            auth=auth
+        )
+        return response.status_code == 200
+
+    def download(_):
+        response = requests.get(
+            f"{BASE_URL}/sync/{config}",
+            headers=headers,
+            auth=auth
+        )
+        if response.status_code == 404:
+            return True
+        # 解析失败说明读到了写了一半的文件
+        response.json()
+        return response.status_code == 200
+
+    try:
+        requests.post(f"{BASE_URL}/clear/{config}", headers=headers, auth=auth)
+
+        with ThreadPoolExecutor(max_workers=16) as pool:
+            uploads = pool.map(upload, range(device_count))
+            downloads = pool.map(download, range(device_count))
+            upload_ok = all(uploads)
+            download_ok = all(downloads)
+
+        response = requests.get(f"{BASE_URL}/status", headers=headers, auth=auth, timeout=5)
+        stress_config = next(c for c in response.json()['configs'] if c['name'] == config)
+        devices = set(stress_config.get('devices', []))
+        expected = {f"stress-device-{i}" for i in range(device_count)}
+        missing = expected - devices
+
+        print(f"   上传全部成功: {'是' if upload_ok else '否'}")
+        print(f"   下载全部完整: {'是' if download_ok else '否'}")
+        print(f"   记录的设备数: {len(devices)}/{device_count}")
+        if missing:
+            print(f"   ❌ 丢失的设备: {sorted(missing)}")
+        return upload_ok and download_ok and not missing
+    except Exception as e:
+        print(f"   ❌ 失败: {e}")
+        return False
+
+
+def test_long_poll():
+    """长轮询：带 If-None-Match 和 ?wait= 的下载应挂起，直到另一台设备上传后立即返回"""
+    config = "longpoll"
+    print(f"\n⏳ 测试长轮询 (配置: {config})...")
+
+    headers, auth = request_auth()
+
+    def upload(marker):
+        test_data = {
+            "device_id": "longpoll-device",
+            "timestamp": 1704067200,
+            "encrypted_data": json.dumps({"version": "1.0", "marker": marker}),
+            "version": "1.0"
+        }
+        return requests.post(f"{BASE_URL}/sync/{config}", json=test_data, headers=headers, auth=auth)
+
+    try:
+        etag = upload("before").headers.get("ETag")
+
+        def wait_for_update():
+            start = time.time()
+            response = requests.get(
+                f"{BASE_URL}/sync/{config}?wait=10",
+                headers={**headers, "If-None-Match": etag},
+                auth=auth,
+                timeout=20
+            )
+            return response, time.time() - start
+
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            pending = pool.submit(wait_for_update)
+            time.sleep(1)
+            upload("after")
+            response, elapsed = pending.result()
+
+        received = response.status_code == 200 and response.json().get("marker") == "after"
+        print(f"   收到新版本: {'是' if received else '否'}")
+        print(f"   等待时间: {elapsed:.2f} 秒")
+        return received and elapsed < 5
+    except Exception as e:
+        print(f"   ❌ 失败: {e}")
+        return False
+
+
+def test_batch_sync():
+    """批量同步：一次请求上传多个配置，再只取回有变化的配置"""
+    configs = ["batch-work", "batch-personal", "batch-family"]
+    print(f"\n📚 测试批量同步 (配置: {', '.join(configs)})...")
+
+    headers, auth = request_auth()
+
+    try:
+        uploads = [
+            {
+                "config_name": config,
+                "device_id": "batch-device",
+                "timestamp": 1704067200,
+                "encrypted_data": json.dumps({"version": "1.0", "config": config}),
+                "version": "1.0"
+            }
+            for config in configs
+        ]
+        response = requests.post(f"{BASE_URL}/sync/batch", json={"uploads": uploads}, headers=headers, auth=auth)
+        results = [json.loads(line) for line in response.text.splitlines()]
+        uploaded = [r for r in results if r.get("status") == "uploaded"]
+        print(f"   上传成功: {len(uploaded)}/{len(configs)}")
+
+        # 第一个配置带上已知 ETag，应返回 unchanged，其余返回完整备份
+        known = [{"name": uploaded[0]["config_name"], "etag": uploaded[0]["etag"]}]
+        known += [{"name": r["config_name"]} for r in uploaded[1:]]
+        response = requests.post(f"{BASE_URL}/sync/batch", json={"configs": known}, headers=headers, auth=auth)
+        results = [json.loads(line) for line in response.text.splitlines()]
+        statuses = [r.get("status") for r in results]
+        print(f"   下载状态: {statuses}")
+        return len(uploaded) == len(configs) and statuses == ["unchanged", "changed", "changed"]
+    except Exception as e:
+        print(f"   ❌ 失败: {e}")
+        return False
+
+
+def test_streaming_upload_and_range():
+    """流式上传：PUT 原始备份，再用 Range 分段下载并拼接，结果应与上传内容一致"""
+    config = "streaming"
+    print(f"\n🌊 测试流式上传与分段下载 (配置: {config})...")
+
+    headers, auth = request_auth()
+
+    backup = json.dumps({
+        "version": "1.0",
+        "format": "vaultsafe-encrypted",
+        "data": {"ciphertext": "x" * 1024 * 1024},
+        "exportedAt": "2024-01-01T00:00:00.000Z"
+    }).encode("utf-8")
+
+    def chunks():
+        for i in range(0, len(backup), 64 * 1024):
+            yield backup[i:i + 64 * 1024]
+
+    try:
+        response = requests.put(
+            f"{BASE_URL}/sync/{config}",
+            params={"device_id": "streaming-device", "timestamp": 1704067200},
+            data=chunks(),
+            headers=headers,
+            auth=auth
+        )
+        print(f"   上传状态码: {response.status_code}")
+
+        parts = []
+        half = len(backup) // 2
+        for byte_range in (f"bytes=0-{half - 1}", f"bytes={half}-"):
+            part = requests.get(
+                f"{BASE_URL}/sync/{config}",
+                headers={**headers, "Range": byte_range},
+                auth=auth
+            )
+            if part.status_code != 206:
+                print(f"   ❌ Range 请求返回 {part.status_code}")
+                return False
+            parts.append(part.content)
+
+        matches = b"".join(parts) == backup
+        print(f"   分段拼接一致: {'是' if matches else '否'}")
+        return response.status_code == 200 and matches
+    except Exception as e:
+        print(f"   ❌ 失败: {e}")
+        return False
+
+
+def test_chunked_sync():
+    """分块同步：只上传变化的数据块并提交清单，完整下载的结果应与修改后的备份一致"""
+    config = "chunked"
+    print(f"\n🧩 测试分块同步 (配置: {config})...")
+
+    headers, auth = request_auth()
+
+    backup = json.dumps({
+        "version": "1.0",
+        "format": "vaultsafe-encrypted",
+        "data": {"ciphertext": "AbZz" * 256 * 1024},
+        "exportedAt": "2024-01-01T00:00:00.000Z"
+    })
+
+    try:
+        requests.post(
+            f"{BASE_URL}/sync/{config}",
+            json={"device_id": "chunked-device", "timestamp": 1704067200, "encrypted_data": backup},
+            headers=headers,
+            auth=auth
+        )
+        manifest = requests.get(f"{BASE_URL}/sync/{config}/manifest", headers=headers, auth=auth).json()
+        hashes = [chunk["hash"] for chunk in manifest["chunks"]]
+        print(f"   数据块数量: {len(hashes)}")
+
+        # 只替换最后一个数据块，其余数据块服务器上已有
+        last = requests.get(f"{BASE_URL}/sync/{config}/chunks/{hashes[-1]}", headers=headers, auth=auth).content
+        new_last = last.replace(b"2024-01-01", b"2024-06-01")
+        new_hash = hashlib.sha256(new_last).hexdigest()
+        requests.put(f"{BASE_URL}/sync/{config}/chunks/{new_hash}", data=new_last, headers=headers, auth=auth)
+
+        response = requests.post(
+            f"{BASE_URL}/sync/{config}/manifest",
+            json={"device_id": "chunked-device", "timestamp": 1704067201, "chunks": hashes[:-1] + [new_hash]},
+            headers={**headers, "If-Match": manifest["etag"]},
+            auth=auth
+        )
+        print(f"   提交清单状态码: {response.status_code}")
+
+        expected = backup.replace("2024-01-01", "2024-06-01").encode("utf-8")
+        download = requests.get(f"{BASE_URL}/sync/{config}", headers=headers, auth=auth)
+        matches = download.content == expected
+        print(f"   重组结果一致: {'是' if matches else '否'}")
+        return response.status_code == 200 and matches
+    except Exception as e:
+        print(f"   ❌ 失败: {e}")
+        return False
+
+
+def test_clear_during_uploads():
+    """上传期间清除全部数据：之后 /status 列出的每个配置都应能完整下载（会清除服务器上的所有数据）"""
+    config_count = 16
+    upload_count = 200
+    print(f"\n🧹 测试上传期间清除全部数据 ({config_count} 个配置，{upload_count} 次上传)...")
+
+    headers, auth = request_auth()
+
+    def upload(index):
+        test_data = {
+            "device_id": f"clear-device-{index}",
+            "timestamp": 1704067200 + index,
+            "encrypted_data": json.dumps({"version": "1.0", "index": index, "padding": "x" * 16384}),
+        }
+        response = requests.post(
+            f"{BASE_URL}/sync/clear-race-{index % config_count}",
+            json=test_data,
+            headers=headers,
+            auth=auth
+        )
+        return response.status_code == 200
+
+    try:
+        with ThreadPoolExecutor(max_workers=16) as pool:
+            uploads = [pool.submit(upload, i) for i in range(upload_count)]
+            # 在上传进行期间多次清除，之后仍有上传继续写入
+            clears = []
+            for _ in range(5):
+                time.sleep(0.05)
+                clears.append(requests.post(f"{BASE_URL}/clear", headers=headers, auth=auth).status_code == 200)
+            upload_ok = all(future.result() for future in uploads)
+            clear_ok = all(clears)
+
+        response = requests.get(f"{BASE_URL}/status", headers=headers, auth=auth, timeout=5)
+        listed = [c["name"] for c in response.json()["configs"] if c.get("has_data")]
+        broken = []
+        for name in listed:
+            download = requests.get(f"{BASE_URL}/sync/{name}", headers=headers, auth=auth)
+            if download.status_code != 200:
+                broken.append((name, download.status_code))
+                continue
+            # 解析失败说明读到了不完整的备份
+            download.json()
+
+        print(f"   上传全部成功: {'是' if upload_ok else '否'}")
+        print(f"   清除全部成功: {'是' if clear_ok else '否'}")
+        print(f"   清除后列出的配置: {len(listed)}，无法下载: {len(broken)}")
+        if broken:
+            print(f"   ❌ 无法下载的配置: {broken}")
+        return upload_ok and clear_ok and not broken
+    except Exception as e:
+        print(f"   ❌ 失败: {e}")
+        return False
+
+
 def main():
     print("=" * 50)
     print("  VaultSafe 同步服务器测试")
@@ -201,6 +515,12 @@ def main():
     results.append(("上传数据", test_upload()))
     results.append(("下载数据", test_download()))
     results.append(("多配置功能", test_multiple_configs()))
+    results.append(("并发上传", test_concurrent_uploads()))
+    results.append(("长轮询", test_long_poll()))
+    results.append(("批量同步", test_batch_sync()))
+    results.append(("流式上传", test_streaming_upload_and_range()))
+    results.append(("分块同步", test_chunked_sync()))
+    results.append(("上传期间清除", test_clear_during_uploads()))
 
     # 打印结果
     print("\n" + "=" * 50)